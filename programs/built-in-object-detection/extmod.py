@@ -1,23 +1,62 @@
 from datetime import datetime, timezone
+import math
+import shlex
 import subprocess
+import threading
 import sys
 import os
 import time
 import json
+import copy
+import hashlib
+import tempfile
+import multiprocessing
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import torch
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
 from PIL import Image, ImageDraw
+import numpy as np
 
 # プイレビュー用画像の保存パス
 PREVIEW_IMAGE_PATH = os.environ["PREVIEW_IMAGE_PATH"]
 
+#
+# プレビュー画像をHTTPで配信するポート番号
+# 指定した場合はPREVIEW_IMAGE_PATHへの書き込みは行わず、
+# http://<ホスト>:<ポート>/stream.mjpg (MJPEG) と /result.jpg で配信する
+# 0の場合は配信せず、従来通りPREVIEW_IMAGE_PATHに書き込む
+PREVIEW_HTTP_PORT = int(os.environ.get("PREVIEW_HTTP_PORT", "0"))
+
 # 使用するYoloモデルファイルの名前
 # パス指定する場合はソースコードからの相対パスで指定
-MODEL_FILE_NAME = os.environ["MODEL_FILE_NAME"]
+# 環境変数で指定しない場合は、設定ファイル(CONFIG_FILE_PATH)で指定する
+MODEL_FILE_NAME = os.environ.get("MODEL_FILE_NAME", "")
 
 # モデルファイルを絶対パスに変換(このソースコードの場所を起点)
 MODEL_FILE_PATH = os.path.join(os.path.dirname(__file__), MODEL_FILE_NAME)
 
+#
+# 設定ファイル(JSON)のパス
+# RuntimeConfig.KEYSの設定値(CONF、IOU、CLASSESなど)を、このファイルの定数の代わりに指定できる
+# 例) {"CONF" : 0.4, "CLASSES" : [0, 2]}
+# 実行中もCONFIG_CHECK_INTERVAL_SECごとに変更を確認し、変更されていれば次のフレームから反映する
+# (コンテナの再起動やモデルの読み込み直しは不要で、MODEL_FILE_NAMEを変更した場合だけ新しいモデルを読み込む)
+# 同じ名前の環境変数を指定した場合は、環境変数の値を優先する
+# ファイルがない場合は、このファイルの定数の値を使う
+CONFIG_FILE_PATH = os.environ.get("CONFIG_FILE_PATH", os.path.join(os.path.dirname(__file__), "config.json"))
+
+# 設定ファイルの変更を確認する間隔(秒)
+CONFIG_CHECK_INTERVAL_SEC = 2
+
 # confidence threshold
 # 検出信頼度の閾値(0.0 ~ 1.0)
 # これを下回る検出信頼度(confidence score)の検出は、結果に含めない1
@@ -50,6 +89,194 @@ IOU = 0.5
 #
 CLASSES = [0]
 
+#
+# カメラフレームをストリーミングで取得するコマンド
+# 標準出力にJPEG画像を連続で出力し続けるコマンドを指定する
+# 例) ffmpeg -loglevel error -f v4l2 -i /dev/video0 -f mjpeg -q:v 3 -
+# 空の場合は従来通り、1フレームごとに aicap get_frame を実行する
+FRAME_STREAM_COMMAND = os.environ.get("FRAME_STREAM_COMMAND", "")
+
+#
+# ストリーミングコマンドの出力形式
+# "mjpeg"  : JPEG画像の連結(multipartのヘッダが間に含まれていても可)
+# "length" : 4バイト(ビッグエンディアン)のデータ長 + JPEG画像 の繰り返し
+FRAME_STREAM_FORMAT = os.environ.get("FRAME_STREAM_FORMAT", "mjpeg")
+
+#
+# 複数のカメラを1つのプロセスで処理する場合の、カメラの設定(JSON配列)
+# モデルは全カメラで1つだけ読み込み、各カメラの最新フレームをまとめて1回のpredictで推論する
+# 例) [{"name" : "front", "stream_command" : "ffmpeg ... -f mjpeg -", "preview_http_port" : 8081},
+#      {"name" : "back", "stream_command" : "ffmpeg ... -f mjpeg -"}]
+#   name               : カメラの名前(Push通知の結果情報に "camera" として含まれる)
+#   stream_command     : ストリーミングコマンド(省略時はFRAME_STREAM_COMMAND、空の場合は aicap get_frame)
+#   stream_format      : ストリーミングコマンドの出力形式(省略時はFRAME_STREAM_FORMAT)
+#   preview_image_path : プレビュー画像の保存パス(省略時はPREVIEW_IMAGE_PATHのファイル名に _<name> を付けたもの)
+#   preview_http_port  : プレビュー画像をHTTPで配信するポート番号(省略時は0: 配信しない)
+#   rois               : 推論する領域(ROI)の多角形のリスト(省略時はROIS)
+# aicap get_frameで取得できるのはAIBOXのカメラ1台分だけなので、2台目以降はstream_commandを指定する
+# 空の場合は従来通り、1台のカメラを処理する
+CAMERAS = os.environ.get("CAMERAS", "")
+
+#
+# 統計情報(フレーム取得、Push通知など)を出力する間隔(秒)
+# 0の場合は出力しない(終了時には必ず出力する)
+STATS_INTERVAL_SEC = float(os.environ.get("STATS_INTERVAL_SEC", "60"))
+
+#
+# JPEGのデコードと、枠の描画 + JPEGエンコードを行うワーカープロセスの数
+# 推論とは別のプロセスで行うので、検知物体が多く描画に時間がかかるシーンでも推論が遅れない
+# 画像データは共有メモリ(/dev/shm)で受け渡すので、Dockerのshm_size(既定64MB)に収まるよう注意する
+# 0の場合はワーカープロセスを使わず、従来通り同じプロセス内で処理する
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))
+
+#
+# 処理時間のパーセンタイルを計算するために保持するサンプル数(処理段ごと)
+STAGE_LATENCY_SAMPLES = 1000
+
+#
+# 計測値(処理時間、件数)をPrometheusのテキスト形式で書き出すファイル
+# node_exporterのtextfile collectorなどで収集する
+# 空の場合は書き出さない(PREVIEW_HTTP_PORTを指定した場合は http://<アドレス>:<ポート>/metrics でも取得できる)
+METRICS_FILE_PATH = os.environ.get("METRICS_FILE_PATH", "")
+
+# 計測値をファイルに書き出す間隔(秒)
+METRICS_INTERVAL_SEC = 10
+
+#
+# 推論ごとのUltralyticsのコンソール出力
+# ログ(json-file 10MB×10)を消費するので、"0"を指定すると出力しない
+PREDICT_VERBOSE = os.environ.get("PREDICT_VERBOSE", "1") != "0"
+
+#
+# モデルの入力画像サイズ(ピクセル)
+# フレームのJPEGは、長辺がこのサイズを下回らない範囲で縮小しながらデコードする
+# (JPEGのDCTスケーリングを使うので、フルサイズでデコードしてから縮小するより速く、メモリも少ない)
+# 検出したBOXの座標は元の解像度に変換してから、描画やPush通知に使用する
+# 0の場合は縮小せずにデコードする
+MODEL_INPUT_SIZE = int(os.environ.get("MODEL_INPUT_SIZE", "640"))
+
+#
+# 推論する領域(ROI)の多角形のリスト(JSON配列)
+# 座標はフレームの幅と高さに対する割合(0.0 ~ 1.0)で指定する
+# 例) [[[0.0, 0.5], [0.6, 0.3], [1.0, 0.3], [1.0, 1.0], [0.0, 1.0]]]
+# 各ROIを囲む矩形だけを切り出して推論し、中心がいずれかのROIの中にある物体だけを検出する
+# (フレーム全体を縮小して推論するより、遠くの小さな物体が検出しやすくなる)
+# 複数のカメラを処理する場合は、CAMERASの "rois" でカメラごとに指定できる
+# 空の場合はフレーム全体を推論する
+ROIS = os.environ.get("ROIS", "")
+
+#
+# ROIを囲む矩形を、モデルの入力サイズのタイルに分割して推論する(タイル推論)
+# フレームを縮小せずにデコードするので小さな物体も検出できるが、タイルの数だけ推論の回数が増える
+# タイルの重なった部分で重複して検出された物体は1つにまとめる
+ROI_TILED = os.environ.get("ROI_TILED", "0") == "1"
+
+# タイルの重なり(タイルの大きさに対する割合)
+# タイルの境界で分断された物体も、どちらかのタイルで全体が写るようにする
+ROI_TILE_OVERLAP = 0.2
+
+#
+# シーンに変化がないフレームの推論を省略する(モーションゲート)
+# JPEGのデータが最後に推論したフレームと同じ場合や、
+# 縮小したグレースケール画像で、輝度がMOTION_PIXEL_THRESHOLD以上変化した画素の割合が
+# MOTION_AREA_THRESHOLD未満の場合は推論を省略し、前回の結果をそのまま使う
+# 変化が閾値未満の物体(遠くの小さな物体など)は、MOTION_FORCE_INTERVAL_SECごとの推論まで検知が遅れるので、
+# 有効にする場合は、実際の映像で見逃しがないことを確認しながらMOTION_AREA_THRESHOLDを調整する
+# 既定では無効(すべてのフレームを推論する)、MOTION_GATE_ENABLED=1で有効にする
+MOTION_GATE_ENABLED = os.environ.get("MOTION_GATE_ENABLED", "0") == "1"
+MOTION_PIXEL_THRESHOLD = 15
+MOTION_AREA_THRESHOLD = 0.0005
+
+#
+# 変化がなくても推論する間隔(秒)
+# 最後に推論してからこの時間が経過した場合は、必ず推論を行う
+MOTION_FORCE_INTERVAL_SEC = 5
+
+#
+# 読み込んだモデルを保持しておく数
+# モデルはファイルごとに1回だけ読み込まれ、フレームの画像サイズが変わってもそのまま再利用する
+# (推論時にモデルの入力サイズに合わせてレターボックス処理される)
+MODEL_CACHE_SIZE = 2
+
+#
+# フレームレート(fps)
+# フレームの取得、推論、結果の公開(描画・Push通知・プレビュー保存)は別々のスレッドで並行して行う
+# 物体を検出している間はTARGET_FPSで動作し、
+# 検出がない状態がIDLE_AFTER_SEC秒続いたらIDLE_FPSに下げる(検出したらすぐTARGET_FPSに戻る)
+TARGET_FPS = 10
+IDLE_FPS = 2
+IDLE_AFTER_SEC = 10
+
+#
+# エラー発生時の待ち時間(秒)
+# エラーが続く場合は倍々に延ばし、ERROR_RETRY_INTERVAL_MAX_SECで頭打ちにする
+ERROR_RETRY_INTERVAL_SEC = 0.5
+ERROR_RETRY_INTERVAL_MAX_SEC = 5
+
+#
+# Push通知キューの最大数
+# 送信待ちの通知がこの数を超えた場合は、PUSH_DROP_POLICYに従って破棄する
+PUSH_QUEUE_SIZE = 10
+
+#
+# Push通知キューが満杯の場合の破棄方針
+# "oldest" : 一番古い通知を破棄して新しい通知を積む
+# "newest" : 新しい通知を破棄する
+PUSH_DROP_POLICY = "oldest"
+
+#
+# Push通知に失敗した場合のリトライ回数
+PUSH_RETRY_COUNT = 3
+
+#
+# リトライまでの待ち時間(秒)
+# リトライのたびに倍になり、PUSH_RETRY_INTERVAL_MAX_SECで頭打ちになる
+PUSH_RETRY_INTERVAL_SEC = 1.0
+PUSH_RETRY_INTERVAL_MAX_SEC = 30.0
+
+#
+# aicap push コマンドのタイムアウト(秒)
+PUSH_TIMEOUT_SEC = 60
+
+#
+# Push通知の結果情報(JSON)の渡し方
+# "arg"   : コマンドライン引数(-J)で渡す(従来通り)
+# "file"  : 一時ファイルに書き込み、PUSH_JSON_FILE_OPTIONでパスを渡す(画像は標準入力)
+# "stdin" : 標準入力で渡す(画像は一時ファイルに書き込み、-i でパスを渡す)
+# 検出物体が多いと、コマンドライン引数の長さの上限(1つあたり128KB)を超えることがあるので、その場合は "file" / "stdin" を使う
+# ("file" / "stdin" は、結果情報をファイルから読み込めるaicapが必要)
+PUSH_PAYLOAD_TRANSPORT = os.environ.get("PUSH_PAYLOAD_TRANSPORT", "arg")
+
+# 結果情報のファイルを指定するaicap pushのオプション("stdin"の場合は "-" を渡す)
+# aicapのバージョンによって異なるので既定値はなく、"file" / "stdin" を使う場合は必ず指定する
+PUSH_JSON_FILE_OPTION = os.environ.get("PUSH_JSON_FILE_OPTION", "")
+
+#
+# 結果情報のキーを短縮する(PUSH_SHORT_KEY_MAP)
+# 受信側で短縮したキーを扱えるようにしてから有効にする
+PUSH_SHORT_KEYS = os.environ.get("PUSH_SHORT_KEYS", "0") == "1"
+
+# 結果情報の小数の桁数(負の場合は丸めない)
+PUSH_FLOAT_DIGITS = 3
+
+#
+# Push通知する画像
+# "full"      : 元の解像度の画像に検知枠を描画する(従来通り)
+# "thumbnail" : 推論に使った縮小画像に検知枠を描画し、長辺をPUSH_THUMBNAIL_SIZE以下にする
+# "crops"     : 検出物体のBOXの部分だけを元の解像度の画像から切り出し、横に並べる
+# "thumbnail" / "crops" の場合は、元の解像度でのデコードと描画を行わないので、CPUの負荷も下がる
+PUSH_IMAGE_MODE = os.environ.get("PUSH_IMAGE_MODE", "full")
+
+# サムネイルの長辺のサイズ(ピクセル)
+PUSH_THUMBNAIL_SIZE = 640
+
+# 切り出した画像の高さ(ピクセル)、周囲に含める余白(BOXの大きさに対する割合)、最大の数
+PUSH_CROP_HEIGHT = 240
+PUSH_CROP_MARGIN = 0.2
+PUSH_CROP_COUNT = 8
+
+# 結果情報のキーの短縮形
+PUSH_SHORT_KEY_MAP = {"pos" : "p", "box" : "b", "conf" : "c", "cls" : "k", "camera" : "cam"}
 
 def get_frame() -> bytes:
     """
@@ -77,7 +304,264 @@ def get_frame() -> bytes:
             f"Command failed (exit code {e.returncode}): "
             f"{e.stderr.decode(errors='ignore')}"
         ) from e
-    
+
+
+class FrameSource:
+    """
+    カメラフレーム画像(JPEG)の取得元
+
+    stream_commandが指定されている場合は、常駐させた子プロセスの標準出力から
+    JPEG画像を連続で読み込み、最新のフレームを返します(ストリーミングモード)
+    指定されていない場合や、子プロセスが停止している間は
+    get_frame()で1フレームずつ取得します(ワンショットモード)
+    """
+
+    # JPEGのSOI/EOIマーカー
+    SOI = b"\xff\xd8"
+    EOI = b"\xff\xd9"
+
+    # 子プロセスが停止してから再起動を試みるまでの時間(秒)
+    RESTART_INTERVAL_SEC = 5
+
+    def __init__(self, stream_command : str = "", stream_format : str = "mjpeg"):
+        """
+        Args:
+            stream_command (str) : ストリーミングで使用するコマンド(空の場合はワンショットのみ)
+            stream_format (str)  : ストリーミングの出力形式("mjpeg" または "length")
+        """
+        self.stream_command = stream_command
+        self.stream_format = stream_format
+
+        self._proc = None
+        self._reader_alive = False
+        self._next_start_time = 0.0
+        self._cond = threading.Condition()
+
+        # 最新フレームと、その通番
+        self._frame = None
+        self._frame_seq = 0
+
+        # read()で最後に返したフレームの通番
+        self._read_seq = 0
+
+        # 統計情報
+        self._stats_start = time.monotonic()
+        self._stats_count = 0
+        self._stats_latency_sum = 0.0
+        self._stats_latency_max = 0.0
+
+    @property
+    def streaming(self) -> bool:
+        """
+        ストリーミングモードで動作中かどうか
+        """
+        return self._reader_alive
+
+    def read(self, timeout : float = 5.0) -> bytes:
+        """
+        最新のカメラフレーム画像を取得します
+        ストリーミングモードの場合は、前回返したフレームより新しいフレームが届くまで待ちます
+
+        Args:
+            timeout (float) : ストリーミングでフレームを待つ最大時間(秒)
+
+        Returns:
+            bytes : カメラフレーム画像(JPEG)
+        """
+        start = time.monotonic()
+        frame = None
+
+        if self.stream_command:
+            self._ensure_stream()
+            if self.streaming:
+                frame = self._read_stream(timeout)
+
+        if frame is None:
+            # ストリーミングが使えない場合はワンショットで取得
+            frame = get_frame()
+
+        latency = time.monotonic() - start
+        self._stats_count += 1
+        self._stats_latency_sum += latency
+        self._stats_latency_max = max(self._stats_latency_max, latency)
+
+        return frame
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までのフレーム取得の統計を返します
+
+        Returns:
+            dict : mode(取得方式), frames(取得数), fps, latency_avg_ms / latency_max_ms(取得にかかった時間)
+        """
+        now = time.monotonic()
+        elapsed = now - self._stats_start
+        count = self._stats_count
+
+        res = {
+            "mode" : "stream" if self.streaming else "oneshot",
+            "frames" : count,
+            "fps" : round(count / elapsed, 2) if elapsed > 0 else 0.0,
+            "latency_avg_ms" : round(self._stats_latency_sum / count * 1000, 1) if count > 0 else 0.0,
+            "latency_max_ms" : round(self._stats_latency_max * 1000, 1)
+        }
+
+        self._stats_start = now
+        self._stats_count = 0
+        self._stats_latency_sum = 0.0
+        self._stats_latency_max = 0.0
+
+        return res
+
+    def close(self):
+        """
+        ストリーミングの子プロセスを停止します
+        """
+        proc = self._proc
+        self._proc = None
+
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def _ensure_stream(self):
+        """
+        ストリーミングの子プロセスが動作していなければ起動します
+        """
+        if self._proc is not None and self._proc.poll() is None:
+            return
+
+        now = time.monotonic()
+        if now < self._next_start_time:
+            return
+        self._next_start_time = now + self.RESTART_INTERVAL_SEC
+
+        if self._proc is not None:
+            print(f"Frame stream exited (exit code {self._proc.returncode})")
+            self._proc = None
+
+        try:
+            self._proc = subprocess.Popen(
+                shlex.split(self.stream_command),
+                stdout=subprocess.PIPE
+            )
+        except OSError as e:
+            print(f"Could not start frame stream: {e}")
+            return
+
+        self._reader_alive = True
+        threading.Thread(target=self._read_loop, args=(self._proc,), daemon=True).start()
+        print(f"Frame stream started: {self.stream_command}")
+
+    def _read_stream(self, timeout : float) -> bytes:
+        """
+        ストリーミングで受信した最新フレームを取得します
+
+        Returns:
+            bytes : カメラフレーム画像(JPEG)、タイムアウトまたは停止した場合はNone
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._frame_seq != self._read_seq or not self.streaming,
+                timeout=timeout)
+
+            if self._frame_seq == self._read_seq:
+                return None
+
+            self._read_seq = self._frame_seq
+            return self._frame
+
+    def _read_loop(self, proc : subprocess.Popen):
+        """
+        子プロセスの標準出力を読み込み、フレームに分割するスレッド関数
+        複数のフレームが溜まっていた場合は最新のものだけが残ります
+
+        Args:
+            proc (Popen) : ストリーミングの子プロセス
+        """
+        split = self._split_length if self.stream_format == "length" else self._split_mjpeg
+        buf = bytearray()
+
+        try:
+            while True:
+                chunk = proc.stdout.read1(65536)
+                if not chunk:
+                    break
+
+                buf += chunk
+
+                for frame in split(buf):
+                    with self._cond:
+                        self._frame = frame
+                        self._frame_seq += 1
+                        self._cond.notify_all()
+
+        except Exception as e:
+            print(f"Frame stream error: {e}")
+
+        finally:
+            with self._cond:
+                # 子プロセスが再起動された後に終了した古いスレッドは、新しいストリームの状態を変えない
+                if proc is self._proc:
+                    self._reader_alive = False
+                self._cond.notify_all()
+
+    def _split_mjpeg(self, buf : bytearray) -> list:
+        """
+        連結されたJPEGデータをSOI/EOIマーカーで分割します
+        分割したデータはbufから取り除かれます
+
+        Args:
+            buf (bytearray) : 受信データ
+
+        Returns:
+            list : 完成したJPEGフレームのリスト
+        """
+        frames = []
+
+        while True:
+            start = buf.find(self.SOI)
+            if start < 0:
+                # 次のチャンクとマーカーがまたがる可能性があるので最後の1バイトは残す
+                del buf[:-1]
+                break
+
+            end = buf.find(self.EOI, start + 2)
+            if end < 0:
+                del buf[:start]
+                break
+
+            frames.append(bytes(buf[start:end + 2]))
+            del buf[:end + 2]
+
+        return frames
+
+    def _split_length(self, buf : bytearray) -> list:
+        """
+        データ長付きのJPEGデータを分割します
+        分割したデータはbufから取り除かれます
+
+        Args:
+            buf (bytearray) : 受信データ
+
+        Returns:
+            list : 完成したJPEGフレームのリスト
+        """
+        frames = []
+
+        while len(buf) >= 4:
+            length = int.from_bytes(buf[:4], "big")
+            if len(buf) < 4 + length:
+                break
+
+            frames.append(bytes(buf[4:4 + length]))
+            del buf[:4 + length]
+
+        return frames
+
 
 def push(timestamp: int, image: bytes, result: dict):
     """
@@ -92,23 +576,45 @@ def push(timestamp: int, image: bytes, result: dict):
     Returns:
         なし
     """
+    payload = encode_result(result)
+
     #
     # aicap pushコマンド
     # -i を　"-"　で指定すると、標準入力(stdin)から画像データを受け取る
     cmd = [
         "aicap", "push",
-        "-t", str(timestamp),
-        "-i", "-",         # -i - で stdin から画像を受け取る
-        "-J", json.dumps(result)
+        "-t", str(timestamp)
     ]
 
+    # 結果情報を一時ファイルで渡す場合のパス
+    temp_path = None
+
     try:
+        if PUSH_PAYLOAD_TRANSPORT == "file":
+            with tempfile.NamedTemporaryFile("w", prefix="aicap-push-", suffix=".json", delete=False) as f:
+                temp_path = f.name
+                f.write(payload)
+            cmd += ["-i", "-", PUSH_JSON_FILE_OPTION, temp_path]
+            stdin = image
+
+        elif PUSH_PAYLOAD_TRANSPORT == "stdin":
+            with tempfile.NamedTemporaryFile("wb", prefix="aicap-push-", suffix=".jpg", delete=False) as f:
+                temp_path = f.name
+                f.write(image)
+            cmd += ["-i", temp_path, PUSH_JSON_FILE_OPTION, "-"]
+            stdin = payload.encode()
+
+        else:
+            cmd += ["-i", "-", "-J", payload] # -i - で stdin から画像を受け取る
+            stdin = image
+
         result = subprocess.run(
             cmd,
             check=True,
-            input=image, # 画像バイナリを stdin に渡す
+            input=stdin, # 画像バイナリ(または結果情報)を stdin に渡す
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            timeout=PUSH_TIMEOUT_SEC
         )
     
     except subprocess.CalledProcessError as e:
@@ -116,143 +622,2310 @@ def push(timestamp: int, image: bytes, result: dict):
             f"Command failed (exit code {e.returncode}): "
             f"{e.stderr.decode(errors='ignore')}"
         ) from e
-    
 
-def create_result_jpeg(img : Image, result : list) -> bytes:
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"Command timed out ({PUSH_TIMEOUT_SEC} sec)") from e
+
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+
+def encode_result(result) -> str:
     """
-    parse_results関数で成形された検出物体のBOXを画像に書き込みます
-    
+    Push通知の結果情報をJSONに変換します
+    空白を除いた形式にし、小数を丸めて(PUSH_FLOAT_DIGITS)、必要ならキーを短縮します(PUSH_SHORT_KEYS)
+
     Args:
-        img (Image)   : カメラフレーム画像のPIL Image
-        result (list) : parse_results関数で成形された結果リスト
+        result : 結果情報
 
     Returns:
-        bytes : BOXを書き込んだJPEG画像
+        str : JSON
+    """
+    def compact(obj):
+        if isinstance(obj, dict):
+            return {(PUSH_SHORT_KEY_MAP.get(k, k) if PUSH_SHORT_KEYS else k) : compact(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [compact(v) for v in obj]
+        if isinstance(obj, float) and PUSH_FLOAT_DIGITS >= 0:
+            return round(obj, PUSH_FLOAT_DIGITS)
+        return obj
+
+    return json.dumps(compact(result), separators=(",", ":"))
+
+
+class PushQueue:
+    """
+    Push通知を非同期で送信するキュー
+
+    put()で積まれた通知は、ワーカースレッドがpush()で順番に送信します
+    失敗した場合は待ち時間を倍にしながらリトライし、
+    キューが満杯の場合はdrop_policyに従って通知を破棄します
     """
 
-    draw = ImageDraw.Draw(img)
+    def __init__(self, maxsize : int, drop_policy : str = "oldest",
+                 retry_count : int = 3, retry_interval : float = 1.0, retry_interval_max : float = 30.0):
+        """
+        Args:
+            maxsize (int)              : キューの最大数
+            drop_policy (str)          : 満杯時の破棄方針("oldest" または "newest")
+            retry_count (int)          : 失敗時のリトライ回数
+            retry_interval (float)     : 最初のリトライまでの待ち時間(秒)
+            retry_interval_max (float) : リトライまでの待ち時間の上限(秒)
+        """
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.retry_count = retry_count
+        self.retry_interval = retry_interval
+        self.retry_interval_max = retry_interval_max
 
-    for r in result:
+        self._queue = deque()
+        self._cond = threading.Condition()
 
-        cr = (255, 0, 0)
+        # queued : キューに積んだ数
+        # sent   : 送信に成功した数
+        # dropped: キューが満杯で破棄した数
+        # failed : リトライしても送信できなかった数
+        self._counters = {"queued" : 0, "sent" : 0, "dropped" : 0, "failed" : 0}
 
-        x1 = r["box"]["x1"]
-        y1 = r["box"]["y1"]
-        x2 = r["box"]["x2"]
-        y2 = r["box"]["y2"]
+        threading.Thread(target=self._worker, daemon=True).start()
 
-        draw.rectangle((x1, y1, x2, y2), fill=None, outline=cr, width=5)
+    def put(self, timestamp : int, image : bytes, result) -> bool:
+        """
+        Push通知をキューに積みます
+        呼び出し元は送信の完了を待ちません
 
-    dst = BytesIO()
-    img.save(dst, format='JPEG', quality=75)
-    dst.seek(0)
+        Args:
+            timestamp (int) : 時間(Unixtime)
+            image (bytes)   : 画像
+            result          : 結果情報(呼び出し後に変更されても影響しないようコピーされます)
 
-    return dst.getvalue()
+        Returns:
+            bool : キューに積めた場合はTrue、破棄した場合はFalse
+        """
+        item = (timestamp, image, copy.deepcopy(result))
 
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self._counters["dropped"] += 1
+                if self.drop_policy == "newest":
+                    return False
+                self._queue.popleft()
 
-def parse_results(results : list) -> list:
+            self._queue.append(item)
+            self._counters["queued"] += 1
+            self._cond.notify()
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        送信状況のカウンターを返します
+
+        Returns:
+            dict : queued, sent, dropped, failed と pending(送信待ちの数)
+        """
+        with self._cond:
+            return dict(self._counters, pending=len(self._queue))
+
+    def _worker(self):
+        """
+        キューから取り出した通知を送信するスレッド関数
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._queue) > 0)
+                timestamp, image, result = self._queue.popleft()
+
+            for attempt in range(self.retry_count + 1):
+                try:
+                    with metrics.measure("push"):
+                        push(timestamp, image, result)
+                    counter = "sent"
+                    break
+
+                except Exception as e:
+                    print(f"Push failed ({attempt + 1}/{self.retry_count + 1}): {e}")
+                    counter = "failed"
+
+                    if attempt < self.retry_count:
+                        time.sleep(min(self.retry_interval * (2 ** attempt), self.retry_interval_max))
+
+            with self._cond:
+                self._counters[counter] += 1
+
+            if counter == "failed":
+                metrics.inc("errors")
+
+
+class PreviewServer:
     """
-    yolo predictの結果を以下の形に成形します
+    プレビュー画像をメモリ上に保持し、HTTPで配信します
 
-    {
-        "pos"  : {"x" : x, "y" : y}, <= 検出物体中心座標
-        "box"  : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}, <= BOX座標
-        "conf" : 検出信頼度[confidence score](0.0 ~ 1.0),
-        "cls"  : 検出クラス
-    }
-    
-    Args:
-        results (list) : predictの結果リスト
+    /stream.mjpg : multipart/x-mixed-replace形式のMJPEGストリーム(新しい画像が届くたびに送信)
+    /result.jpg  : 最新の画像1枚(ETagに対応し、変化がなければ304 Not Modifiedを返す)
+    /metrics     : 処理時間と件数(Prometheusのテキスト形式)
+    """
 
-    Returns:
-        list : 成形した結果のリスト
+    # MJPEGストリームの区切り文字列
+    BOUNDARY = "aicapframe"
+
+    def __init__(self, port : int):
+        """
+        Args:
+            port (int) : 待ち受けるポート番号
+        """
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
+
+        # 再起動前のETagと重複しないよう、起動時間をETagに含める
+        self._etag_prefix = str(int(time.time()))
+
+        self._server = ThreadingHTTPServer(("", port), PreviewRequestHandler)
+        self._server.daemon_threads = True
+        self._server.preview = self
+
+    def start(self):
+        """
+        配信を開始します
+        """
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Preview server started on port {self._server.server_address[1]}")
+
+    def update(self, frame : bytes):
+        """
+        配信する画像を更新します
+
+        Args:
+            frame (bytes) : プレビュー画像(JPEG)
+        """
+        with self._cond:
+            self._frame = frame
+            self._seq += 1
+            self._cond.notify_all()
+
+    def latest(self) -> tuple:
+        """
+        最新の画像を取得します
+
+        Returns:
+            tuple : (プレビュー画像(JPEG), ETag)、画像がまだない場合は(None, None)
+        """
+        with self._cond:
+            if self._frame is None:
+                return None, None
+            return self._frame, f'"{self._etag_prefix}-{self._seq}"'
+
+    def wait(self, seq : int, timeout : float) -> tuple:
+        """
+        seqより新しい画像が届くまで待ちます
+
+        Args:
+            seq (int)       : 前回取得した画像の通番
+            timeout (float) : 待つ最大時間(秒)
+
+        Returns:
+            tuple : (プレビュー画像(JPEG), 通番)、タイムアウトした場合は(None, seq)
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq != seq and self._frame is not None, timeout=timeout):
+                return None, seq
+            return self._frame, self._seq
+
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    """
+    PreviewServerのリクエストハンドラ
     """
 
-    res = []
+    def do_GET(self):
+        path = self.path.split("?")[0]
 
-    for box in reversed(results[0].boxes):
+        if path == "/stream.mjpg":
+            self._send_stream()
+        elif path == "/result.jpg":
+            self._send_frame()
+        elif path == "/metrics":
+            self._send_metrics()
+        else:
+            self.send_error(404)
 
-        cls = box.cls.tolist()
-        conf = box.conf.tolist()
-        r = box.xyxy.tolist()
+    def _send_frame(self):
+        """
+        最新の画像を1枚返します
+        """
+        frame, etag = self.server.preview.latest()
 
-        x1 = int(r[0][0])
-        y1 = int(r[0][1])
-        x2 = int(r[0][2])
-        y2 = int(r[0][3])
+        if frame is None:
+            self.send_error(503)
+            return
 
-        pos_x = int(x1 + (x2 - x1) / 2)
-        pos_y = int(y1 + (y2 - y1) / 2)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
 
-        res.append({
-                "pos" : {"x" : pos_x, "y" : pos_y}, 
-                "box" : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}, 
-                "conf" : conf[0],
-                "cls" : int(cls[0])
-            })
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(frame)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(frame)
 
-    return res    
+    def _send_metrics(self):
+        """
+        計測値をPrometheusのテキスト形式で返します
+        """
+        body = metrics.prometheus().encode()
 
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-def main():
+    def _send_stream(self):
+        """
+        新しい画像が届くたびにMJPEGストリームとして送信し続けます
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={PreviewServer.BOUNDARY}")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
 
-    frame_w = 0
-    frame_h = 0
+        seq = 0
 
-    while True:
+        try:
+            while True:
+                frame, seq = self.server.preview.wait(seq, timeout=30)
+                if frame is None:
+                    continue
+
+                self.wfile.write(
+                    f"--{PreviewServer.BOUNDARY}\r\n"
+                    f"Content-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(frame)}\r\n\r\n".encode())
+                self.wfile.write(frame)
+                self.wfile.write(b"\r\n")
+                self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが切断した
+            pass
+
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+class RuntimeConfig:
+    """
+    設定ファイル(JSON)を監視し、変更されたら読み込み直して設定値(このファイルの定数)に反映します
+
+    設定ファイルに書かれていない設定値は定数の初期値に戻し、環境変数で指定された設定値は常に環境変数の値を使います
+    読み込みはメインループ(推論の合間)で行い、すべての設定値を確認してから一度に反映するので、
+    フレームの処理中に設定値が変わったり、一部の設定値だけが反映されたりすることはありません
+    設定ファイルに誤りがある場合は、それまでの設定値のまま処理を続けます
+    """
+
+    # 設定ファイルで変更できる設定値と型
+    KEYS = {
+        "MODEL_FILE_NAME" : str,
+        "CONF" : (int, float),
+        "IOU" : (int, float),
+        "CLASSES" : list,
+    }
+
+    def __init__(self, path : str, interval_sec : float):
+        """
+        Args:
+            path (str)           : 設定ファイルのパス
+            interval_sec (float) : 変更を確認する間隔(秒)
+        """
+        self.path = path
+        self.interval_sec = interval_sec
+
+        # 定数の初期値
+        self._defaults = {k : globals()[k] for k in self.KEYS}
+
+        # 環境変数で指定された設定値
+        self._env = {k : self._convert(k, os.environ[k], from_env=True) for k in self.KEYS if k in os.environ}
+
+        # 最後に読み込んだ設定ファイルの更新時間とサイズ、確認した時間
+        self._stamp = None
+        self._checked = 0.0
+
+    def load(self):
+        """
+        設定ファイルを読み込んで反映します(起動時)
+        誤りがある場合は例外を送出します
+        """
+        self._checked = time.monotonic()
+        self._stamp = self._file_stamp()
+        self._apply(self._read())
+
+    def check(self) -> bool:
+        """
+        前回の確認からCONFIG_CHECK_INTERVAL_SEC以上経過していれば、設定ファイルが変更されたかどうかを確認し、
+        変更されていれば読み込み直して反映します
+
+        Returns:
+            bool : 設定値が変わった場合はTrue
+        """
+        now = time.monotonic()
+        if now - self._checked < self.interval_sec:
+            return False
+        self._checked = now
+
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
 
         try:
-            # ビデオ映像取得
-            frame = get_frame()
-            timestamp = int(datetime.now(tz=timezone.utc).timestamp())
-
-            # PLI Imageに変換
-            img = Image.open(BytesIO(frame))
-
-            # 画像サイズが変わったらモデルの最初期化を行う
-            if img.width != frame_w or img.height != frame_h:
-                model = YOLO(model=MODEL_FILE_PATH)
-                frame_w = img.width
-                frame_h = img.height
-
-            # 物体検知実行
-            results = model.predict(
-                img, 
-                conf=CONF, 
-                iou=IOU, 
-                classes=CLASSES, 
-                verbose=True)
-
-            # 結果を整形
-            res = parse_results(results)
-
-            # 物体を検知したか？
-            if len(res) > 0:
-                
-                # 検知枠を書き込んだJPEG画像の生成
-                frame = create_result_jpeg(img, res)
-
-                # PUSH通知
-                # エラーはここでキャッチしてそのまま処理を流す
-                try:
-                    push(timestamp, frame, res)
-                except Exception as e:
-                    print(str(e))    
-            
+            values = self._read()
+        except Exception as e:
+            print(f"Config not reloaded, keeping the current settings: {self.path}: {e}")
+            return False
 
-            # 結果確認用のプレビューイメージの保存
-            with open(PREVIEW_IMAGE_PATH, 'wb') as f:
-                f.write(frame)
+        print(f"Config reloaded: {self.path}")
+        return self._apply(values)
+
+    def _file_stamp(self) -> tuple:
+        """
+        設定ファイルの更新時間とサイズを返します(ファイルがない場合はNone)
+        """
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _read(self) -> dict:
+        """
+        定数の初期値、設定ファイル、環境変数の順に重ねた設定値を返します
+
+        Returns:
+            dict : 設定値
+        """
+        values = dict(self._defaults)
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("the config file must be a JSON object")
+
+            for k, v in data.items():
+                if k not in self.KEYS:
+                    raise ValueError(f"unknown setting: {k}")
+                if k in self._env:
+                    print(f"Config: {k} is set by the environment variable, ignoring the config file")
+                    continue
+                values[k] = self._convert(k, v)
+
+        values.update(self._env)
+
+        return values
+
+    def _convert(self, key : str, value, from_env : bool = False):
+        """
+        設定値の型を確認します
+        環境変数の値(文字列)は、文字列の設定値以外はJSONとして解釈します
+
+        Args:
+            key (str)       : 設定値の名前
+            value           : 値
+            from_env (bool) : 環境変数の値かどうか
+
+        Returns:
+            確認した値
+        """
+        types = self.KEYS[key] if isinstance(self.KEYS[key], tuple) else (self.KEYS[key],)
+
+        if from_env and str not in types:
+            value = json.loads(value)
+        if bool in types and value in (0, 1):
+            value = bool(value)
+
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ValueError(f"invalid value for {key}: {value!r}")
+        if isinstance(value, list) and not all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+            raise ValueError(f"invalid value for {key}: {value!r}")
+
+        return value
+
+    def _apply(self, values : dict) -> bool:
+        """
+        変わった設定値を反映し、ログに出力します
+
+        Args:
+            values (dict) : 設定値
+
+        Returns:
+            bool : 設定値が変わった場合はTrue
+        """
+        module = globals()
+        changed = {k : v for k, v in values.items() if module[k] != v}
+
+        for k, v in changed.items():
+            print(f"Config: {k} = {v!r} (was {module[k]!r})")
+
+        module.update(changed)
+
+        # モデルはパスが変わった場合だけ、次の推論で読み込む
+        if "MODEL_FILE_NAME" in changed:
+            module["MODEL_FILE_PATH"] = os.path.join(os.path.dirname(__file__), MODEL_FILE_NAME)
+
+        return len(changed) > 0
+
+
+class ModelManager:
+    """
+    読み込み済みのYOLOモデルを (モデルのパス, タスク) ごとに保持します
+
+    初めて使うモデルは読み込んだ直後にダミー画像で推論(ウォームアップ)してから返すので、
+    実際のフレームで初回推論の遅延が発生しません
+    推論する画像はモデルの入力サイズにレターボックス処理されるので、
+    フレームの画像サイズが切り替わっても、一度読み込んだモデルはそのまま再利用されます
+    """
+
+    def __init__(self, max_models : int = 2, input_size : int = 640):
+        """
+        Args:
+            max_models (int) : 保持するモデルの最大数(超えた場合は最も長く使われていないものを破棄)
+            input_size (int) : モデルの入力画像サイズ(ウォームアップに使うダミー画像の大きさ)
+        """
+        self.max_models = max_models
+        self.input_size = input_size
+        self._models = OrderedDict()
+
+        # 最初のモデルのウォームアップが完了したらセットされる
+        self.ready = threading.Event()
+
+    def get(self, model_path : str, task : str = "detect") -> YOLO:
+        """
+        モデルを取得します
+        保持していない場合は読み込んでウォームアップします
+
+        Args:
+            model_path (str) : モデルファイルのパス
+            task (str)       : タスク("detect"など)
+
+        Returns:
+            YOLO : ウォームアップ済みのモデル
+        """
+        key = (model_path, task)
+
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+
+        start = time.monotonic()
+
+        model = YOLO(model=model_path, task=task)
+
+        # ダミー画像で推論してウォームアップ
+        model.predict(Image.new("RGB", (self.input_size, self.input_size)), verbose=False)
+
+        print(f"Model loaded: {model_path} ({time.monotonic() - start:.1f} sec)")
+
+        self._models[key] = model
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+
+        if not self.ready.is_set():
+            self.ready.set()
+            print("Model ready")
+
+        return model
+
+
+class LatestSlot:
+    """
+    値を1つだけ保持するスレッド間の受け渡し場所
+
+    取り出される前に新しい値がput()された場合、古い値は破棄されます(最新の値が優先)
+    ただし、保持している値よりpriorityが低い値は破棄する側になります
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._priority = 0
+        self._has_item = False
+
+        # 取り出される前に破棄された値の数
+        self.dropped = 0
+
+    def put(self, item, priority : int = 0) -> bool:
+        """
+        値を置きます
+
+        Args:
+            item           : 受け渡す値
+            priority (int) : 優先度(保持中の値より低い場合は置かずに破棄する)
+
+        Returns:
+            bool : 置けた場合はTrue
+        """
+        with self._cond:
+            if self._has_item:
+                self.dropped += 1
+                if priority < self._priority:
+                    return False
+
+            self._item = item
+            self._priority = priority
+            self._has_item = True
+            self._cond.notify_all()
+
+        return True
+
+    def get(self, timeout : float = None):
+        """
+        値を取り出します
+        値が置かれていない場合は、置かれるまで待ちます
+
+        Args:
+            timeout (float) : 待つ最大時間(秒)、Noneの場合は無制限
+
+        Returns:
+            取り出した値、タイムアウトした場合はNone
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._has_item, timeout=timeout):
+                return None
+
+            item = self._item
+            self._item = None
+            self._priority = 0
+            self._has_item = False
+
+            return item
+
+
+class Stage:
+    """
+    パイプラインの処理段
+    busy()で囲んだ処理の時間を積算して、稼働率(occupancy)を計算します
+    直近の処理時間も保持して、パーセンタイルを返します
+    """
+
+    def __init__(self, name : str, samples : int = STAGE_LATENCY_SAMPLES):
+        """
+        Args:
+            name (str)    : 処理段の名前
+            samples (int) : パーセンタイルの計算に使う直近の処理時間のサンプル数
+        """
+        self.name = name
+        self.count = 0
+        self._lock = threading.Lock()
+        self._busy_sec = 0.0
+        self._start = time.monotonic()
+        self._samples = deque(maxlen=samples)
+
+    @contextmanager
+    def busy(self):
+        """
+        処理時間を計測するコンテキストマネージャ
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._busy_sec += elapsed
+                self._samples.append(elapsed)
+                self.count += 1
+
+    def occupancy(self) -> float:
+        """
+        前回の呼び出しから今回までの稼働率を返します
+
+        Returns:
+            float : 稼働率(0.0 ~ 1.0)
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._start
+            res = self._busy_sec / elapsed if elapsed > 0 else 0.0
+            self._busy_sec = 0.0
+            self._start = now
+
+        return round(min(res, 1.0), 3)
+
+    def latency(self) -> dict:
+        """
+        直近の処理時間のパーセンタイルを返します
+
+        Returns:
+            dict : p50/p90/p99/max(ミリ秒)
+        """
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64) * 1000.0
+
+        if len(samples) == 0:
+            return {"p50" : 0.0, "p90" : 0.0, "p99" : 0.0, "max" : 0.0}
+
+        p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+        return {
+            "p50" : round(float(p50), 1),
+            "p90" : round(float(p90), 1),
+            "p99" : round(float(p99), 1),
+            "max" : round(float(samples.max()), 1)
+        }
+
+
+class Metrics:
+    """
+    処理段ごとの処理時間と、フレーム数などの件数を計測します
+
+    処理時間は直近のサンプルからパーセンタイル(quantile)を計算し、合計と回数は起動時からの累計を返します
+    Prometheusのテキスト形式(summaryとcounter)で出力できます
+    """
+
+    # 計測する処理段
+    STAGES = ("acquire", "decode", "inference", "parse", "draw", "encode", "push", "preview", "sleep")
+
+    # 数える件数
+    COUNTERS = ("frames", "detections", "skipped", "errors")
+
+    # 出力するパーセンタイル
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, samples : int = STAGE_LATENCY_SAMPLES):
+        """
+        Args:
+            samples (int) : パーセンタイルの計算に使う直近の処理時間のサンプル数
+        """
+        self._lock = threading.Lock()
+        self._samples = {s : deque(maxlen=samples) for s in self.STAGES}
+        self._sum = {s : 0.0 for s in self.STAGES}
+        self._count = {s : 0 for s in self.STAGES}
+        self._counters = {c : 0 for c in self.COUNTERS}
+
+    @contextmanager
+    def measure(self, stage : str):
+        """
+        処理時間を計測するコンテキストマネージャ
+
+        Args:
+            stage (str) : 処理段の名前(STAGESのいずれか)
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def observe(self, stage : str, sec : float):
+        """
+        処理時間を記録します
+
+        Args:
+            stage (str) : 処理段の名前(STAGESのいずれか)
+            sec (float) : 処理時間(秒)
+        """
+        with self._lock:
+            self._samples[stage].append(sec)
+            self._sum[stage] += sec
+            self._count[stage] += 1
+
+    def inc(self, name : str, value : int = 1):
+        """
+        件数を加算します
+
+        Args:
+            name (str)  : 件数の名前(COUNTERSのいずれか)
+            value (int) : 加算する数
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def prometheus(self) -> str:
+        """
+        計測値をPrometheusのテキスト形式で返します
+
+        Returns:
+            str : Prometheusのテキスト形式
+        """
+        with self._lock:
+            samples = {s : np.array(self._samples[s], dtype=np.float64) for s in self.STAGES}
+            sums = dict(self._sum)
+            counts = dict(self._count)
+            counters = dict(self._counters)
+
+        lines = [
+            "# HELP aicap_stage_seconds Processing time of each stage (quantiles over recent samples).",
+            "# TYPE aicap_stage_seconds summary"
+        ]
+        for stage in self.STAGES:
+            values = np.quantile(samples[stage], self.QUANTILES) if len(samples[stage]) > 0 else [float("nan")] * len(self.QUANTILES)
+            for q, v in zip(self.QUANTILES, values):
+                lines.append(f'aicap_stage_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'aicap_stage_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'aicap_stage_seconds_count{{stage="{stage}"}} {counts[stage]}')
+
+        for name in self.COUNTERS:
+            lines.append(f"# TYPE aicap_{name}_total counter")
+            lines.append(f"aicap_{name}_total {counters[name]}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path : str):
+        """
+        計測値をPrometheusのテキスト形式でファイルに書き出します
+        一時ファイルに書いてから置き換えるので、読み込む側が書きかけのファイルを読むことはありません
+
+        Args:
+            path (str) : 書き出すファイルのパス
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+# 処理時間と件数の計測
+# 各スレッドから記録するので、モジュールで1つだけ作成する
+metrics = Metrics()
+
+
+class FrameScheduler:
+    """
+    フレームレートを制御します
+
+    物体を検出している間はactive_fpsで、検出がない状態がidle_after_sec続いたらidle_fpsで動作します
+    アイドル中に物体を検出した場合は、待ちを打ち切ってすぐにactive_fpsに戻ります
+    1フレームの処理にかかった時間を差し引いた残りの時間だけ待つので、処理時間に関係なく目標のフレームレートになります
+    """
+
+    def __init__(self, active_fps : float, idle_fps : float, idle_after_sec : float):
+        """
+        Args:
+            active_fps (float)     : 物体を検出している間のフレームレート
+            idle_fps (float)       : 物体を検出していない間のフレームレート
+            idle_after_sec (float) : 検出がなくなってからアイドルに切り替えるまでの時間(秒)
+        """
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.idle_after_sec = idle_after_sec
+
+        self._last_active = time.monotonic()
+        self._wake = threading.Event()
+
+    @property
+    def idle(self) -> bool:
+        """
+        アイドル中かどうか
+        """
+        return time.monotonic() - self._last_active >= self.idle_after_sec
+
+    def interval(self) -> float:
+        """
+        現在のフレーム間隔を返します
+
+        Returns:
+            float : フレーム間隔(秒)
+        """
+        return 1.0 / (self.idle_fps if self.idle else self.active_fps)
+
+    def set_active(self, active : bool):
+        """
+        物体を検出しているかどうかを通知します
+
+        Args:
+            active (bool) : 物体を検出している場合はTrue
+        """
+        if not active:
+            return
+
+        was_idle = self.idle
+        self._last_active = time.monotonic()
+
+        # アイドル中の待ちを打ち切る
+        if was_idle:
+            self._wake.set()
+
+    def wait(self, start : float):
+        """
+        startから現在のフレーム間隔が経過するまで待ちます
+
+        Args:
+            start (float) : 処理を開始した時間(time.monotonic())
+        """
+        while True:
+            remaining = start + self.interval() - time.monotonic()
+            if remaining <= 0:
+                return
+
+            if self._wake.wait(remaining):
+                self._wake.clear()
+
+    def stats(self) -> dict:
+        """
+        現在の動作状態を返します
+
+        Returns:
+            dict : mode("active" または "idle"), fps(目標フレームレート)
+        """
+        idle = self.idle
+        return {"mode" : "idle" if idle else "active", "fps" : self.idle_fps if idle else self.active_fps}
+
+
+class Backoff:
+    """
+    エラーが続いた場合の待ち時間を、最小値から倍々で最大値まで延ばします
+    """
+
+    def __init__(self, min_sec : float, max_sec : float):
+        """
+        Args:
+            min_sec (float) : 最初のエラーでの待ち時間(秒)
+            max_sec (float) : 待ち時間の上限(秒)
+        """
+        self.min_sec = min_sec
+        self.max_sec = max_sec
+        self._count = 0
+
+    def failed(self) -> float:
+        """
+        エラーを記録し、次に待つ時間を返します
+
+        Returns:
+            float : 待ち時間(秒)
+        """
+        wait = min(self.min_sec * (2 ** self._count), self.max_sec)
+        self._count = min(self._count + 1, 16)
+        return wait
+
+    def reset(self):
+        """
+        成功したので待ち時間を最小値に戻します
+        """
+        self._count = 0
+
+
+class Pipeline:
+    """
+    フレーム取得 / 推論 / 結果の公開 を並行して行うパイプライン
+
+    capture スレッド : FrameSourceからフレームを取得して入力スロットに置く
+    推論(呼び出し元) : next_frame()で最新のフレームを取り出して推論し、結果をpublish()に渡す
+    publish スレッド : publish()に渡された結果をpublish_funcで処理する(描画、JPEG生成、Push通知、プレビュー保存)
+
+    フレームN+1の取得と、フレームN-1の公開が、フレームNの推論と並行して行われます
+    各スロットは1つしか値を持たないので、推論は常に最新のフレームで行われます
+    """
+
+    def __init__(self, source : FrameSource, publish_func, scheduler : FrameScheduler, on_frame = None):
+        """
+        Args:
+            source (FrameSource)       : フレームの取得元
+            publish_func               : 推論結果を受け取って公開する関数
+            scheduler (FrameScheduler) : フレーム取得のタイミングを決めるスケジューラ
+            on_frame                   : 新しいフレームを取得するたびに呼ばれる関数(省略可)
+        """
+        self.source = source
+        self.publish_func = publish_func
+        self.scheduler = scheduler
+        self.on_frame = on_frame
+
+        self.capture_stage = Stage("capture")
+        self.inference_stage = Stage("inference")
+        self.publish_stage = Stage("publish")
+
+        self._frames = LatestSlot()
+        self._results = LatestSlot()
+
+    def start(self):
+        """
+        取得スレッドと公開スレッドを開始します
+        """
+        threading.Thread(target=self._capture_loop, daemon=True).start()
+        threading.Thread(target=self._publish_loop, daemon=True).start()
+
+    def next_frame(self, timeout : float = None) -> tuple:
+        """
+        最新のフレームを取り出します
+        新しいフレームが取得されるまで待ちます
+
+        Args:
+            timeout (float) : 待つ最大時間(秒)、Noneの場合は無制限
+
+        Returns:
+            tuple : (カメラフレーム画像(JPEG), 取得時間(Unixtime))、タイムアウトした場合はNone
+        """
+        return self._frames.get(timeout)
+
+    def publish(self, item, priority : int = 0):
+        """
+        推論結果を公開スレッドに渡します
+
+        Args:
+            item           : publish_funcに渡す値
+            priority (int) : 優先度(Push通知を伴う結果は、伴わない結果で上書きされないよう高くする)
+        """
+        self._results.put(item, priority)
+
+    def stats(self) -> dict:
+        """
+        各処理段の稼働率と処理時間、破棄されたフレーム数を返します
+
+        Returns:
+            dict : 推論したフレーム数(frames)、稼働率(occupancy)、処理時間(latency_ms)と破棄数(dropped)
+        """
+        stages = (self.capture_stage, self.inference_stage, self.publish_stage)
+        return {
+            "frames" : self.inference_stage.count,
+            "occupancy" : {s.name : s.occupancy() for s in stages},
+            "latency_ms" : {s.name : s.latency() for s in stages},
+            "dropped" : {"capture" : self._frames.dropped, "publish" : self._results.dropped}
+        }
+
+    def _capture_loop(self):
+        """
+        フレームを取得し続けるスレッド関数
+        """
+        backoff = Backoff(ERROR_RETRY_INTERVAL_SEC, ERROR_RETRY_INTERVAL_MAX_SEC)
+
+        while True:
+            start = time.monotonic()
+
+            try:
+                with self.capture_stage.busy(), metrics.measure("acquire"):
+                    frame = self.source.read()
+                timestamp = int(datetime.now(tz=timezone.utc).timestamp())
+
+                self._frames.put((frame, timestamp))
+                backoff.reset()
+
+                if self.on_frame is not None:
+                    self.on_frame()
+
+            except Exception as e:
+                print(str(e))
+                metrics.inc("errors")
+                time.sleep(backoff.failed())
+
+            # フレームレート制御
+            # 処理にかかった時間を差し引いた残りの時間だけ待つ
+            with metrics.measure("sleep"):
+                self.scheduler.wait(start)
+
+    def _publish_loop(self):
+        """
+        推論結果を公開し続けるスレッド関数
+        """
+        while True:
+            item = self._results.get()
+
+            try:
+                with self.publish_stage.busy():
+                    self.publish_func(item)
+
+            except Exception as e:
+                print(str(e))
+                metrics.inc("errors")
+
+
+class FrameCollector:
+    """
+    複数のカメラのパイプラインから、新しいフレームをまとめて取り出します
+    各パイプラインのon_frameにnotify()を設定して使います
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def notify(self):
+        """
+        新しいフレームが取得されたことを通知します
+        """
+        self._event.set()
+
+    def collect(self, cameras : list) -> list:
+        """
+        いずれかのカメラで新しいフレームが取得されるまで待ち、
+        その時点で取得済みの各カメラの最新フレームをすべて取り出します
+
+        Args:
+            cameras (list) : Cameraのリスト
+
+        Returns:
+            list : (Camera, カメラフレーム画像(JPEG), 取得時間(Unixtime)) のリスト
+        """
+        while True:
+            self._event.wait()
+            self._event.clear()
+
+            batch = []
+            for camera in cameras:
+                item = camera.pipeline.next_frame(timeout=0)
+                if item is not None:
+                    batch.append((camera, *item))
+
+            if len(batch) > 0:
+                return batch
+
+
+class BatchPredictor:
+    """
+    複数の画像を1回のpredictでまとめて推論します
+
+    バッチ推論に対応していないモデル(NCNNなど、先頭の画像の結果しか返らない)の場合は、
+    最初の推論で検出して、以降は1枚ずつ推論します
+    """
+
+    def __init__(self):
+        self.batched = True
+
+    def predict(self, model : YOLO, imgs : list, **kwargs) -> list:
+        """
+        画像のリストを推論します
+
+        Args:
+            model (YOLO)  : モデル
+            imgs (list)   : PIL Imageのリスト
+            **kwargs      : predictの引数
+
+        Returns:
+            list : imgsと同じ順番の推論結果のリスト
+        """
+        if self.batched and len(imgs) > 1:
+            results = model.predict(imgs, **kwargs)
+            if len(results) == len(imgs):
+                return results
+
+            self.batched = False
+            print("Batched inference is not supported by this model, predicting one image at a time")
+
+        results = []
+        for img in imgs:
+            results += model.predict(img, **kwargs)
+
+        return results
+
+
+class DetectionBatch:
+    """
+    1フレーム分の検出結果をNumPy配列でまとめて保持します
+
+    YOLOの結果からBOXごとにtolist()で取り出す代わりに、全BOXを一度に配列として取り出します
+    Push通知などで従来の形式が必要な場合は to_list() で変換します
+    """
+
+    __slots__ = ("xyxy", "pos", "conf", "cls", "id")
+
+    def __init__(self, xyxy : np.ndarray, conf : np.ndarray, cls : np.ndarray, id : np.ndarray = None):
+        """
+        Args:
+            xyxy (ndarray) : BOX座標 (N, 4) [x1, y1, x2, y2]
+            conf (ndarray) : 検出信頼度 (N,)
+            cls (ndarray)  : 検出クラス (N,)
+            id (ndarray)   : トラッキングID (N,)、トラッキングしていない場合はNone
+        """
+        self.xyxy = xyxy.astype(int)
+        self.conf = conf
+        self.cls = cls.astype(int)
+        self.id = id.astype(int) if id is not None else None
+
+        # 検出物体の中心座標 (N, 2) [x, y]
+        self.pos = (self.xyxy[:, :2] + (self.xyxy[:, 2:] - self.xyxy[:, :2]) / 2).astype(int)
+
+    @classmethod
+    def from_results(cls, results : list, scale : tuple = (1.0, 1.0)) -> "DetectionBatch":
+        """
+        predict / trackの結果から生成します
+        並び順はparse_resultsの従来の処理に合わせて逆順にします
+
+        Args:
+            results (list) : predict / trackの結果リスト
+            scale (tuple)  : BOX座標に掛ける倍率(横, 縦)、縮小デコードした画像の座標を元の解像度に戻す
+
+        Returns:
+            DetectionBatch : 検出結果
+        """
+        boxes = results[0].boxes
+
+        return cls(
+            boxes.xyxy.cpu().numpy()[::-1] * np.array([scale[0], scale[1], scale[0], scale[1]]),
+            boxes.conf.cpu().numpy()[::-1],
+            boxes.cls.cpu().numpy()[::-1],
+            boxes.id.cpu().numpy()[::-1] if boxes.id is not None else None)
+
+    @classmethod
+    def empty(cls) -> "DetectionBatch":
+        """
+        検出なしの結果を生成します
+
+        Returns:
+            DetectionBatch : 空の検出結果
+        """
+        return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0))
+
+    def __len__(self) -> int:
+        return len(self.xyxy)
+
+    def to_list(self) -> list:
+        """
+        以下の形の辞書のリストに変換します
+
+        {
+            "pos"  : {"x" : x, "y" : y}, <= 検出物体中心座標
+            "box"  : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}, <= BOX座標
+            "conf" : 検出信頼度[confidence score](0.0 ~ 1.0),
+            "cls"  : 検出クラス
+        }
+
+        Returns:
+            list : 変換した結果のリスト
+        """
+        return [
+            {
+                "pos" : {"x" : x, "y" : y},
+                "box" : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2},
+                "conf" : conf,
+                "cls" : cls
+            }
+            for (x, y), (x1, y1, x2, y2), conf, cls
+            in zip(self.pos.tolist(), self.xyxy.tolist(), self.conf.tolist(), self.cls.tolist())
+        ]
+
+
+class MotionGate:
+    """
+    シーンに変化がないフレームの推論を省略するための判定を行います
+
+    次の場合は変化なしと判断します(最後に推論したフレームと比較)
+    - JPEGのデータのハッシュが同じ
+    - 縮小したグレースケール画像で、輝度がpixel_threshold以上変化した画素の割合がarea_threshold未満
+    ただし、最後に推論してからforce_interval_sec以上経過した場合は、変化がなくても推論します
+    """
+
+    # 比較に使う縮小画像の幅(高さは縦横比から決める)
+    WIDTH = 160
+
+    def __init__(self, pixel_threshold : int, area_threshold : float, force_interval_sec : float):
+        """
+        Args:
+            pixel_threshold (int)      : 変化したとみなす輝度の差(0 ~ 255)
+            area_threshold (float)     : 変化ありと判断する、変化した画素の割合(0.0 ~ 1.0)
+            force_interval_sec (float) : 変化がなくても推論する間隔(秒)
+        """
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.force_interval_sec = force_interval_sec
+
+        # 最後に推論したフレームの情報
+        self._digest = None
+        self._gray = None
+        self._last_run = 0.0
+
+        # 統計情報
+        self._counters = {"frames" : 0, "skipped_hash" : 0, "skipped_motion" : 0}
+
+    def check(self, frame : bytes, img : Image) -> bool:
+        """
+        推論が必要かどうかを判定します
+        推論が必要と判定したフレームは、次回以降の比較対象になります
+
+        Args:
+            frame (bytes) : カメラフレーム画像(JPEG)
+            img (Image)   : frameをデコードしたPIL Image
+
+        Returns:
+            bool : 推論が必要な場合はTrue
+        """
+        self._counters["frames"] += 1
+
+        now = time.monotonic()
+        forced = now - self._last_run >= self.force_interval_sec
+
+        # 全く同じフレーム
+        digest = hashlib.blake2b(frame, digest_size=16).digest()
+        if not forced and digest == self._digest:
+            self._counters["skipped_hash"] += 1
+            return False
+
+        # 縮小したグレースケール画像で差分を比較
+        size = (self.WIDTH, max(1, round(self.WIDTH * img.height / img.width)))
+        gray = np.asarray(img.convert("L").resize(size, Image.BOX), dtype=np.int16)
+
+        if not forced and self._gray is not None and self._gray.shape == gray.shape:
+            changed = np.count_nonzero(np.abs(gray - self._gray) >= self.pixel_threshold)
+            if changed < gray.size * self.area_threshold:
+                self._counters["skipped_motion"] += 1
+                return False
+
+        self._digest = digest
+        self._gray = gray
+        self._last_run = now
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までの、推論を省略した割合を返します
+
+        Returns:
+            dict : frames(判定したフレーム数), skipped_hash / skipped_motion(理由ごとの省略数), skip_ratio(省略した割合)
+        """
+        res = dict(self._counters)
+        skipped = res["skipped_hash"] + res["skipped_motion"]
+        res["skip_ratio"] = round(skipped / res["frames"], 3) if res["frames"] > 0 else 0.0
+
+        self._counters = {"frames" : 0, "skipped_hash" : 0, "skipped_motion" : 0}
+
+        return res
+
+
+def points_in_polygon(points : np.ndarray, polygon : np.ndarray) -> np.ndarray:
+    """
+    点が多角形の内側にあるかどうかを判定します(レイキャスティング法)
+
+    Args:
+        points (ndarray)  : 点の座標 (N, 2)
+        polygon (ndarray) : 多角形の頂点の座標 (M, 2)
+
+    Returns:
+        ndarray : 内側にある場合はTrue (N,)
+    """
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+    # 点から右に伸ばした半直線と交差する辺の数が奇数なら内側
+    crosses = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / np.where(y2 == y1, 1e-12, y2 - y1) + x1)
+
+    return np.count_nonzero(crosses, axis=1) % 2 == 1
+
+
+def nms_boxes(xyxy : np.ndarray, conf : np.ndarray, cls : np.ndarray, iou : float) -> np.ndarray:
+    """
+    クラスごとにNMS(Non-Maximum Suppression)を行い、残すBOXのインデックスを返します
+    ROIやタイルの重なった部分で、同じ物体が重複して検出された場合に使います
+
+    Args:
+        xyxy (ndarray) : BOX座標 (N, 4)
+        conf (ndarray) : 検出信頼度 (N,)
+        cls (ndarray)  : 検出クラス (N,)
+        iou (float)    : 重複とみなすIoUのしきい値
+
+    Returns:
+        ndarray : 残すBOXのインデックス(信頼度の高い順)
+    """
+    if len(xyxy) == 0:
+        return np.zeros(0, dtype=int)
+
+    # クラスごとに座標をずらして、違うクラスのBOX同士が重ならないようにする
+    boxes = xyxy + (cls * (xyxy.max() + 1))[:, None]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    order = conf.argsort()[::-1]
+    keep = []
+
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        ious = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-12)
+
+        order = rest[ious <= iou]
+
+    return np.array(keep, dtype=int)
+
+
+class RoiCropper:
+    """
+    ROI(多角形)を囲む矩形を切り出して推論するための画像を作り、検出結果をフレーム全体の座標に戻します
+
+    フレーム全体をモデルの入力サイズに縮小すると遠くの小さな物体が検出できなくなるので、
+    必要な部分だけを切り出して推論します
+    tiledを指定した場合は、ROIを囲む矩形をモデルの入力サイズのタイルに(重なりを持たせて)分割し、
+    縮小せずに推論します
+    """
+
+    def __init__(self, rois : list, tiled : bool, tile_size : int, overlap : float):
+        """
+        Args:
+            rois (list)     : ROIの多角形のリスト(座標はフレームの幅と高さに対する割合)
+            tiled (bool)    : タイルに分割して推論するかどうか
+            tile_size (int) : タイルの大きさ(モデルの入力サイズ)
+            overlap (float) : タイルの重なり(タイルの大きさに対する割合)
+        """
+        self.rois = []
+        for roi in rois:
+            polygon = np.array(roi, dtype=np.float64)
+            if polygon.ndim != 2 or polygon.shape[0] < 3 or polygon.shape[1] != 2:
+                raise ValueError(f"ROI must be a list of 3 or more [x, y] points: {roi}")
+            if polygon.min() < 0.0 or polygon.max() > 1.0:
+                raise ValueError(f"ROI coordinates must be between 0.0 and 1.0: {roi}")
+            self.rois.append(polygon)
+
+        if tiled and tile_size <= 0:
+            raise ValueError("MODEL_INPUT_SIZE must be specified for tiled inference")
+
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    def decode_size(self) -> int:
+        """
+        フレームをデコードする際の長辺の最小サイズ(decode_frameのmin_size)を返します
+        切り出した矩形が、モデルの入力サイズを下回らない程度に縮小します
+
+        Returns:
+            int : 長辺の最小サイズ(0の場合は縮小しない)
+        """
+        if self.tiled:
+            return 0
+
+        ratio = max(max(p.max(axis=0) - p.min(axis=0)) for p in self.rois)
+        return math.ceil(self.tile_size / max(ratio, 1e-3))
+
+    def crop(self, img : Image) -> list:
+        """
+        推論する領域を切り出します
+
+        Args:
+            img (Image) : フレーム画像
+
+        Returns:
+            list : (切り出した画像, 切り出した位置(x, y)) のリスト
+        """
+        res = []
+        for x1, y1, x2, y2 in self._regions(img.width, img.height):
+            res.append((img.crop((x1, y1, x2, y2)), (x1, y1)))
+
+        return res
+
+    def merge(self, img : Image, crops : list, results : list, iou : float) -> Results:
+        """
+        切り出した領域ごとの推論結果を、フレーム全体の座標の1つの結果にまとめます
+        中心がROIの外にある物体は除き、重なった部分で重複した物体はNMSで1つにします
+
+        Args:
+            img (Image)     : フレーム画像
+            crops (list)    : crop()の結果
+            results (list)  : cropsと同じ順番の推論結果
+            iou (float)     : 重複とみなすIoUのしきい値
+
+        Returns:
+            Results : フレーム全体の座標の推論結果
+        """
+        data = []
+        for (_, (x, y)), result in zip(crops, results):
+            boxes = result.boxes.data.cpu().numpy()
+            if len(boxes) > 0:
+                boxes = boxes[:, :6].copy()
+                boxes[:, [0, 2]] += x
+                boxes[:, [1, 3]] += y
+                data.append(boxes)
+
+        data = np.concatenate(data) if len(data) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+        # 中心がいずれかのROIの中にある物体だけを残す
+        if len(data) > 0:
+            centers = (data[:, :2] + data[:, 2:4]) / 2
+            size = np.array([img.width, img.height])
+            inside = np.zeros(len(data), dtype=bool)
+            for polygon in self.rois:
+                inside |= points_in_polygon(centers, polygon * size)
+            data = data[inside]
+
+        # 重なった領域で重複して検出された物体を1つにする
+        data = data[nms_boxes(data[:, :4], data[:, 4], data[:, 5], iou)]
+
+        # BGRの画像(ultralyticsがPIL Imageを推論する場合と同じ形式)
+        orig_img = np.ascontiguousarray(np.asarray(img.convert("RGB"))[:, :, ::-1])
+
+        return Results(orig_img, path="", names=results[0].names, boxes=torch.as_tensor(data))
+
+    def _regions(self, width : int, height : int) -> list:
+        """
+        切り出す矩形を返します
+
+        Args:
+            width (int)  : フレームの幅
+            height (int) : フレームの高さ
+
+        Returns:
+            list : (x1, y1, x2, y2) のリスト
+        """
+        regions = []
+        for polygon in self.rois:
+            x1, y1 = np.floor(polygon.min(axis=0) * (width, height)).astype(int).tolist()
+            x2, y2 = np.ceil(polygon.max(axis=0) * (width, height)).astype(int).tolist()
+
+            if not self.tiled:
+                regions.append((x1, y1, max(x2, x1 + 1), max(y2, y1 + 1)))
+                continue
+
+            for ty in self._tile_starts(y1, y2):
+                for tx in self._tile_starts(x1, x2):
+                    regions.append((tx, ty, min(tx + self.tile_size, x2), min(ty + self.tile_size, y2)))
+
+        return regions
+
+    def _tile_starts(self, start : int, end : int) -> list:
+        """
+        1辺をタイルに分割した際の、各タイルの開始位置を返します
+        最後のタイルは終端に合わせます
+
+        Args:
+            start (int) : 開始位置
+            end (int)   : 終了位置
+
+        Returns:
+            list : 各タイルの開始位置
+        """
+        if end - start <= self.tile_size:
+            return [start]
+
+        stride = max(1, int(self.tile_size * (1.0 - self.overlap)))
+        starts = list(range(start, end - self.tile_size, stride))
+        starts.append(end - self.tile_size)
+
+        return starts
+
+
+def decode_frame(frame : bytes, min_size : int) -> tuple:
+    """
+    カメラフレーム画像(JPEG)をデコードします
+    min_sizeが指定されている場合は、長辺がmin_sizeを下回らない範囲で
+    JPEGのDCTスケーリング(1/2, 1/4, 1/8)を使って縮小しながらデコードします
+
+    Args:
+        frame (bytes)  : カメラフレーム画像(JPEG)
+        min_size (int) : デコード後の長辺の最小サイズ(0の場合は縮小しない)
+
+    Returns:
+        tuple : (PIL Image, 元の解像度に戻すための倍率(横, 縦))
+    """
+    img = Image.open(BytesIO(frame))
+    w, h = img.size
+
+    if min_size > 0 and max(w, h) > min_size:
+        r = min_size / max(w, h)
+        img.draft("RGB", (math.ceil(w * r), math.ceil(h * r)))
+
+    return img, (w / img.width, h / img.height)
+
+
+def decode_frames(frames : list, min_sizes : list, pool : "WorkerPool" = None) -> list:
+    """
+    カメラフレーム画像(JPEG)をモデルの入力サイズに合わせてデコードし、画素を読み込みます
+
+    Args:
+        frames (list)     : カメラフレーム画像(JPEG)のリスト
+        min_sizes (list)  : フレームごとのdecode_frameのmin_size
+        pool (WorkerPool) : デコードを行うワーカープロセス(Noneの場合はこのプロセスでデコードする)
+
+    Returns:
+        list : (PIL Image, 元の解像度に戻すための倍率(横, 縦)) のリスト
+    """
+    if pool is not None:
+        return pool.decode(frames, min_sizes)
+
+    res = []
+    for frame, min_size in zip(frames, min_sizes):
+        # デコードは画素を参照したときに行われるので、ここで読み込む
+        img, scale = decode_frame(frame, min_size)
+        img.load()
+        res.append((img, scale))
+
+    return res
+
+
+def create_result_jpeg(img : Image, result : DetectionBatch, scale : tuple = (1.0, 1.0)) -> bytes:
+    """
+    parse_results関数で成形された検出物体のBOXを画像に書き込みます
+    
+    Args:
+        img (Image)             : カメラフレーム画像のPIL Image
+        result (DetectionBatch) : parse_results関数で成形された結果
+        scale (tuple)           : imgに対する元の解像度の倍率(横, 縦)
+
+    Returns:
+        bytes : BOXを書き込んだJPEG画像
+    """
+
+    with metrics.measure("draw"):
+        draw = ImageDraw.Draw(img)
+        line_width = max(1, round(5 / scale[0]))
+
+        for x1, y1, x2, y2 in result.xyxy.tolist():
+
+            cr = (255, 0, 0)
+
+            draw.rectangle((x1 / scale[0], y1 / scale[1], x2 / scale[0], y2 / scale[1]), fill=None, outline=cr, width=line_width)
+
+    with metrics.measure("encode"):
+        dst = BytesIO()
+        img.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def create_push_image(frame : bytes, annotated : bytes, boxes : list) -> bytes:
+    """
+    PUSH_IMAGE_MODEに従って、Push通知する画像を生成します
+
+    Args:
+        frame (bytes)     : カメラフレーム画像(JPEG、元の解像度)
+        annotated (bytes) : 検知枠を描画したJPEG画像
+        boxes (list)      : 切り出すBOX座標 (x1, y1, x2, y2) のリスト(元の解像度)
+
+    Returns:
+        bytes : Push通知するJPEG画像
+    """
+    if PUSH_IMAGE_MODE == "thumbnail":
+        return create_thumbnail_jpeg(annotated, PUSH_THUMBNAIL_SIZE)
+
+    if PUSH_IMAGE_MODE == "crops" and len(boxes) > 0:
+        return create_crops_jpeg(frame, boxes[:PUSH_CROP_COUNT], PUSH_CROP_HEIGHT, PUSH_CROP_MARGIN)
+
+    return annotated
+
+
+def create_thumbnail_jpeg(jpeg : bytes, size : int) -> bytes:
+    """
+    JPEG画像を長辺がsize以下になるよう縮小します
+
+    Args:
+        jpeg (bytes) : JPEG画像
+        size (int)   : 長辺のサイズ
+
+    Returns:
+        bytes : 縮小したJPEG画像(縮小する必要がない場合はそのまま)
+    """
+    img = Image.open(BytesIO(jpeg))
+    if max(img.size) <= size:
+        return jpeg
+
+    img.draft("RGB", (size, size))
+    img.thumbnail((size, size), Image.BILINEAR)
+
+    dst = BytesIO()
+    img.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def create_crops_jpeg(jpeg : bytes, boxes : list, height : int, margin : float) -> bytes:
+    """
+    BOXの部分だけを切り出し、高さをそろえて横に並べた1枚のJPEG画像を生成します
+
+    Args:
+        jpeg (bytes)   : カメラフレーム画像(JPEG、元の解像度)
+        boxes (list)   : BOX座標 (x1, y1, x2, y2) のリスト(元の解像度)
+        height (int)   : 切り出した画像の高さ
+        margin (float) : BOXの周囲に含める余白(BOXの大きさに対する割合)
+
+    Returns:
+        bytes : 切り出した画像を並べたJPEG画像
+    """
+    img = Image.open(BytesIO(jpeg))
+
+    crops = []
+    for x1, y1, x2, y2 in boxes:
+        mx = (x2 - x1) * margin
+        my = (y2 - y1) * margin
+        box = (max(0, math.floor(x1 - mx)), max(0, math.floor(y1 - my)),
+               min(img.width, math.ceil(x2 + mx)), min(img.height, math.ceil(y2 + my)))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+
+        crop = img.crop(box)
+        crops.append(crop.resize((max(1, round(crop.width * height / crop.height)), height), Image.BILINEAR))
+
+    sheet = Image.new("RGB", (max(1, sum(c.width for c in crops)), height))
+    x = 0
+    for crop in crops:
+        sheet.paste(crop, (x, 0))
+        x += crop.width
+
+    dst = BytesIO()
+    sheet.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def parse_results(results : list, scale : tuple = (1.0, 1.0)) -> DetectionBatch:
+    """
+    yolo predictの結果をDetectionBatchに成形します
+    BOX座標、信頼度、クラスはBOXごとではなく、全BOX分を一度に配列として取り出します
+    Push通知用の形式には DetectionBatch.to_list() で変換します
+
+    Args:
+        results (list) : predictの結果リスト
+        scale (tuple)  : BOX座標を元の解像度に戻すための倍率(横, 縦)
+
+    Returns:
+        DetectionBatch : 成形した結果(BOX座標は元の解像度)
+    """
+
+    return DetectionBatch.from_results(results, scale)
+
+
+class SharedSlots:
+    """
+    ワーカープロセスとの画像データの受け渡しに使う共有メモリを使い回します
+    空いている共有メモリが足りない場合は、新しく作成します
+    """
+
+    # 共有メモリを確保する単位(バイト)
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = []
+        self._all = []
+
+    def acquire(self, size : int) -> SharedMemory:
+        """
+        size以上の大きさの共有メモリを取得します
+
+        Args:
+            size (int) : 必要な大きさ(バイト)
+
+        Returns:
+            SharedMemory : 共有メモリ(使い終わったらrelease()で返す)
+        """
+        size = max(1, math.ceil(size / self.BLOCK_SIZE)) * self.BLOCK_SIZE
+
+        with self._lock:
+            for i, shm in enumerate(self._free):
+                if shm.size >= size:
+                    return self._free.pop(i)
+
+            # 空いているものが小さすぎる場合は、作り直す
+            if len(self._free) > 0:
+                self._discard(self._free.pop())
+
+            shm = SharedMemory(create=True, size=size)
+            self._all.append(shm)
+
+            return shm
+
+    def release(self, shm : SharedMemory):
+        """
+        共有メモリを返します
+
+        Args:
+            shm (SharedMemory) : acquire()で取得した共有メモリ
+        """
+        with self._lock:
+            self._free.append(shm)
+
+    def close(self):
+        """
+        すべての共有メモリを破棄します
+        """
+        with self._lock:
+            for shm in list(self._all):
+                self._discard(shm)
+            self._free.clear()
+
+    def _discard(self, shm : SharedMemory):
+        """
+        共有メモリを破棄します(ロックを取得した状態で呼ぶ)
+        """
+        self._all.remove(shm)
+        shm.close()
+        shm.unlink()
+
+
+# ワーカープロセスで開いた共有メモリ(名前 → SharedMemory)
+_worker_shms = {}
+
+# ワーカープロセスで開いたままにしておく共有メモリの最大数
+_WORKER_SHM_CACHE_SIZE = 32
+
+
+def _worker_init():
+    """
+    ワーカープロセスの初期化
+    Ctrl+Cはメインプロセスで処理するので、ワーカープロセスでは無視する
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _worker_buffer(name : str) -> memoryview:
+    """
+    ワーカープロセスで共有メモリを開きます(開いたものは使い回す)
+
+    Args:
+        name (str) : 共有メモリの名前
+
+    Returns:
+        memoryview : 共有メモリのバッファ
+    """
+    shm = _worker_shms.get(name)
+    if shm is None:
+        # 作り直されて使われなくなったものが溜まらないよう、上限を超えたら全部閉じる
+        if len(_worker_shms) >= _WORKER_SHM_CACHE_SIZE:
+            for s in _worker_shms.values():
+                s.close()
+            _worker_shms.clear()
+
+        shm = SharedMemory(name=name)
+        _worker_shms[name] = shm
+
+    return shm.buf
+
+
+def _decode_task(src : str, length : int, dst : str, min_size : int) -> tuple:
+    """
+    ワーカープロセスでJPEGをデコードし、RGBの画素データを共有メモリに書き込みます
+
+    Args:
+        src (str)      : JPEGが書き込まれた共有メモリの名前
+        length (int)   : JPEGの長さ(バイト)
+        dst (str)      : 画素データを書き込む共有メモリの名前
+        min_size (int) : decode_frameのmin_size
+
+    Returns:
+        tuple : (画像サイズ, 倍率)
+    """
+    img, scale = decode_frame(bytes(_worker_buffer(src)[:length]), min_size)
+    data = img.convert("RGB").tobytes()
+    _worker_buffer(dst)[:len(data)] = data
+
+    return img.size, scale
+
+
+def _annotate_task(src : str, length : int, size : tuple, dst : str, args : tuple) -> int:
+    """
+    ワーカープロセスで枠を描画してJPEGにエンコードし、共有メモリに書き込みます
+
+    Args:
+        src (str)     : 画像が書き込まれた共有メモリの名前
+        length (int)  : 画像データの長さ(バイト)
+        size (tuple)  : RGBの画素データの場合は画像サイズ、JPEGの場合はNone
+        dst (str)     : JPEGを書き込む共有メモリの名前
+        args (tuple)  : create_result_jpegの画像以外の引数
+
+    Returns:
+        int : JPEGの長さ(バイト)
+    """
+    data = bytes(_worker_buffer(src)[:length])
+    img = Image.open(BytesIO(data)) if size is None else Image.frombytes("RGB", size, data)
+
+    jpeg = create_result_jpeg(img, *args)
+
+    buf = _worker_buffer(dst)
+    if len(jpeg) > len(buf):
+        raise RuntimeError(f"Encoded image is too large ({len(jpeg)} bytes)")
+    buf[:len(jpeg)] = jpeg
+
+    return len(jpeg)
+
+
+class WorkerPool:
+    """
+    JPEGのデコードと、枠の描画 + JPEGエンコードを別プロセスで行います
+
+    推論と同じプロセスで行うとGILを取り合うため、検知物体が多く描画に時間がかかるシーンで推論が遅れます
+    画像データはpickleせず、共有メモリ(SharedMemory)で受け渡します
+    ワーカープロセスが異常終了した場合は、以降は同じプロセス内で処理します
+    """
+
+    def __init__(self, processes : int):
+        """
+        スレッドのロックの状態などを引き継がないよう、スレッドを開始する前に呼び出してください
+
+        Args:
+            processes (int) : ワーカープロセスの数
+        """
+        # 共有メモリを管理するresource_trackerをforkの前に起動して、ワーカープロセスと共有する
+        # (ワーカープロセスが別々に起動すると、ワーカープロセスの終了時に共有メモリが破棄されてしまう)
+        resource_tracker.ensure_running()
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_worker_init)
+        self._slots = SharedSlots()
+
+        # 最初の呼び出しでワーカープロセスがすべて起動するので、ここで起動しておく
+        self._executor.submit(int).result()
+
+        print(f"Worker pool started: {processes} processes")
+
+    def decode(self, frames : list, min_sizes : list) -> list:
+        """
+        カメラフレーム画像(JPEG)をまとめてデコードします
+        (decode_frameでデコードして、画素を読み込んだものと同じ結果になります)
+
+        Args:
+            frames (list)    : カメラフレーム画像(JPEG)のリスト
+            min_sizes (list) : フレームごとのdecode_frameのmin_size
+
+        Returns:
+            list : (PIL Image, 元の解像度に戻すための倍率(横, 縦)) のリスト
+        """
+        if self._executor is None:
+            return [self._decode_local(frame, min_size) for frame, min_size in zip(frames, min_sizes)]
+
+        slots = []
+        try:
+            tasks = []
+            for frame, min_size in zip(frames, min_sizes):
+                # ヘッダだけ読んで、デコード後のサイズを求める
+                img, _ = decode_frame(frame, min_size)
+
+                src = self._slots.acquire(len(frame))
+                slots.append(src)
+                dst = self._slots.acquire(img.width * img.height * 3)
+                slots.append(dst)
+
+                src.buf[:len(frame)] = frame
+                tasks.append((dst, self._executor.submit(_decode_task, src.name, len(frame), dst.name, min_size)))
+
+            res = []
+            for dst, future in tasks:
+                size, scale = future.result()
+                res.append((Image.frombytes("RGB", size, dst.buf[:size[0] * size[1] * 3]), scale))
+
+            return res
+
+        except BrokenProcessPool:
+            self._broken()
+            return [self._decode_local(frame, min_size) for frame, min_size in zip(frames, min_sizes)]
+
+        finally:
+            for shm in slots:
+                self._slots.release(shm)
+
+    def annotate(self, src, *args) -> bytes:
+        """
+        画像に枠を描画してJPEGにエンコードします
+        (create_result_jpegと同じ結果になります)
+
+        Args:
+            src   : PIL Image またはカメラフレーム画像(JPEG)
+            *args : create_result_jpegの画像以外の引数
+
+        Returns:
+            bytes : 枠を描画したJPEG画像
+        """
+        if self._executor is None:
+            return self._annotate_local(src, *args)
+
+        if isinstance(src, Image.Image):
+            data = src.convert("RGB").tobytes()
+            size = src.size
+        else:
+            data = src
+            size = None
+
+        w, h = src.size if size is not None else Image.open(BytesIO(src)).size
+
+        slots = []
+        try:
+            src_shm = self._slots.acquire(len(data))
+            slots.append(src_shm)
+            # JPEGは画素データより大きくなることはないので、画素データの大きさ + ヘッダ分を確保する
+            dst_shm = self._slots.acquire(w * h * 3 + 65536)
+            slots.append(dst_shm)
+
+            src_shm.buf[:len(data)] = data
+            length = self._executor.submit(_annotate_task, src_shm.name, len(data), size, dst_shm.name, args).result()
+
+            return bytes(dst_shm.buf[:length])
+
+        except BrokenProcessPool:
+            self._broken()
+            return self._annotate_local(src, *args)
+
+        finally:
+            for shm in slots:
+                self._slots.release(shm)
+
+    def close(self):
+        """
+        ワーカープロセスを終了し、共有メモリを破棄します
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._slots.close()
+
+    def _broken(self):
+        """
+        ワーカープロセスが異常終了したので、以降は同じプロセス内で処理します
+        """
+        if self._executor is not None:
+            print("Worker pool is broken, decoding and encoding in the main process")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _decode_local(self, frame : bytes, min_size : int) -> tuple:
+        img, scale = decode_frame(frame, min_size)
+        img.load()
+        return img, scale
+
+    def _annotate_local(self, src, *args) -> bytes:
+        img = src if isinstance(src, Image.Image) else Image.open(BytesIO(src))
+        return create_result_jpeg(img, *args)
+
+
+def publish(item : tuple, camera : "Camera"):
+    """
+    推論結果を公開します
+    (Pipelineの公開スレッドから呼ばれます)
+
+    Args:
+        item (tuple)    : (時間(Unixtime), カメラフレーム画像(JPEG), PIL Image, decode_frameの倍率, parse_resultsの結果(DetectionBatch))
+        camera (Camera) : 推論結果を公開するカメラ(Push通知の送信キュー、プレビューの保存先)
+
+    Returns:
+        なし
+    """
+    timestamp, frame, img, scale, res = item
+
+    # 物体を検知したか？
+    if len(res) > 0:
+
+        # 元の解像度の画像に検知枠を描画するかどうか
+        # サムネイルや切り出した画像をPush通知する場合は、推論に使った縮小画像に描画してプレビューに使う
+        full = PUSH_IMAGE_MODE not in ("thumbnail", "crops")
+        src = frame
+
+        if camera.pool is not None:
+            # 元の解像度でのデコード、検知枠の描画、JPEGエンコードはワーカープロセスで行う
+            with metrics.measure("encode"):
+                frame = camera.pool.annotate(frame, res) if full else camera.pool.annotate(img, res, scale)
+
+        else:
+            # 推論に縮小した画像を使った場合は、元の解像度でデコードし直す
+            if full and scale != (1.0, 1.0):
+                with metrics.measure("decode"):
+                    img = Image.open(BytesIO(frame))
+                    img.load()
+                scale = (1.0, 1.0)
+
+            # 検知枠を書き込んだJPEG画像の生成
+            frame = create_result_jpeg(img, res, scale)
+
+        # Push通知する画像
+        with metrics.measure("encode"):
+            image = create_push_image(src, frame, res.xyxy.tolist())
+
+        # 複数のカメラを処理している場合は、どのカメラの結果かを含める
+        result = res.to_list()
+        if camera.tagged:
+            for r in result:
+                r["camera"] = camera.name
+
+        # PUSH通知
+        # 送信はワーカースレッドで行うので、ここでは待たない
+        camera.push_queue.put(timestamp, image, result)
+
+    # 結果確認用のプレビューイメージの保存
+    # HTTP配信が有効な場合は、ファイルには書き込まずメモリ上の画像を配信する
+    with metrics.measure("preview"):
+        if camera.preview is not None:
+            camera.preview.update(frame)
+        else:
+            with open(camera.preview_image_path, 'wb') as f:
+                f.write(frame)
+
+
+class Camera:
+    """
+    1台のカメラの処理に必要なもの(フレームの取得元、パイプライン、Push通知の送信キュー、プレビュー)と、
+    カメラごとの推論結果を保持します
+    """
+
+    def __init__(self, name : str, stream_command : str, stream_format : str,
+                 preview_image_path : str, preview_http_port : int, on_frame = None, tagged : bool = False,
+                 pool : WorkerPool = None, rois : list = None):
+        """
+        Args:
+            name (str)               : カメラの名前
+            stream_command (str)     : ストリーミングコマンド(空の場合は aicap get_frame)
+            stream_format (str)      : ストリーミングコマンドの出力形式
+            preview_image_path (str) : プレビュー画像の保存パス
+            preview_http_port (int)  : プレビュー画像をHTTPで配信するポート番号(0の場合は配信しない)
+            on_frame                 : 新しいフレームを取得するたびに呼ばれる関数
+            tagged (bool)            : Push通知の結果情報にカメラの名前を含めるかどうか
+            pool (WorkerPool)        : 描画とJPEGエンコードを行うワーカープロセス(使わない場合はNone)
+            rois (list)              : 推論する領域(ROI)の多角形のリスト(空の場合はフレーム全体)
+        """
+        self.name = name
+        self.tagged = tagged
+        self.preview_image_path = preview_image_path
+        self.pool = pool
+
+        # 推論する領域の切り出し(ROIを指定しない場合はNone)
+        self.roi = RoiCropper(rois, ROI_TILED, MODEL_INPUT_SIZE, ROI_TILE_OVERLAP) if rois else None
+
+        # フレームをデコードする際の長辺の最小サイズ
+        self.decode_size = self.roi.decode_size() if self.roi is not None else MODEL_INPUT_SIZE
+
+        # 推論を省略するかどうかの判定
+        self.gate = MotionGate(MOTION_PIXEL_THRESHOLD, MOTION_AREA_THRESHOLD, MOTION_FORCE_INTERVAL_SEC)
+
+        # カメラフレームの取得元
+        self.source = FrameSource(stream_command, stream_format)
+
+        # Push通知の送信キュー
+        self.push_queue = PushQueue(
+            PUSH_QUEUE_SIZE,
+            drop_policy=PUSH_DROP_POLICY,
+            retry_count=PUSH_RETRY_COUNT,
+            retry_interval=PUSH_RETRY_INTERVAL_SEC,
+            retry_interval_max=PUSH_RETRY_INTERVAL_MAX_SEC)
+
+        # プレビューのHTTP配信
+        self.preview = PreviewServer(preview_http_port) if preview_http_port > 0 else None
+
+        # フレームレートの制御
+        self.scheduler = FrameScheduler(TARGET_FPS, IDLE_FPS, IDLE_AFTER_SEC)
+
+        # 取得 / 推論 / 公開 のパイプライン
+        self.pipeline = Pipeline(
+            self.source,
+            lambda item: publish(item, self),
+            self.scheduler,
+            on_frame)
+
+        # 推論結果(推論を省略したフレームでは前回の結果を使う)
+        self.res = DetectionBatch.empty()
+
+    def start(self):
+        """
+        プレビューの配信とパイプラインを開始します
+        """
+        if self.preview is not None:
+            self.preview.start()
+        self.pipeline.start()
+
+    def close(self):
+        """
+        フレームの取得を終了します
+        """
+        self.source.close()
+
+    def print_stats(self):
+        """
+        統計情報を出力します
+        """
+        suffix = f" ({self.name})" if self.tagged else ""
+        print(f"frame source{suffix}: {json.dumps(self.source.stats())}")
+        print(f"push queue{suffix}: {json.dumps(self.push_queue.stats())}")
+        print(f"pipeline{suffix}: {json.dumps(self.pipeline.stats())}")
+        print(f"motion gate{suffix}: {json.dumps(self.gate.stats())}")
+        print(f"scheduler{suffix}: {json.dumps(self.scheduler.stats())}")
+
+
+def create_cameras(config : str, on_frame = None, pool : WorkerPool = None) -> list:
+    """
+    カメラの設定からCameraのリストを作成します
+
+    Args:
+        config (str)      : カメラの設定(JSON配列)、空の場合は従来通りの1台
+        on_frame          : 新しいフレームを取得するたびに呼ばれる関数
+        pool (WorkerPool) : 描画とJPEGエンコードを行うワーカープロセス(使わない場合はNone)
+
+    Returns:
+        list : Cameraのリスト
+    """
+    rois = json.loads(ROIS) if ROIS else []
+
+    if not config:
+        return [Camera("default", FRAME_STREAM_COMMAND, FRAME_STREAM_FORMAT, PREVIEW_IMAGE_PATH, PREVIEW_HTTP_PORT, on_frame,
+                       pool=pool, rois=rois)]
+
+    base, ext = os.path.splitext(PREVIEW_IMAGE_PATH)
+
+    cameras = []
+    for i, c in enumerate(json.loads(config)):
+        name = str(c.get("name", f"camera{i + 1}"))
+        if any(camera.name == name for camera in cameras):
+            raise ValueError(f"Duplicate camera name: {name}")
+
+        cameras.append(Camera(
+            name,
+            c.get("stream_command", FRAME_STREAM_COMMAND),
+            c.get("stream_format", FRAME_STREAM_FORMAT),
+            c.get("preview_image_path", f"{base}_{name}{ext}"),
+            int(c.get("preview_http_port", 0)),
+            on_frame,
+            tagged=True,
+            pool=pool,
+            rois=c.get("rois", rois)))
+
+    return cameras
+
+
+def main():
+
+    # 設定ファイル
+    # 定数の代わりに設定値を指定でき、実行中の変更もメインループで反映する
+    config = RuntimeConfig(CONFIG_FILE_PATH, CONFIG_CHECK_INTERVAL_SEC)
+    config.load()
+    if not MODEL_FILE_NAME:
+        raise ValueError("MODEL_FILE_NAME is not set (environment variable or config file)")
+
+    # 結果情報をファイルや標準入力で渡す場合は、aicapのオプションが必要
+    # (Push通知のたびに失敗しないよう、起動時に確認する)
+    if PUSH_PAYLOAD_TRANSPORT not in ("arg", "file", "stdin"):
+        raise ValueError(f"invalid PUSH_PAYLOAD_TRANSPORT: {PUSH_PAYLOAD_TRANSPORT}")
+    if PUSH_PAYLOAD_TRANSPORT != "arg" and not PUSH_JSON_FILE_OPTION:
+        raise ValueError(f"PUSH_JSON_FILE_OPTION must be set when PUSH_PAYLOAD_TRANSPORT is {PUSH_PAYLOAD_TRANSPORT}")
+
+    # 読み込んだモデルの管理
+    # 複数のカメラを処理する場合も、モデルは1つだけ読み込む
+    models = ModelManager(MODEL_CACHE_SIZE, MODEL_INPUT_SIZE)
+
+    # 複数の画像をまとめて推論
+    predictor = BatchPredictor()
+
+    # 各カメラの新しいフレームをまとめて取り出す
+    collector = FrameCollector()
+
+    # デコードと描画 + JPEGエンコードを行うワーカープロセス
+    # プロセスはforkで起動するので、スレッドを開始する(カメラを作成する)前に起動しておく
+    pool = WorkerPool(WORKER_PROCESSES) if WORKER_PROCESSES > 0 else None
+
+    # カメラごとの取得元、パイプライン、Push通知、プレビュー
+    cameras = create_cameras(CAMERAS, collector.notify, pool)
+    for camera in cameras:
+        camera.start()
+
+    def print_stats():
+        for camera in cameras:
+            camera.print_stats()
+
+    stats_time = time.monotonic()
+    metrics_time = time.monotonic()
+
+    # 推論でエラーが発生した場合の待ち時間
+    backoff = Backoff(ERROR_RETRY_INTERVAL_SEC, ERROR_RETRY_INTERVAL_MAX_SEC)
+
+    while True:
+
+        try:
+            # 設定ファイルが変更されていれば、次のフレームから反映する
+            config.check()
+
+            # ビデオ映像取得
+            # 各カメラの取得スレッドが取得した最新のフレームを受け取る
+            batch = collector.collect(cameras)
+            metrics.inc("frames", len(batch))
+
+            with ExitStack() as stack:
+                for camera, _, _ in batch:
+                    stack.enter_context(camera.pipeline.inference_stage.busy())
+
+                # 推論するフレーム (Camera, PIL Image, 倍率)
+                targets = []
+
+                # PLI Imageに変換
+                # モデルの入力サイズ(ROIを指定したカメラは、ROIを切り出した大きさ)に合わせて縮小しながらデコードする
+                # ワーカープロセスを使う場合は、各カメラのフレームを並行してデコードする
+                # (デコード結果は (PIL Image, 倍率) のリストで、batchと同じ順番)
+                with metrics.measure("decode"):
+                    decoded = decode_frames(
+                        [frame for _, frame, _ in batch],
+                        [camera.decode_size for camera, _, _ in batch],
+                        pool)
+
+                for (camera, frame, timestamp), (img, scale) in zip(batch, decoded):
+
+                    # シーンに変化がなければ推論を省略し、前回の結果をそのまま使う
+                    if not MOTION_GATE_ENABLED or camera.gate.check(frame, img):
+                        targets.append((camera, img, scale))
+                    else:
+                        # 推論を省略したフレーム
+                        metrics.inc("skipped")
+
+                if len(targets) > 0:
+
+                    # モデルを取得
+                    # 初めて使うモデルの場合は、ここでモデルの読み込みとウォームアップが行われる
+                    # (画像サイズが違うカメラやROIを切り出す場合も、同じモデルを共有する)
+                    model = models.get(MODEL_FILE_PATH)
+
+                    # 推論する画像
+                    # ROIを指定したカメラは、ROIを囲む矩形(またはタイル)を切り出す
+                    # (カメラごとに (切り出した画像, 位置) のリスト)
+                    crops = []
+                    for camera, img, _ in targets:
+                        crops.append(camera.roi.crop(img) if camera.roi is not None else [(img, (0, 0))])
+
+                    # 物体検知実行
+                    # 各カメラの画像をまとめて1回で推論する
+                    with metrics.measure("inference"):
+                        outputs = predictor.predict(
+                            model,
+                            [c for items in crops for c, _ in items],
+                            conf=CONF, 
+                            iou=IOU, 
+                            classes=CLASSES, 
+                            verbose=PREDICT_VERBOSE)
+
+                    # カメラごとに、切り出した画像の推論結果をフレーム全体の座標の1つの結果にまとめる
+                    results = []
+                    for (camera, img, _), items in zip(targets, crops):
+                        part, outputs = outputs[:len(items)], outputs[len(items):]
+                        results.append(camera.roi.merge(img, items, part, IOU) if camera.roi is not None else part[0])
+
+                    # 結果を整形
+                    for (camera, _, scale), result in zip(targets, results):
+                        with metrics.measure("parse"):
+                            camera.res = parse_results([result], scale)
+                        metrics.inc("detections", len(camera.res))
+
+            for (camera, frame, timestamp), (img, scale) in zip(batch, decoded):
+
+                # 物体を検出している間はフレームレートを上げる
+                camera.scheduler.set_active(len(camera.res) > 0)
+
+                # 描画、Push通知、プレビュー保存は公開スレッドで行う
+                # 物体を検知したフレームは、検知なしのフレームで上書きされないよう優先度を上げる
+                camera.pipeline.publish((timestamp, frame, img, scale, camera.res), priority=1 if len(camera.res) > 0 else 0)
+
+            backoff.reset()
+
+            # 統計情報を出力
+            if STATS_INTERVAL_SEC > 0 and time.monotonic() - stats_time >= STATS_INTERVAL_SEC:
+                print_stats()
+                stats_time = time.monotonic()
 
-            time.sleep(0.1)  # フレームレート制御
+            # 計測値をファイルに書き出す
+            if METRICS_FILE_PATH and time.monotonic() - metrics_time >= METRICS_INTERVAL_SEC:
+                metrics.write(METRICS_FILE_PATH)
+                metrics_time = time.monotonic()
 
         except KeyboardInterrupt:
             print("Received SIGINT (Ctrl+C), exiting...")
+            print_stats()
+            for camera in cameras:
+                camera.close()
+            if pool is not None:
+                pool.close()
             sys.exit(0)
 
         except Exception as e:
             print(str(e))    
-            time.sleep(5)
+            metrics.inc("errors")
+            time.sleep(backoff.failed())
 
 
 if __name__ == "__main__":
@@ -1,24 +1,66 @@
 from datetime import datetime, timezone
 import math
+import shlex
 import subprocess
+import threading
 import sys
 import os
 import time
 import json
+import copy
+import hashlib
+import tempfile
+import multiprocessing
+import signal
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import torch
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from ultralytics.trackers.track import TRACKER_MAP
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
 from PIL import Image, ImageDraw
+import numpy as np
 
 # プイビュー用画像の保存パス
 PREVIEW_IMAGE_PATH = os.environ["PREVIEW_IMAGE_PATH"]
 
+#
+# プレビュー画像をHTTPで配信するポート番号
+# 指定した場合はPREVIEW_IMAGE_PATHへの書き込みは行わず、
+# http://<ホスト>:<ポート>/stream.mjpg (MJPEG) と /result.jpg で配信する
+# 0の場合は配信せず、従来通りPREVIEW_IMAGE_PATHに書き込む
+PREVIEW_HTTP_PORT = int(os.environ.get("PREVIEW_HTTP_PORT", "0"))
+
 # 使用するYoloモデルファイルの名前
 # パス指定する場合はソースコードからの相対パスで指定
-MODEL_FILE_NAME = os.environ["MODEL_FILE_NAME"]
+# 環境変数で指定しない場合は、設定ファイル(CONFIG_FILE_PATH)で指定する
+MODEL_FILE_NAME = os.environ.get("MODEL_FILE_NAME", "")
 
 # モデルファイルを絶対パスに変換(このソースコードの場所を起点)
 MODEL_FILE_PATH = os.path.join(os.path.dirname(__file__), MODEL_FILE_NAME)
 
+#
+# 設定ファイル(JSON)のパス
+# RuntimeConfig.KEYSの設定値(CONF、IOU、CLASSESなど)を、このファイルの定数の代わりに指定できる
+# 例) {"CONF" : 0.4, "ALERT_SEC" : 120}
+# 実行中もCONFIG_CHECK_INTERVAL_SECごとに変更を確認し、変更されていれば次のフレームから反映する
+# (コンテナの再起動やモデルの読み込み直しは不要で、MODEL_FILE_NAMEを変更した場合だけ新しいモデルを読み込む)
+# 同じ名前の環境変数を指定した場合は、環境変数の値を優先する
+# ファイルがない場合は、このファイルの定数の値を使う
+CONFIG_FILE_PATH = os.environ.get("CONFIG_FILE_PATH", os.path.join(os.path.dirname(__file__), "config.json"))
+
+# 設定ファイルの変更を確認する間隔(秒)
+CONFIG_CHECK_INTERVAL_SEC = 2
+
 # confidence threshold
 # 検出信頼度の閾値(0.0 ~ 1.0)
 # これを下回る検出信頼度(confidence score)の検出は、結果に含めない
@@ -61,6 +103,16 @@ WARNING_SEC = 30
 # 赤枠で結果画像に描画
 ALERT_SEC = 60
 
+#
+# アラートを再通知する間隔(秒)
+# ALERT_SEC以上静止したオブジェクトは、アラート状態(赤枠)になったときに1回だけPush通知し、
+# その後も静止し続けている場合は、この間隔ごとに再通知する
+ALERT_COOLDOWN_SEC = 300
+
+#
+# WARNING_SECを超えた(警告状態になった)ときにもPush通知するかどうか
+ALERT_PUSH_ON_WARNING = False
+
 #
 # オブジェクトの保持時間(秒)
 # track処理で検出されなかったオブジェクトを保持しておく時間
@@ -68,6 +120,286 @@ ALERT_SEC = 60
 # ここで設定された時間はtracking_objects配列に保持しておく
 OBJECT_RETENTION_TIME_SEC = 10
 
+#
+# トラッキング情報の保存先(追記型のジャーナルファイル)
+# 再起動や画像サイズの変更の後も、静止していたオブジェクトの静止時間を引き継ぐ
+# 複数のカメラを処理する場合は、ファイル名にカメラの名前を付ける
+# SDカードへの書き込みを増やさないよう、既定では保存しない(空の場合は保存しない)
+# 保存する場合は、docker-compose.ymlで /home/cap/aicap/extmod/tracks.jsonl などを指定する
+TRACK_STATE_PATH = os.environ.get("TRACK_STATE_PATH", "")
+
+# 前回から更新されたオブジェクトを追記する間隔(秒)
+# 異常終了した場合は、最大でこの時間分の静止時間が失われる
+TRACK_STATE_INTERVAL_SEC = 5
+
+# 追記した行数がこの数を超えたら、全オブジェクトを1行にまとめたファイルに書き換える(コンパクション)
+TRACK_STATE_COMPACT_RECORDS = 100
+
+# 復元するオブジェクトの、最後に検出されてからの時間の上限(秒)
+TRACK_RESTORE_MAX_AGE_SEC = 600
+
+# 復元したオブジェクトを、新しいトラッキングIDのオブジェクトに引き継ぐまで待つ時間(秒)
+# 検出されたBOXと同じクラスで重なり(IoU)がTRACK_RESTORE_IOU以上のものがあれば、同じオブジェクトとみなす
+TRACK_RESTORE_WAIT_SEC = 120
+TRACK_RESTORE_IOU = 0.5
+
+#
+# カメラフレームをストリーミングで取得するコマンド
+# 標準出力にJPEG画像を連続で出力し続けるコマンドを指定する
+# 例) ffmpeg -loglevel error -f v4l2 -i /dev/video0 -f mjpeg -q:v 3 -
+# 空の場合は従来通り、1フレームごとに aicap get_frame を実行する
+FRAME_STREAM_COMMAND = os.environ.get("FRAME_STREAM_COMMAND", "")
+
+#
+# ストリーミングコマンドの出力形式
+# "mjpeg"  : JPEG画像の連結(multipartのヘッダが間に含まれていても可)
+# "length" : 4バイト(ビッグエンディアン)のデータ長 + JPEG画像 の繰り返し
+FRAME_STREAM_FORMAT = os.environ.get("FRAME_STREAM_FORMAT", "mjpeg")
+
+#
+# 複数のカメラを1つのプロセスで処理する場合の、カメラの設定(JSON配列)
+# モデルは全カメラで1つだけ読み込み、各カメラの最新フレームをまとめて1回のpredictで推論する
+# 例) [{"name" : "front", "stream_command" : "ffmpeg ... -f mjpeg -", "preview_http_port" : 8081},
+#      {"name" : "back", "stream_command" : "ffmpeg ... -f mjpeg -"}]
+#   name               : カメラの名前(Push通知の結果情報に "camera" として含まれる)
+#   stream_command     : ストリーミングコマンド(省略時はFRAME_STREAM_COMMAND、空の場合は aicap get_frame)
+#   stream_format      : ストリーミングコマンドの出力形式(省略時はFRAME_STREAM_FORMAT)
+#   preview_image_path : プレビュー画像の保存パス(省略時はPREVIEW_IMAGE_PATHのファイル名に _<name> を付けたもの)
+#   preview_http_port  : プレビュー画像をHTTPで配信するポート番号(省略時は0: 配信しない)
+#   rois               : 推論する領域(ROI)の多角形のリスト(省略時はROIS)
+# aicap get_frameで取得できるのはAIBOXのカメラ1台分だけなので、2台目以降はstream_commandを指定する
+# 空の場合は従来通り、1台のカメラを処理する
+CAMERAS = os.environ.get("CAMERAS", "")
+
+#
+# 統計情報(フレーム取得、Push通知など)を出力する間隔(秒)
+# 0の場合は出力しない(終了時には必ず出力する)
+STATS_INTERVAL_SEC = float(os.environ.get("STATS_INTERVAL_SEC", "60"))
+
+#
+# JPEGのデコードと、枠の描画 + JPEGエンコードを行うワーカープロセスの数
+# 推論とは別のプロセスで行うので、検知物体が多く描画に時間がかかるシーンでも推論が遅れない
+# 画像データは共有メモリ(/dev/shm)で受け渡すので、Dockerのshm_size(既定64MB)に収まるよう注意する
+# 0の場合はワーカープロセスを使わず、従来通り同じプロセス内で処理する
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))
+
+#
+# 処理時間のパーセンタイルを計算するために保持するサンプル数(処理段ごと)
+STAGE_LATENCY_SAMPLES = 1000
+
+#
+# 計測値(処理時間、件数)をPrometheusのテキスト形式で書き出すファイル
+# node_exporterのtextfile collectorなどで収集する
+# 空の場合は書き出さない(PREVIEW_HTTP_PORTを指定した場合は http://<アドレス>:<ポート>/metrics でも取得できる)
+METRICS_FILE_PATH = os.environ.get("METRICS_FILE_PATH", "")
+
+# 計測値をファイルに書き出す間隔(秒)
+METRICS_INTERVAL_SEC = 10
+
+#
+# 推論ごとのUltralyticsのコンソール出力
+# ログ(json-file 10MB×10)を消費するので、"0"を指定すると出力しない
+PREDICT_VERBOSE = os.environ.get("PREDICT_VERBOSE", "1") != "0"
+
+#
+# トラッカーの設定ファイル
+# model.track()のデフォルトと同じBoT-SORTを使用する(ByteTrackを使う場合は "bytetrack.yaml")
+TRACKER_CONFIG = "botsort.yaml"
+
+#
+# モデルの入力画像サイズ(ピクセル)
+# フレームのJPEGは、長辺がこのサイズを下回らない範囲で縮小しながらデコードする
+# (JPEGのDCTスケーリングを使うので、フルサイズでデコードしてから縮小するより速く、メモリも少ない)
+# 検出したBOXの座標は元の解像度に変換してから、描画やPush通知に使用する
+# 0の場合は縮小せずにデコードする
+MODEL_INPUT_SIZE = int(os.environ.get("MODEL_INPUT_SIZE", "640"))
+
+#
+# 推論する領域(ROI)の多角形のリスト(JSON配列)
+# 座標はフレームの幅と高さに対する割合(0.0 ~ 1.0)で指定する
+# 例) [[[0.0, 0.5], [0.6, 0.3], [1.0, 0.3], [1.0, 1.0], [0.0, 1.0]]]
+# 各ROIを囲む矩形だけを切り出して推論し、中心がいずれかのROIの中にある物体だけを検出する
+# (フレーム全体を縮小して推論するより、遠くの小さな物体が検出しやすくなる)
+# 複数のカメラを処理する場合は、CAMERASの "rois" でカメラごとに指定できる
+# 空の場合はフレーム全体を推論する
+ROIS = os.environ.get("ROIS", "")
+
+#
+# ROIを囲む矩形を、モデルの入力サイズのタイルに分割して推論する(タイル推論)
+# フレームを縮小せずにデコードするので小さな物体も検出できるが、タイルの数だけ推論の回数が増える
+# タイルの重なった部分で重複して検出された物体は1つにまとめる
+ROI_TILED = os.environ.get("ROI_TILED", "0") == "1"
+
+# タイルの重なり(タイルの大きさに対する割合)
+# タイルの境界で分断された物体も、どちらかのタイルで全体が写るようにする
+ROI_TILE_OVERLAP = 0.2
+
+#
+# シーンに変化がないフレームの推論を省略する(モーションゲート)
+# JPEGのデータが最後に推論したフレームと同じ場合や、
+# 縮小したグレースケール画像で、輝度がMOTION_PIXEL_THRESHOLD以上変化した画素の割合が
+# MOTION_AREA_THRESHOLD未満の場合は推論を省略し、前回の結果をそのまま使う
+# 変化が閾値未満の物体(遠くの小さな物体など)は、MOTION_FORCE_INTERVAL_SECごとの推論まで検知が遅れるので、
+# 有効にする場合は、実際の映像で見逃しがないことを確認しながらMOTION_AREA_THRESHOLDを調整する
+# 既定では無効(すべてのフレームを推論する)、MOTION_GATE_ENABLED=1で有効にする
+MOTION_GATE_ENABLED = os.environ.get("MOTION_GATE_ENABLED", "0") == "1"
+MOTION_PIXEL_THRESHOLD = 15
+MOTION_AREA_THRESHOLD = 0.0005
+
+#
+# 変化がなくても推論する間隔(秒)
+# 最後に推論してからこの時間が経過した場合は、必ず推論を行う
+MOTION_FORCE_INTERVAL_SEC = 5
+
+#
+# キーフレームの間隔(フレーム数)
+# 検出とトラッキングはキーフレームだけで行い、その間のフレームでは検出したBOXを
+# 縮小したグレースケール画像のテンプレートマッチングで動かす(静止時間の加算は推論した場合と同じ)
+# 次の場合は、間隔の途中でもキーフレームにする
+# - BOXの外で変化があった(新しい物体が現れた、物体が大きく動いた)
+# - BOXが見つからなかった(一致度がKEYFRAME_MIN_SCORE未満)
+# - BOXの信頼度がCONF未満になった(キーフレームでないフレームごとにKEYFRAME_CONF_DECAYを掛ける)
+# トラッカーが追跡中のIDを失わないよう、トラッカーの設定(track_buffer)より小さくする
+# 0の場合は、従来通り変化があったフレームはすべて推論する
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", "0"))
+
+# テンプレートマッチングに使う縮小画像の幅と、BOXを探す範囲(縮小画像のピクセル)
+KEYFRAME_MATCH_WIDTH = 320
+KEYFRAME_SEARCH_RANGE = 8
+
+# BOXが見つかったとみなす一致度(正規化相互相関、-1.0 ~ 1.0)
+KEYFRAME_MIN_SCORE = 0.7
+
+# キーフレームでないフレームごとに、信頼度に掛ける値
+KEYFRAME_CONF_DECAY = 0.98
+
+#
+# 読み込んだモデルを保持しておく数
+# モデルはファイルごとに1回だけ読み込まれ、フレームの画像サイズが変わってもそのまま再利用する
+# (推論時にモデルの入力サイズに合わせてレターボックス処理される)
+MODEL_CACHE_SIZE = 2
+
+#
+# フレームレート(fps)
+# フレームの取得、推論、結果の公開(描画・Push通知・プレビュー保存)は別々のスレッドで並行して行う
+# 物体を検出している間はTARGET_FPSで動作し、
+# 検出がない状態がIDLE_AFTER_SEC秒続いたらIDLE_FPSに下げる(検出したらすぐTARGET_FPSに戻る)
+# 静止時間の計測は時間(Unixtime)で行うので、フレームレートを下げても結果は変わらない
+# TARGET_FPSは従来の処理間隔(0.1秒)と同じにする(下げるとトラッキングの対応付けの精度が落ちる)
+TARGET_FPS = 10
+IDLE_FPS = 1
+IDLE_AFTER_SEC = 30
+
+#
+# エラー発生時の待ち時間(秒)
+# エラーが続く場合は倍々に延ばし、ERROR_RETRY_INTERVAL_MAX_SECで頭打ちにする
+ERROR_RETRY_INTERVAL_SEC = 0.5
+ERROR_RETRY_INTERVAL_MAX_SEC = 5
+
+#
+# Push通知キューの最大数
+# 送信待ちの通知がこの数を超えた場合は、PUSH_DROP_POLICYに従って破棄する
+PUSH_QUEUE_SIZE = 10
+
+#
+# Push通知キューが満杯の場合の破棄方針
+# "oldest" : 一番古い通知を破棄して新しい通知を積む
+# "newest" : 新しい通知を破棄する
+PUSH_DROP_POLICY = "oldest"
+
+#
+# Push通知に失敗した場合のリトライ回数
+PUSH_RETRY_COUNT = 3
+
+#
+# リトライまでの待ち時間(秒)
+# リトライのたびに倍になり、PUSH_RETRY_INTERVAL_MAX_SECで頭打ちになる
+PUSH_RETRY_INTERVAL_SEC = 1.0
+PUSH_RETRY_INTERVAL_MAX_SEC = 30.0
+
+#
+# aicap push コマンドのタイムアウト(秒)
+PUSH_TIMEOUT_SEC = 60
+
+#
+# Push通知の結果情報(JSON)の渡し方
+# "arg"   : コマンドライン引数(-J)で渡す(従来通り)
+# "file"  : 一時ファイルに書き込み、PUSH_JSON_FILE_OPTIONでパスを渡す(画像は標準入力)
+# "stdin" : 標準入力で渡す(画像は一時ファイルに書き込み、-i でパスを渡す)
+# 検出物体が多いと、コマンドライン引数の長さの上限(1つあたり128KB)を超えることがあるので、その場合は "file" / "stdin" を使う
+# ("file" / "stdin" は、結果情報をファイルから読み込めるaicapが必要)
+PUSH_PAYLOAD_TRANSPORT = os.environ.get("PUSH_PAYLOAD_TRANSPORT", "arg")
+
+# 結果情報のファイルを指定するaicap pushのオプション("stdin"の場合は "-" を渡す)
+# aicapのバージョンによって異なるので既定値はなく、"file" / "stdin" を使う場合は必ず指定する
+PUSH_JSON_FILE_OPTION = os.environ.get("PUSH_JSON_FILE_OPTION", "")
+
+#
+# 結果情報のキーを短縮する(PUSH_SHORT_KEY_MAP)
+# 受信側で短縮したキーを扱えるようにしてから有効にする
+PUSH_SHORT_KEYS = os.environ.get("PUSH_SHORT_KEYS", "0") == "1"
+
+# 結果情報の小数の桁数(負の場合は丸めない)
+PUSH_FLOAT_DIGITS = 3
+
+#
+# Push通知する画像
+# "full"      : 元の解像度の画像に検知枠を描画する(従来通り)
+# "thumbnail" : 推論に使った縮小画像に検知枠を描画し、長辺をPUSH_THUMBNAIL_SIZE以下にする
+# "crops"     : Push通知するオブジェクトのBOXの部分だけを元の解像度の画像から切り出し、横に並べる
+# "thumbnail" / "crops" の場合は、元の解像度でのデコードと描画を行わないので、CPUの負荷も下がる
+PUSH_IMAGE_MODE = os.environ.get("PUSH_IMAGE_MODE", "full")
+
+# サムネイルの長辺のサイズ(ピクセル)
+PUSH_THUMBNAIL_SIZE = 640
+
+# 切り出した画像の高さ(ピクセル)、周囲に含める余白(BOXの大きさに対する割合)、最大の数
+PUSH_CROP_HEIGHT = 240
+PUSH_CROP_MARGIN = 0.2
+PUSH_CROP_COUNT = 8
+
+# 結果情報のキーの短縮形
+PUSH_SHORT_KEY_MAP = {
+    "id" : "i", "pos" : "p", "box" : "b", "prev_timestamp" : "t", "stay_sec" : "s", "state" : "st",
+    "alert_state" : "a", "conf" : "c", "cls" : "k", "tracked" : "tr", "camera" : "cam"
+}
+
+#
+# 検知した前後の映像(クリップ)の保存先ディレクトリ
+# 直近のフレームを取得したJPEGのままメモリ上に保持しておき、アラート状態になったとき、前後のフレームをまとめて書き込む
+# (常時録画と違い、SDカードへの書き込みは検知したときだけ)
+# 空の場合は保存しない(フレームの保持もしない)
+CLIP_DIR = os.environ.get("CLIP_DIR", "")
+
+# 検知より前 / 後に含める時間(秒)
+CLIP_PRE_SEC = 10
+CLIP_POST_SEC = 5
+
+# メモリ上に保持するフレームの合計サイズの上限(バイト)
+# 保持している時間がCLIP_PRE_SECに満たなくても、超えた分は古いフレームから捨てる
+# (書き込み待ちのクリップも同じ上限で打ち切るので、メモリの使用量は最大でこの2倍)
+CLIP_BUFFER_MAX_BYTES = 32 * 1024 * 1024
+
+# 検知が続いた場合に延長するクリップの最大の長さ(秒)
+CLIP_MAX_SEC = 60
+
+# 保存しておくクリップの数(超えた場合は古いものから削除する、0の場合は削除しない)
+CLIP_KEEP_COUNT = 100
+
+#
+# 検知の記録(SQLite)の保存先
+# オブジェクトごとの検知していた期間と静止時間、警告とアラートを記録する
+# tools/events/events.py で、期間を指定して件数や時間を集計できる
+# SDカードへの書き込みを増やさないよう、既定では記録しない(空の場合は記録しない)
+# 記録する場合は、docker-compose.ymlで /home/cap/aicap/extmod/events.db などを指定する
+EVENT_DB_PATH = os.environ.get("EVENT_DB_PATH", "")
+
+# 記録はまとめて書き込む(推論のループでは書き込まない)
+# 書き込む間隔(秒)と、間隔を待たずに書き込む行数、書き込み待ちの行数の上限
+EVENT_FLUSH_INTERVAL_SEC = 5
+EVENT_BATCH_SIZE = 100
+EVENT_QUEUE_SIZE = 10000
+
 def get_frame() -> bytes:
     """
     カメラフレーム画像をJPEGで取得します
@@ -94,7 +426,264 @@ def get_frame() -> bytes:
             f"Command failed (exit code {e.returncode}): "
             f"{e.stderr.decode(errors='ignore')}"
         ) from e
-    
+
+
+class FrameSource:
+    """
+    カメラフレーム画像(JPEG)の取得元
+
+    stream_commandが指定されている場合は、常駐させた子プロセスの標準出力から
+    JPEG画像を連続で読み込み、最新のフレームを返します(ストリーミングモード)
+    指定されていない場合や、子プロセスが停止している間は
+    get_frame()で1フレームずつ取得します(ワンショットモード)
+    """
+
+    # JPEGのSOI/EOIマーカー
+    SOI = b"\xff\xd8"
+    EOI = b"\xff\xd9"
+
+    # 子プロセスが停止してから再起動を試みるまでの時間(秒)
+    RESTART_INTERVAL_SEC = 5
+
+    def __init__(self, stream_command : str = "", stream_format : str = "mjpeg"):
+        """
+        Args:
+            stream_command (str) : ストリーミングで使用するコマンド(空の場合はワンショットのみ)
+            stream_format (str)  : ストリーミングの出力形式("mjpeg" または "length")
+        """
+        self.stream_command = stream_command
+        self.stream_format = stream_format
+
+        self._proc = None
+        self._reader_alive = False
+        self._next_start_time = 0.0
+        self._cond = threading.Condition()
+
+        # 最新フレームと、その通番
+        self._frame = None
+        self._frame_seq = 0
+
+        # read()で最後に返したフレームの通番
+        self._read_seq = 0
+
+        # 統計情報
+        self._stats_start = time.monotonic()
+        self._stats_count = 0
+        self._stats_latency_sum = 0.0
+        self._stats_latency_max = 0.0
+
+    @property
+    def streaming(self) -> bool:
+        """
+        ストリーミングモードで動作中かどうか
+        """
+        return self._reader_alive
+
+    def read(self, timeout : float = 5.0) -> bytes:
+        """
+        最新のカメラフレーム画像を取得します
+        ストリーミングモードの場合は、前回返したフレームより新しいフレームが届くまで待ちます
+
+        Args:
+            timeout (float) : ストリーミングでフレームを待つ最大時間(秒)
+
+        Returns:
+            bytes : カメラフレーム画像(JPEG)
+        """
+        start = time.monotonic()
+        frame = None
+
+        if self.stream_command:
+            self._ensure_stream()
+            if self.streaming:
+                frame = self._read_stream(timeout)
+
+        if frame is None:
+            # ストリーミングが使えない場合はワンショットで取得
+            frame = get_frame()
+
+        latency = time.monotonic() - start
+        self._stats_count += 1
+        self._stats_latency_sum += latency
+        self._stats_latency_max = max(self._stats_latency_max, latency)
+
+        return frame
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までのフレーム取得の統計を返します
+
+        Returns:
+            dict : mode(取得方式), frames(取得数), fps, latency_avg_ms / latency_max_ms(取得にかかった時間)
+        """
+        now = time.monotonic()
+        elapsed = now - self._stats_start
+        count = self._stats_count
+
+        res = {
+            "mode" : "stream" if self.streaming else "oneshot",
+            "frames" : count,
+            "fps" : round(count / elapsed, 2) if elapsed > 0 else 0.0,
+            "latency_avg_ms" : round(self._stats_latency_sum / count * 1000, 1) if count > 0 else 0.0,
+            "latency_max_ms" : round(self._stats_latency_max * 1000, 1)
+        }
+
+        self._stats_start = now
+        self._stats_count = 0
+        self._stats_latency_sum = 0.0
+        self._stats_latency_max = 0.0
+
+        return res
+
+    def close(self):
+        """
+        ストリーミングの子プロセスを停止します
+        """
+        proc = self._proc
+        self._proc = None
+
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def _ensure_stream(self):
+        """
+        ストリーミングの子プロセスが動作していなければ起動します
+        """
+        if self._proc is not None and self._proc.poll() is None:
+            return
+
+        now = time.monotonic()
+        if now < self._next_start_time:
+            return
+        self._next_start_time = now + self.RESTART_INTERVAL_SEC
+
+        if self._proc is not None:
+            print(f"Frame stream exited (exit code {self._proc.returncode})")
+            self._proc = None
+
+        try:
+            self._proc = subprocess.Popen(
+                shlex.split(self.stream_command),
+                stdout=subprocess.PIPE
+            )
+        except OSError as e:
+            print(f"Could not start frame stream: {e}")
+            return
+
+        self._reader_alive = True
+        threading.Thread(target=self._read_loop, args=(self._proc,), daemon=True).start()
+        print(f"Frame stream started: {self.stream_command}")
+
+    def _read_stream(self, timeout : float) -> bytes:
+        """
+        ストリーミングで受信した最新フレームを取得します
+
+        Returns:
+            bytes : カメラフレーム画像(JPEG)、タイムアウトまたは停止した場合はNone
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._frame_seq != self._read_seq or not self.streaming,
+                timeout=timeout)
+
+            if self._frame_seq == self._read_seq:
+                return None
+
+            self._read_seq = self._frame_seq
+            return self._frame
+
+    def _read_loop(self, proc : subprocess.Popen):
+        """
+        子プロセスの標準出力を読み込み、フレームに分割するスレッド関数
+        複数のフレームが溜まっていた場合は最新のものだけが残ります
+
+        Args:
+            proc (Popen) : ストリーミングの子プロセス
+        """
+        split = self._split_length if self.stream_format == "length" else self._split_mjpeg
+        buf = bytearray()
+
+        try:
+            while True:
+                chunk = proc.stdout.read1(65536)
+                if not chunk:
+                    break
+
+                buf += chunk
+
+                for frame in split(buf):
+                    with self._cond:
+                        self._frame = frame
+                        self._frame_seq += 1
+                        self._cond.notify_all()
+
+        except Exception as e:
+            print(f"Frame stream error: {e}")
+
+        finally:
+            with self._cond:
+                # 子プロセスが再起動された後に終了した古いスレッドは、新しいストリームの状態を変えない
+                if proc is self._proc:
+                    self._reader_alive = False
+                self._cond.notify_all()
+
+    def _split_mjpeg(self, buf : bytearray) -> list:
+        """
+        連結されたJPEGデータをSOI/EOIマーカーで分割します
+        分割したデータはbufから取り除かれます
+
+        Args:
+            buf (bytearray) : 受信データ
+
+        Returns:
+            list : 完成したJPEGフレームのリスト
+        """
+        frames = []
+
+        while True:
+            start = buf.find(self.SOI)
+            if start < 0:
+                # 次のチャンクとマーカーがまたがる可能性があるので最後の1バイトは残す
+                del buf[:-1]
+                break
+
+            end = buf.find(self.EOI, start + 2)
+            if end < 0:
+                del buf[:start]
+                break
+
+            frames.append(bytes(buf[start:end + 2]))
+            del buf[:end + 2]
+
+        return frames
+
+    def _split_length(self, buf : bytearray) -> list:
+        """
+        データ長付きのJPEGデータを分割します
+        分割したデータはbufから取り除かれます
+
+        Args:
+            buf (bytearray) : 受信データ
+
+        Returns:
+            list : 完成したJPEGフレームのリスト
+        """
+        frames = []
+
+        while len(buf) >= 4:
+            length = int.from_bytes(buf[:4], "big")
+            if len(buf) < 4 + length:
+                break
+
+            frames.append(bytes(buf[4:4 + length]))
+            del buf[:4 + length]
+
+        return frames
+
 
 def push(timestamp: int, image: bytes, result: dict):
     """
@@ -109,23 +698,45 @@ def push(timestamp: int, image: bytes, result: dict):
     Returns:
         なし
     """
+    payload = encode_result(result)
+
     #
     # aicap pushコマンド
     # -i を　"-"　で指定すると、標準入力(stdin)から画像データを受け取る
     cmd = [
         "aicap", "push",
-        "-t", str(timestamp),
-        "-i", "-",         # -i - で stdin から画像を受け取る
-        "-J", json.dumps(result)
+        "-t", str(timestamp)
     ]
 
+    # 結果情報を一時ファイルで渡す場合のパス
+    temp_path = None
+
     try:
+        if PUSH_PAYLOAD_TRANSPORT == "file":
+            with tempfile.NamedTemporaryFile("w", prefix="aicap-push-", suffix=".json", delete=False) as f:
+                temp_path = f.name
+                f.write(payload)
+            cmd += ["-i", "-", PUSH_JSON_FILE_OPTION, temp_path]
+            stdin = image
+
+        elif PUSH_PAYLOAD_TRANSPORT == "stdin":
+            with tempfile.NamedTemporaryFile("wb", prefix="aicap-push-", suffix=".jpg", delete=False) as f:
+                temp_path = f.name
+                f.write(image)
+            cmd += ["-i", temp_path, PUSH_JSON_FILE_OPTION, "-"]
+            stdin = payload.encode()
+
+        else:
+            cmd += ["-i", "-", "-J", payload] # -i - で stdin から画像を受け取る
+            stdin = image
+
         result = subprocess.run(
             cmd,
             check=True,
-            input=image, # 画像バイナリを stdin に渡す
+            input=stdin, # 画像バイナリ(または結果情報)を stdin に渡す
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            timeout=PUSH_TIMEOUT_SEC
         )
     
     except subprocess.CalledProcessError as e:
@@ -133,220 +744,3896 @@ def push(timestamp: int, image: bytes, result: dict):
             f"Command failed (exit code {e.returncode}): "
             f"{e.stderr.decode(errors='ignore')}"
         ) from e
-    
 
-def create_result_jpeg(img : Image, tracking_objects : list) -> bytes:
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"Command timed out ({PUSH_TIMEOUT_SEC} sec)") from e
+
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+
+def encode_result(result) -> str:
     """
-    tracking_objectsの内容を画像に書き込みます
-    
+    Push通知の結果情報をJSONに変換します
+    空白を除いた形式にし、小数を丸めて(PUSH_FLOAT_DIGITS)、必要ならキーを短縮します(PUSH_SHORT_KEYS)
+
     Args:
-        img (Image)   : カメラフレーム画像のPIL Image
-        tracking_objects (list) : トラッキングオブジェクトを格納した配列
+        result : 結果情報
 
     Returns:
-        bytes : 結果を書き込んだJPEG画像
+        str : JSON
     """
-   
-    draw = ImageDraw.Draw(img)
-    font_size = 30 # 静止時間を書き込む際の文字の大きさ
+    def compact(obj):
+        if isinstance(obj, dict):
+            return {(PUSH_SHORT_KEY_MAP.get(k, k) if PUSH_SHORT_KEYS else k) : compact(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [compact(v) for v in obj]
+        if isinstance(obj, float) and PUSH_FLOAT_DIGITS >= 0:
+            return round(obj, PUSH_FLOAT_DIGITS)
+        return obj
 
-    for p in tracking_objects:
+    return json.dumps(compact(result), separators=(",", ":"))
 
-        if not p["tracked"]:
-            continue
 
-        stay_sec = p["stay_sec"]
+class PushQueue:
+    """
+    Push通知を非同期で送信するキュー
 
-        # 枠の色を決める
-        if stay_sec < WARNING_SEC:
-            cr = (255, 255, 255)
-        elif stay_sec < ALERT_SEC:
-            cr = (255, 255, 0)
-        else:
-            cr = (255, 0, 0)
+    put()で積まれた通知は、ワーカースレッドがpush()で順番に送信します
+    失敗した場合は待ち時間を倍にしながらリトライし、
+    キューが満杯の場合はdrop_policyに従って通知を破棄します
+    """
 
-        # 静止時間
-        hour = math.floor(stay_sec / 60 / 60)
-        min = math.floor(stay_sec / 60) - hour * 60
-        sec = math.floor(stay_sec%60)
-        parking_time = str(min).zfill(2) + ":" + str(sec).zfill(2)
-        if hour > 0:
-            parking_time = str(hour) + ":" + parking_time
+    def __init__(self, maxsize : int, drop_policy : str = "oldest",
+                 retry_count : int = 3, retry_interval : float = 1.0, retry_interval_max : float = 30.0):
+        """
+        Args:
+            maxsize (int)              : キューの最大数
+            drop_policy (str)          : 満杯時の破棄方針("oldest" または "newest")
+            retry_count (int)          : 失敗時のリトライ回数
+            retry_interval (float)     : 最初のリトライまでの待ち時間(秒)
+            retry_interval_max (float) : リトライまでの待ち時間の上限(秒)
+        """
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.retry_count = retry_count
+        self.retry_interval = retry_interval
+        self.retry_interval_max = retry_interval_max
 
-        text = f'{parking_time}'
+        self._queue = deque()
+        self._cond = threading.Condition()
 
-        x1 = p["box"]["x1"]
-        y1 = p["box"]["y1"]
-        x2 = p["box"]["x2"]
-        y2 = p["box"]["y2"]
+        # queued : キューに積んだ数
+        # sent   : 送信に成功した数
+        # dropped: キューが満杯で破棄した数
+        # failed : リトライしても送信できなかった数
+        self._counters = {"queued" : 0, "sent" : 0, "dropped" : 0, "failed" : 0}
 
-        draw.rectangle((x1, y1, x2, y2), fill=None, outline=cr, width=5)
+        threading.Thread(target=self._worker, daemon=True).start()
 
-        text_box = draw.textbbox((x1, y1), text, font_size=font_size, anchor='lt')
-        draw.rectangle(text_box, fill=cr, outline=None)
-        draw.text((x1, y1), text, fill=(0,0,0), font_size=font_size, anchor='lt')
+    def put(self, timestamp : int, image : bytes, result) -> bool:
+        """
+        Push通知をキューに積みます
+        呼び出し元は送信の完了を待ちません
 
-    dst = BytesIO()
-    img.save(dst, format='JPEG', quality=75)
-    dst.seek(0)
+        Args:
+            timestamp (int) : 時間(Unixtime)
+            image (bytes)   : 画像
+            result          : 結果情報(呼び出し後に変更されても影響しないようコピーされます)
 
-    return dst.getvalue()
+        Returns:
+            bool : キューに積めた場合はTrue、破棄した場合はFalse
+        """
+        item = (timestamp, image, copy.deepcopy(result))
 
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self._counters["dropped"] += 1
+                if self.drop_policy == "newest":
+                    return False
+                self._queue.popleft()
 
-def parse_results(results : list, timestamp : int, tracking_objects : list):
+            self._queue.append(item)
+            self._counters["queued"] += 1
+            self._cond.notify()
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        送信状況のカウンターを返します
+
+        Returns:
+            dict : queued, sent, dropped, failed と pending(送信待ちの数)
+        """
+        with self._cond:
+            return dict(self._counters, pending=len(self._queue))
+
+    def _worker(self):
+        """
+        キューから取り出した通知を送信するスレッド関数
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._queue) > 0)
+                timestamp, image, result = self._queue.popleft()
+
+            for attempt in range(self.retry_count + 1):
+                try:
+                    with metrics.measure("push"):
+                        push(timestamp, image, result)
+                    counter = "sent"
+                    break
+
+                except Exception as e:
+                    print(f"Push failed ({attempt + 1}/{self.retry_count + 1}): {e}")
+                    counter = "failed"
+
+                    if attempt < self.retry_count:
+                        time.sleep(min(self.retry_interval * (2 ** attempt), self.retry_interval_max))
+
+            with self._cond:
+                self._counters[counter] += 1
+
+            if counter == "failed":
+                metrics.inc("errors")
+
+
+class PreviewServer:
     """
-    trackの結果をtracking_objectsに設定します。
-    
-    Args:
-        results (list)   : trackの処理結果
-        timestamp (int)  : 時間(Unixtime)
-        tracking_objects (list) : トラッキングオブジェクトを格納した配列
+    プレビュー画像をメモリ上に保持し、HTTPで配信します
 
+    /stream.mjpg : multipart/x-mixed-replace形式のMJPEGストリーム(新しい画像が届くたびに送信)
+    /result.jpg  : 最新の画像1枚(ETagに対応し、変化がなければ304 Not Modifiedを返す)
+    /metrics     : 処理時間と件数(Prometheusのテキスト形式)
     """
 
-    # いったんすべてのオブジェクトのtrackedをFalseで初期化
-    for p in tracking_objects:
-        p["tracked"] = False
+    # MJPEGストリームの区切り文字列
+    BOUNDARY = "aicapframe"
 
-    for box in reversed(results[0].boxes):
+    def __init__(self, port : int):
+        """
+        Args:
+            port (int) : 待ち受けるポート番号
+        """
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
 
-        if box.id is None:
-            continue
+        # 再起動前のETagと重複しないよう、起動時間をETagに含める
+        self._etag_prefix = str(int(time.time()))
 
-        # 結果を扱いやすいように成形
-        id = int(box.id)
-        cls = box.cls.tolist()
-        conf = box.conf.tolist()
-        r = box.xyxy.tolist()
+        self._server = ThreadingHTTPServer(("", port), PreviewRequestHandler)
+        self._server.daemon_threads = True
+        self._server.preview = self
 
-        x1 = int(r[0][0])
-        y1 = int(r[0][1])
-        x2 = int(r[0][2])
-        y2 = int(r[0][3])
+    def start(self):
+        """
+        配信を開始します
+        """
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Preview server started on port {self._server.server_address[1]}")
 
-        pos_x = int(x1 + (x2 - x1) / 2)
-        pos_y = int(y1 + (y2 - y1) / 2)
+    def update(self, frame : bytes):
+        """
+        配信する画像を更新します
 
-        # 今回の処理で検出されたオブジェクトのIDが
-        # tracking_objectsに存在するかどうかを確認
-        p = next((t for t in tracking_objects if t["id"] == id), None)
+        Args:
+            frame (bytes) : プレビュー画像(JPEG)
+        """
+        with self._cond:
+            self._frame = frame
+            self._seq += 1
+            self._cond.notify_all()
 
-        if p is None:
-            # 初めて検知されたオブジェクトなので
-            # 新規に追加
+    def latest(self) -> tuple:
+        """
+        最新の画像を取得します
+
+        Returns:
+            tuple : (プレビュー画像(JPEG), ETag)、画像がまだない場合は(None, None)
+        """
+        with self._cond:
+            if self._frame is None:
+                return None, None
+            return self._frame, f'"{self._etag_prefix}-{self._seq}"'
+
+    def wait(self, seq : int, timeout : float) -> tuple:
+        """
+        seqより新しい画像が届くまで待ちます
+
+        Args:
+            seq (int)       : 前回取得した画像の通番
+            timeout (float) : 待つ最大時間(秒)
+
+        Returns:
+            tuple : (プレビュー画像(JPEG), 通番)、タイムアウトした場合は(None, seq)
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq != seq and self._frame is not None, timeout=timeout):
+                return None, seq
+            return self._frame, self._seq
+
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    """
+    PreviewServerのリクエストハンドラ
+    """
 
-            p = {
-                    "id" : id, 
-                    "pos" : {"x" : pos_x, "y" : pos_y}, 
-                    "box" : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}, 
-                    "prev_timestamp" : timestamp, 
-                    "stay_sec" : 0, # 0秒から開始
-                    "state" : "stay", 
-                    "conf" : conf[0],
-                    "cls" : int(cls[0]),
-                    "tracked" : True
-                }
-            
-            tracking_objects.append(p)
+    def do_GET(self):
+        path = self.path.split("?")[0]
 
+        if path == "/stream.mjpg":
+            self._send_stream()
+        elif path == "/result.jpg":
+            self._send_frame()
+        elif path == "/metrics":
+            self._send_metrics()
         else:
-            # すでにトラッキングされているオブジェクトが
-            # 今回の処理でも見つかったので
-            # 情報を更新
+            self.send_error(404)
 
-            p["tracked"] = True
-            p["conf"] = conf[0]
+    def _send_frame(self):
+        """
+        最新の画像を1枚返します
+        """
+        frame, etag = self.server.preview.latest()
 
-            prev_x = p["pos"]["x"]
-            prev_y = p["pos"]["y"]
+        if frame is None:
+            self.send_error(503)
+            return
 
-            #
-            # 前回から動いているか？
-            # 10ピクセル以上動いていたら動いたと判断
-            move_x = abs(prev_x - pos_x)
-            move_y = abs(prev_y - pos_y)
-            move = move_x > 10 or move_y > 10
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
 
-            p["pos"] = {"x" : pos_x, "y" : pos_y}
-            p["box"] = {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(frame)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(frame)
 
-            if move:
-                p["state"] = "move"
-            else:
-                # 静止している場合は静止時間を加算
-                p["stay_sec"] = p["stay_sec"] + timestamp - p["prev_timestamp"]
-                p["state"] = "stay"
+    def _send_metrics(self):
+        """
+        計測値をPrometheusのテキスト形式で返します
+        """
+        body = metrics.prometheus().encode()
 
-            p["prev_timestamp"] = timestamp
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
+    def _send_stream(self):
+        """
+        新しい画像が届くたびにMJPEGストリームとして送信し続けます
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={PreviewServer.BOUNDARY}")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
 
-def main():
+        seq = 0
+
+        try:
+            while True:
+                frame, seq = self.server.preview.wait(seq, timeout=30)
+                if frame is None:
+                    continue
 
-    # トラッキングオブジェクト情報を格納する配列
-    tracking_objects = []
+                self.wfile.write(
+                    f"--{PreviewServer.BOUNDARY}\r\n"
+                    f"Content-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(frame)}\r\n\r\n".encode())
+                self.wfile.write(frame)
+                self.wfile.write(b"\r\n")
+                self.wfile.flush()
 
-    frame_w = 0
-    frame_h = 0
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが切断した
+            pass
 
-    while True:
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+class RuntimeConfig:
+    """
+    設定ファイル(JSON)を監視し、変更されたら読み込み直して設定値(このファイルの定数)に反映します
+
+    設定ファイルに書かれていない設定値は定数の初期値に戻し、環境変数で指定された設定値は常に環境変数の値を使います
+    読み込みはメインループ(推論の合間)で行い、すべての設定値を確認してから一度に反映するので、
+    フレームの処理中に設定値が変わったり、一部の設定値だけが反映されたりすることはありません
+    設定ファイルに誤りがある場合は、それまでの設定値のまま処理を続けます
+    """
+
+    # 設定ファイルで変更できる設定値と型
+    KEYS = {
+        "MODEL_FILE_NAME" : str,
+        "CONF" : (int, float),
+        "IOU" : (int, float),
+        "CLASSES" : list,
+        "WARNING_SEC" : (int, float),
+        "ALERT_SEC" : (int, float),
+        "ALERT_COOLDOWN_SEC" : (int, float),
+        "ALERT_PUSH_ON_WARNING" : bool,
+        "OBJECT_RETENTION_TIME_SEC" : (int, float),
+    }
+
+    def __init__(self, path : str, interval_sec : float):
+        """
+        Args:
+            path (str)           : 設定ファイルのパス
+            interval_sec (float) : 変更を確認する間隔(秒)
+        """
+        self.path = path
+        self.interval_sec = interval_sec
+
+        # 定数の初期値
+        self._defaults = {k : globals()[k] for k in self.KEYS}
+
+        # 環境変数で指定された設定値
+        self._env = {k : self._convert(k, os.environ[k], from_env=True) for k in self.KEYS if k in os.environ}
+
+        # 最後に読み込んだ設定ファイルの更新時間とサイズ、確認した時間
+        self._stamp = None
+        self._checked = 0.0
+
+    def load(self):
+        """
+        設定ファイルを読み込んで反映します(起動時)
+        誤りがある場合は例外を送出します
+        """
+        self._checked = time.monotonic()
+        self._stamp = self._file_stamp()
+        self._apply(self._read())
+
+    def check(self) -> bool:
+        """
+        前回の確認からCONFIG_CHECK_INTERVAL_SEC以上経過していれば、設定ファイルが変更されたかどうかを確認し、
+        変更されていれば読み込み直して反映します
+
+        Returns:
+            bool : 設定値が変わった場合はTrue
+        """
+        now = time.monotonic()
+        if now - self._checked < self.interval_sec:
+            return False
+        self._checked = now
+
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
 
         try:
-            # ビデオ映像取得
-            frame = get_frame()
-            timestamp = int(datetime.now(tz=timezone.utc).timestamp())
-
-            # PLI Imageに変換
-            img = Image.open(BytesIO(frame))
-
-            # 画像サイズが変わったらモデルの最初期化を行う
-            if img.width != frame_w or img.height != frame_h:
-                model = YOLO(model=MODEL_FILE_PATH)
-                frame_w = img.width
-                frame_h = img.height
-                tracking_objects = []
-
-            # トラッキング実行
-            results = model.track(
-                img, 
-                conf=CONF, 
-                iou=IOU, 
-                persist=True,
-                classes=CLASSES, 
-                verbose=True)
-
-            # 結果を確認し、tracking_objects配列に格納する
-            parse_results(results, timestamp, tracking_objects)
-
-            # 結果を書き込んだJPEG画像の生成
-            frame = create_result_jpeg(img, tracking_objects)
-
-            # ALERT_SECを超えているオブジェクトがあればPush通知
-            if len([p for p in tracking_objects if p["stay_sec"] > ALERT_SEC]) > 0:
-
-                # PUSH通知
-                # エラーはここでキャッチしてそのまま処理を流す
-                try:
-                    push(timestamp, frame, tracking_objects)
-                except Exception as e:
-                    print(str(e))    
+            values = self._read()
+        except Exception as e:
+            print(f"Config not reloaded, keeping the current settings: {self.path}: {e}")
+            return False
 
+        print(f"Config reloaded: {self.path}")
+        return self._apply(values)
 
-            # 時間がたったオブジェクトは削除する
-            tracking_objects = [p for p in tracking_objects if timestamp - p["prev_timestamp"] < OBJECT_RETENTION_TIME_SEC]
+    def _file_stamp(self) -> tuple:
+        """
+        設定ファイルの更新時間とサイズを返します(ファイルがない場合はNone)
+        """
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
 
-            # 結果確認用のプレビューイメージの保存
-            with open(PREVIEW_IMAGE_PATH, 'wb') as f:
-                f.write(frame)
+    def _read(self) -> dict:
+        """
+        定数の初期値、設定ファイル、環境変数の順に重ねた設定値を返します
 
-            time.sleep(0.1)  # フレームレート制御
+        Returns:
+            dict : 設定値
+        """
+        values = dict(self._defaults)
 
-        except KeyboardInterrupt:
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("the config file must be a JSON object")
+
+            for k, v in data.items():
+                if k not in self.KEYS:
+                    raise ValueError(f"unknown setting: {k}")
+                if k in self._env:
+                    print(f"Config: {k} is set by the environment variable, ignoring the config file")
+                    continue
+                values[k] = self._convert(k, v)
+
+        values.update(self._env)
+
+        return values
+
+    def _convert(self, key : str, value, from_env : bool = False):
+        """
+        設定値の型を確認します
+        環境変数の値(文字列)は、文字列の設定値以外はJSONとして解釈します
+
+        Args:
+            key (str)       : 設定値の名前
+            value           : 値
+            from_env (bool) : 環境変数の値かどうか
+
+        Returns:
+            確認した値
+        """
+        types = self.KEYS[key] if isinstance(self.KEYS[key], tuple) else (self.KEYS[key],)
+
+        if from_env and str not in types:
+            value = json.loads(value)
+        if bool in types and value in (0, 1):
+            value = bool(value)
+
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ValueError(f"invalid value for {key}: {value!r}")
+        if isinstance(value, list) and not all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+            raise ValueError(f"invalid value for {key}: {value!r}")
+
+        return value
+
+    def _apply(self, values : dict) -> bool:
+        """
+        変わった設定値を反映し、ログに出力します
+
+        Args:
+            values (dict) : 設定値
+
+        Returns:
+            bool : 設定値が変わった場合はTrue
+        """
+        module = globals()
+        changed = {k : v for k, v in values.items() if module[k] != v}
+
+        for k, v in changed.items():
+            print(f"Config: {k} = {v!r} (was {module[k]!r})")
+
+        module.update(changed)
+
+        # モデルはパスが変わった場合だけ、次の推論で読み込む
+        if "MODEL_FILE_NAME" in changed:
+            module["MODEL_FILE_PATH"] = os.path.join(os.path.dirname(__file__), MODEL_FILE_NAME)
+
+        return len(changed) > 0
+
+
+class ModelManager:
+    """
+    読み込み済みのYOLOモデルを (モデルのパス, タスク) ごとに保持します
+
+    初めて使うモデルは読み込んだ直後にダミー画像で推論(ウォームアップ)してから返すので、
+    実際のフレームで初回推論の遅延が発生しません
+    推論する画像はモデルの入力サイズにレターボックス処理されるので、
+    フレームの画像サイズが切り替わっても、一度読み込んだモデルはそのまま再利用されます
+    """
+
+    def __init__(self, max_models : int = 2, input_size : int = 640):
+        """
+        Args:
+            max_models (int) : 保持するモデルの最大数(超えた場合は最も長く使われていないものを破棄)
+            input_size (int) : モデルの入力画像サイズ(ウォームアップに使うダミー画像の大きさ)
+        """
+        self.max_models = max_models
+        self.input_size = input_size
+        self._models = OrderedDict()
+
+        # 最初のモデルのウォームアップが完了したらセットされる
+        self.ready = threading.Event()
+
+    def get(self, model_path : str, task : str = "detect") -> YOLO:
+        """
+        モデルを取得します
+        保持していない場合は読み込んでウォームアップします
+
+        Args:
+            model_path (str) : モデルファイルのパス
+            task (str)       : タスク("detect"など)
+
+        Returns:
+            YOLO : ウォームアップ済みのモデル
+        """
+        key = (model_path, task)
+
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+
+        start = time.monotonic()
+
+        model = YOLO(model=model_path, task=task)
+
+        # ダミー画像で推論してウォームアップ
+        model.predict(Image.new("RGB", (self.input_size, self.input_size)), verbose=False)
+
+        print(f"Model loaded: {model_path} ({time.monotonic() - start:.1f} sec)")
+
+        self._models[key] = model
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+
+        if not self.ready.is_set():
+            self.ready.set()
+            print("Model ready")
+
+        return model
+
+
+class TrackerState:
+    """
+    トラッカーの状態
+
+    model.track()はトラッカーをモデルの中に保持するため、モデルを読み込み直すと追跡中のIDが失われます
+    このクラスはトラッカーをモデルとは別に保持し、model.predict()の結果に対して
+    model.track()と同じ処理でトラッキングIDを付与します
+    """
+
+    def __init__(self, config : str = TRACKER_CONFIG):
+        """
+        Args:
+            config (str) : トラッカーの設定ファイル
+        """
+        self.cfg = IterableSimpleNamespace(**yaml_load(check_yaml(config)))
+        self.reset()
+
+    def reset(self):
+        """
+        追跡中の情報を破棄して、トラッカーを初期化します
+        """
+        self.tracker = TRACKER_MAP[self.cfg.tracker_type](args=self.cfg, frame_rate=30)
+
+    def update(self, results : list) -> list:
+        """
+        predictの結果でトラッカーを更新し、追跡できたBOXにIDを付与します
+        (ultralyticsのon_predict_postprocess_endと同じ処理)
+        検出がないフレームでもトラッカーを更新し、見失ったオブジェクトの経過フレーム数を進めます
+        (更新しないと、検出がない間はtrack_bufferによる破棄が止まり、
+        長時間後に同じ場所に現れた別のオブジェクトに古いIDが付与されてしまう)
+
+        Args:
+            results (list) : predictの結果リスト
+
+        Returns:
+            list : IDが付与された結果リスト(trackの結果と同じ形式)
+        """
+        result = results[0]
+
+        det = result.boxes.cpu().numpy()
+
+        tracks = self.tracker.update(det, result.orig_img)
+        if len(tracks) == 0:
+            return results
+
+        idx = tracks[:, -1].astype(int)
+        results[0] = result[idx]
+        results[0].update(boxes=torch.as_tensor(tracks[:, :-1]))
+
+        return results
+
+
+class LatestSlot:
+    """
+    値を1つだけ保持するスレッド間の受け渡し場所
+
+    取り出される前に新しい値がput()された場合、古い値は破棄されます(最新の値が優先)
+    ただし、保持している値よりpriorityが低い値は破棄する側になります
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._priority = 0
+        self._has_item = False
+
+        # 取り出される前に破棄された値の数
+        self.dropped = 0
+
+    def put(self, item, priority : int = 0) -> bool:
+        """
+        値を置きます
+
+        Args:
+            item           : 受け渡す値
+            priority (int) : 優先度(保持中の値より低い場合は置かずに破棄する)
+
+        Returns:
+            bool : 置けた場合はTrue
+        """
+        with self._cond:
+            if self._has_item:
+                self.dropped += 1
+                if priority < self._priority:
+                    return False
+
+            self._item = item
+            self._priority = priority
+            self._has_item = True
+            self._cond.notify_all()
+
+        return True
+
+    def get(self, timeout : float = None):
+        """
+        値を取り出します
+        値が置かれていない場合は、置かれるまで待ちます
+
+        Args:
+            timeout (float) : 待つ最大時間(秒)、Noneの場合は無制限
+
+        Returns:
+            取り出した値、タイムアウトした場合はNone
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._has_item, timeout=timeout):
+                return None
+
+            item = self._item
+            self._item = None
+            self._priority = 0
+            self._has_item = False
+
+            return item
+
+
+class Stage:
+    """
+    パイプラインの処理段
+    busy()で囲んだ処理の時間を積算して、稼働率(occupancy)を計算します
+    直近の処理時間も保持して、パーセンタイルを返します
+    """
+
+    def __init__(self, name : str, samples : int = STAGE_LATENCY_SAMPLES):
+        """
+        Args:
+            name (str)    : 処理段の名前
+            samples (int) : パーセンタイルの計算に使う直近の処理時間のサンプル数
+        """
+        self.name = name
+        self.count = 0
+        self._lock = threading.Lock()
+        self._busy_sec = 0.0
+        self._start = time.monotonic()
+        self._samples = deque(maxlen=samples)
+
+    @contextmanager
+    def busy(self):
+        """
+        処理時間を計測するコンテキストマネージャ
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._busy_sec += elapsed
+                self._samples.append(elapsed)
+                self.count += 1
+
+    def occupancy(self) -> float:
+        """
+        前回の呼び出しから今回までの稼働率を返します
+
+        Returns:
+            float : 稼働率(0.0 ~ 1.0)
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._start
+            res = self._busy_sec / elapsed if elapsed > 0 else 0.0
+            self._busy_sec = 0.0
+            self._start = now
+
+        return round(min(res, 1.0), 3)
+
+    def latency(self) -> dict:
+        """
+        直近の処理時間のパーセンタイルを返します
+
+        Returns:
+            dict : p50/p90/p99/max(ミリ秒)
+        """
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64) * 1000.0
+
+        if len(samples) == 0:
+            return {"p50" : 0.0, "p90" : 0.0, "p99" : 0.0, "max" : 0.0}
+
+        p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+        return {
+            "p50" : round(float(p50), 1),
+            "p90" : round(float(p90), 1),
+            "p99" : round(float(p99), 1),
+            "max" : round(float(samples.max()), 1)
+        }
+
+
+class Metrics:
+    """
+    処理段ごとの処理時間と、フレーム数などの件数を計測します
+
+    処理時間は直近のサンプルからパーセンタイル(quantile)を計算し、合計と回数は起動時からの累計を返します
+    Prometheusのテキスト形式(summaryとcounter)で出力できます
+    """
+
+    # 計測する処理段
+    STAGES = ("acquire", "decode", "inference", "track", "parse", "propagate", "draw", "encode", "push", "preview", "sleep")
+
+    # 数える件数
+    COUNTERS = ("frames", "detections", "skipped", "propagated", "suppressed", "errors")
+
+    # 出力するパーセンタイル
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, samples : int = STAGE_LATENCY_SAMPLES):
+        """
+        Args:
+            samples (int) : パーセンタイルの計算に使う直近の処理時間のサンプル数
+        """
+        self._lock = threading.Lock()
+        self._samples = {s : deque(maxlen=samples) for s in self.STAGES}
+        self._sum = {s : 0.0 for s in self.STAGES}
+        self._count = {s : 0 for s in self.STAGES}
+        self._counters = {c : 0 for c in self.COUNTERS}
+
+    @contextmanager
+    def measure(self, stage : str):
+        """
+        処理時間を計測するコンテキストマネージャ
+
+        Args:
+            stage (str) : 処理段の名前(STAGESのいずれか)
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def observe(self, stage : str, sec : float):
+        """
+        処理時間を記録します
+
+        Args:
+            stage (str) : 処理段の名前(STAGESのいずれか)
+            sec (float) : 処理時間(秒)
+        """
+        with self._lock:
+            self._samples[stage].append(sec)
+            self._sum[stage] += sec
+            self._count[stage] += 1
+
+    def inc(self, name : str, value : int = 1):
+        """
+        件数を加算します
+
+        Args:
+            name (str)  : 件数の名前(COUNTERSのいずれか)
+            value (int) : 加算する数
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def prometheus(self) -> str:
+        """
+        計測値をPrometheusのテキスト形式で返します
+
+        Returns:
+            str : Prometheusのテキスト形式
+        """
+        with self._lock:
+            samples = {s : np.array(self._samples[s], dtype=np.float64) for s in self.STAGES}
+            sums = dict(self._sum)
+            counts = dict(self._count)
+            counters = dict(self._counters)
+
+        lines = [
+            "# HELP aicap_stage_seconds Processing time of each stage (quantiles over recent samples).",
+            "# TYPE aicap_stage_seconds summary"
+        ]
+        for stage in self.STAGES:
+            values = np.quantile(samples[stage], self.QUANTILES) if len(samples[stage]) > 0 else [float("nan")] * len(self.QUANTILES)
+            for q, v in zip(self.QUANTILES, values):
+                lines.append(f'aicap_stage_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'aicap_stage_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'aicap_stage_seconds_count{{stage="{stage}"}} {counts[stage]}')
+
+        for name in self.COUNTERS:
+            lines.append(f"# TYPE aicap_{name}_total counter")
+            lines.append(f"aicap_{name}_total {counters[name]}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path : str):
+        """
+        計測値をPrometheusのテキスト形式でファイルに書き出します
+        一時ファイルに書いてから置き換えるので、読み込む側が書きかけのファイルを読むことはありません
+
+        Args:
+            path (str) : 書き出すファイルのパス
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+# 処理時間と件数の計測
+# 各スレッドから記録するので、モジュールで1つだけ作成する
+metrics = Metrics()
+
+
+class FrameScheduler:
+    """
+    フレームレートを制御します
+
+    物体を検出している間はactive_fpsで、検出がない状態がidle_after_sec続いたらidle_fpsで動作します
+    アイドル中に物体を検出した場合は、待ちを打ち切ってすぐにactive_fpsに戻ります
+    1フレームの処理にかかった時間を差し引いた残りの時間だけ待つので、処理時間に関係なく目標のフレームレートになります
+    """
+
+    def __init__(self, active_fps : float, idle_fps : float, idle_after_sec : float):
+        """
+        Args:
+            active_fps (float)     : 物体を検出している間のフレームレート
+            idle_fps (float)       : 物体を検出していない間のフレームレート
+            idle_after_sec (float) : 検出がなくなってからアイドルに切り替えるまでの時間(秒)
+        """
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.idle_after_sec = idle_after_sec
+
+        self._last_active = time.monotonic()
+        self._wake = threading.Event()
+
+    @property
+    def idle(self) -> bool:
+        """
+        アイドル中かどうか
+        """
+        return time.monotonic() - self._last_active >= self.idle_after_sec
+
+    def interval(self) -> float:
+        """
+        現在のフレーム間隔を返します
+
+        Returns:
+            float : フレーム間隔(秒)
+        """
+        return 1.0 / (self.idle_fps if self.idle else self.active_fps)
+
+    def set_active(self, active : bool):
+        """
+        物体を検出しているかどうかを通知します
+
+        Args:
+            active (bool) : 物体を検出している場合はTrue
+        """
+        if not active:
+            return
+
+        was_idle = self.idle
+        self._last_active = time.monotonic()
+
+        # アイドル中の待ちを打ち切る
+        if was_idle:
+            self._wake.set()
+
+    def wait(self, start : float):
+        """
+        startから現在のフレーム間隔が経過するまで待ちます
+
+        Args:
+            start (float) : 処理を開始した時間(time.monotonic())
+        """
+        while True:
+            remaining = start + self.interval() - time.monotonic()
+            if remaining <= 0:
+                return
+
+            if self._wake.wait(remaining):
+                self._wake.clear()
+
+    def stats(self) -> dict:
+        """
+        現在の動作状態を返します
+
+        Returns:
+            dict : mode("active" または "idle"), fps(目標フレームレート)
+        """
+        idle = self.idle
+        return {"mode" : "idle" if idle else "active", "fps" : self.idle_fps if idle else self.active_fps}
+
+
+class Backoff:
+    """
+    エラーが続いた場合の待ち時間を、最小値から倍々で最大値まで延ばします
+    """
+
+    def __init__(self, min_sec : float, max_sec : float):
+        """
+        Args:
+            min_sec (float) : 最初のエラーでの待ち時間(秒)
+            max_sec (float) : 待ち時間の上限(秒)
+        """
+        self.min_sec = min_sec
+        self.max_sec = max_sec
+        self._count = 0
+
+    def failed(self) -> float:
+        """
+        エラーを記録し、次に待つ時間を返します
+
+        Returns:
+            float : 待ち時間(秒)
+        """
+        wait = min(self.min_sec * (2 ** self._count), self.max_sec)
+        self._count = min(self._count + 1, 16)
+        return wait
+
+    def reset(self):
+        """
+        成功したので待ち時間を最小値に戻します
+        """
+        self._count = 0
+
+
+class ClipRecorder:
+    """
+    検知した前後の映像(クリップ)を保存します
+
+    直近のフレームを取得したJPEGのままリングバッファに保持しておき(デコードもエンコードもしない)、
+    trigger()が呼ばれたら、その前のCLIP_PRE_SEC秒と後のCLIP_POST_SEC秒のフレームを1つのファイルに書き込みます
+    リングバッファは保持する時間と合計サイズの両方で上限を設け、超えた分は古いフレームから捨てます
+
+    クリップはJPEGを連結したMJPEGファイル(.mjpeg)と、各フレームの位置と時間を記録したインデックス(.json)です
+    (MJPEGファイルは ffplay -f mjpeg などで再生できます)
+    """
+
+    def __init__(self, clip_dir : str, name : str, pre_sec : float, post_sec : float,
+                 max_bytes : int, max_sec : float, keep_count : int):
+        """
+        Args:
+            clip_dir (str)   : クリップの保存先ディレクトリ
+            name (str)       : ファイル名に含める名前(空の場合は含めない)
+            pre_sec (float)  : 検知より前に含める時間(秒)
+            post_sec (float) : 検知より後に含める時間(秒)
+            max_bytes (int)  : 保持するフレームの合計サイズの上限(バイト)
+            max_sec (float)  : 検知が続いた場合に延長するクリップの最大の長さ(秒)
+            keep_count (int) : 保存しておくクリップの数(0の場合は削除しない)
+        """
+        self.clip_dir = clip_dir
+        self.name = name
+        self.pre_sec = pre_sec
+        self.post_sec = post_sec
+        self.max_bytes = max_bytes
+        self.max_sec = max_sec
+        self.keep_count = keep_count
+
+        self._lock = threading.Lock()
+
+        # 直近のフレーム (JPEG, 時間(Unixtime), 取得した時間(time.monotonic())) と合計サイズ
+        self._frames = deque()
+        self._bytes = 0
+
+        # 書き込み待ちのクリップ(検知の後のフレームを集めている間だけ)
+        self._clip = None
+
+        # 最後にクリップに含めたフレームの取得時間(続けて検知した場合に、同じフレームを重複して保存しない)
+        self._last_captured = 0.0
+
+        self._counters = {"triggers" : 0, "clips" : 0, "frames" : 0, "bytes" : 0, "errors" : 0}
+
+        os.makedirs(clip_dir, exist_ok=True)
+
+    def add(self, frame : bytes, timestamp : float, captured : float):
+        """
+        フレームをリングバッファに追加します
+        (Pipelineの取得スレッドから呼ばれます)
+
+        Args:
+            frame (bytes)     : カメラフレーム画像(JPEG)
+            timestamp (float) : 時間(Unixtime)
+            captured (float)  : 取得した時間(time.monotonic())
+        """
+        done = None
+
+        with self._lock:
+            self._frames.append((frame, timestamp, captured))
+            self._bytes += len(frame)
+
+            # 時間とサイズの上限を超えた古いフレームを捨てる
+            while len(self._frames) > 1 and (
+                    captured - self._frames[0][2] > self.pre_sec or self._bytes > self.max_bytes):
+                old = self._frames.popleft()
+                self._bytes -= len(old[0])
+
+            clip = self._clip
+            if clip is not None:
+                clip["frames"].append((frame, timestamp, captured))
+                clip["bytes"] += len(frame)
+
+                # 検知の後の時間が過ぎたか、サイズの上限を超えたら書き込む
+                if captured >= clip["end"] or clip["bytes"] > self.max_bytes:
+                    done, self._clip = clip, None
+                    self._last_captured = captured
+
+        if done is not None:
+            # 書き込みは別のスレッドで行い、フレームの取得を止めない
+            threading.Thread(target=self._write, args=(done,), daemon=True).start()
+
+    def trigger(self, captured : float = None):
+        """
+        クリップの保存を開始します
+        既に検知の後のフレームを集めている場合は、CLIP_MAX_SECを上限に終わりを延長します
+
+        Args:
+            captured (float) : 検知したフレームを取得した時間(time.monotonic())、省略した場合は現在
+        """
+        if captured is None:
+            captured = time.monotonic()
+
+        with self._lock:
+            self._counters["triggers"] += 1
+
+            clip = self._clip
+            if clip is not None:
+                clip["end"] = min(max(clip["end"], captured + self.post_sec), clip["start"] + self.max_sec)
+                return
+
+            # 検知より前のフレーム(前のクリップに含めたフレームは除く)
+            # 取得スレッドは推論より先に進んでいるので、検知より後のフレームも既に含まれている
+            start = max(captured - self.pre_sec, self._last_captured)
+            frames = [f for f in self._frames if f[2] > start]
+            if len(frames) == 0:
+                start = captured
+
+            self._clip = {
+                "event" : time.time() - (time.monotonic() - captured),
+                "start" : start,
+                "end" : captured + self.post_sec,
+                "frames" : frames,
+                "bytes" : sum(len(f[0]) for f in frames),
+            }
+
+    def close(self):
+        """
+        書き込み待ちのクリップがあれば、そこまでのフレームで書き込みます
+        """
+        with self._lock:
+            done, self._clip = self._clip, None
+            if done is not None and len(done["frames"]) > 0:
+                self._last_captured = done["frames"][-1][2]
+
+        if done is not None:
+            self._write(done)
+
+    def stats(self) -> dict:
+        """
+        保持しているフレームと、保存したクリップの統計を返します
+
+        Returns:
+            dict : buffered_frames / buffered_bytes / buffered_sec(保持しているフレーム)、
+                   triggers(検知の回数)、clips / frames / bytes(保存したクリップ)、errors(書き込みに失敗した数)
+        """
+        with self._lock:
+            return dict(
+                self._counters,
+                buffered_frames=len(self._frames),
+                buffered_bytes=self._bytes,
+                buffered_sec=round(self._frames[-1][2] - self._frames[0][2], 1) if len(self._frames) > 0 else 0.0)
+
+    def _write(self, clip : dict):
+        """
+        クリップをファイルに書き込みます
+        フレームは連結せずに1回の連続した書き込み(writev)で書き込み、書き終わってからファイル名を変えます
+
+        Args:
+            clip (dict) : 書き込むクリップ
+        """
+        frames = clip["frames"]
+        if len(frames) == 0:
+            return
+
+        t = datetime.fromtimestamp(clip["event"])
+        base = t.strftime("%Y%m%d-%H%M%S") + f"-{t.microsecond // 1000:03d}" + (f"_{self.name}" if self.name else "")
+        path = os.path.join(self.clip_dir, base)
+
+        # インデックス (ファイル内の位置, サイズ, 時間(Unixtime))
+        index = []
+        offset = 0
+        for frame, timestamp, _ in frames:
+            index.append([offset, len(frame), round(timestamp, 3)])
+            offset += len(frame)
+
+        start = time.monotonic()
+        try:
+            fd = os.open(path + ".mjpeg.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                buffers = [f[0] for f in frames]
+                # 一度に渡せるバッファの数には上限がある
+                iov_max = os.sysconf("SC_IOV_MAX")
+                for i in range(0, len(buffers), iov_max):
+                    chunk = buffers[i:i + iov_max]
+                    written = os.writev(fd, chunk)
+                    if written != sum(len(b) for b in chunk):
+                        raise OSError(f"Short write to {path}.mjpeg")
+            finally:
+                os.close(fd)
+
+            with open(path + ".json.tmp", "w") as f:
+                json.dump({"camera" : self.name, "event" : round(clip["event"], 3), "frames" : index}, f)
+
+            os.replace(path + ".mjpeg.tmp", path + ".mjpeg")
+            os.replace(path + ".json.tmp", path + ".json")
+
+        except OSError as e:
+            print(f"Failed to write clip: {e}")
+            with self._lock:
+                self._counters["errors"] += 1
+            return
+
+        print(f"Clip saved: {path}.mjpeg ({len(frames)} frames, {offset} bytes, {(time.monotonic() - start) * 1000:.0f} ms)")
+
+        with self._lock:
+            self._counters["clips"] += 1
+            self._counters["frames"] += len(frames)
+            self._counters["bytes"] += offset
+
+        self._remove_old()
+
+    def _remove_old(self):
+        """
+        保存しておく数を超えたクリップを、古いものから削除します
+        (複数のカメラで同じディレクトリを使う場合は、このカメラのクリップだけを数える)
+        """
+        if self.keep_count <= 0:
+            return
+
+        suffix = f"_{self.name}.mjpeg" if self.name else ".mjpeg"
+        try:
+            clips = sorted(f for f in os.listdir(self.clip_dir)
+                           if f.endswith(suffix) and (self.name or "_" not in f))
+        except OSError:
+            return
+
+        for f in clips[:-self.keep_count]:
+            base = os.path.join(self.clip_dir, f[:-len(".mjpeg")])
+            for ext in (".mjpeg", ".json"):
+                try:
+                    os.remove(base + ext)
+                except OSError:
+                    pass
+
+
+class EventStore:
+    """
+    検知の記録(検知していた期間とアラート)をSQLiteのデータベースに保存します
+
+    add()は行をキューに積むだけで、書き込みはワーカースレッドがまとめて1つのトランザクションで行います
+    (推論のループで書き込みを待つことはありません)
+    データベースはWALモードで開くので、書き込み中でも tools/events/events.py で集計できます
+
+    events テーブル
+        kind       : "detection"(検知していた期間) / "alert"(アラート) / "warning"(警告)
+        camera     : カメラの名前
+        cls        : 検出クラス
+        track      : トラッキングID(トラッキングしない場合はNULL)
+        start_time : 開始時間(Unixtime)
+        end_time   : 終了時間(Unixtime)
+        frames     : 検知したフレーム数(数えていない場合はNULL)
+        conf       : 検出信頼度
+        stay_sec   : 静止時間(秒)(静止時間を数えていない場合はNULL)
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            camera TEXT NOT NULL,
+            cls INTEGER NOT NULL,
+            track INTEGER,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            frames INTEGER,
+            conf REAL,
+            stay_sec REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS events_start_time ON events (start_time)",
+        "CREATE INDEX IF NOT EXISTS events_cls_start_time ON events (cls, start_time)",
+        "CREATE INDEX IF NOT EXISTS events_track ON events (track)",
+    )
+
+    INSERT = ("INSERT INTO events (kind, camera, cls, track, start_time, end_time, frames, conf, stay_sec) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, path : str, flush_interval_sec : float, batch_size : int, queue_size : int):
+        """
+        Args:
+            path (str)                 : データベースファイルのパス
+            flush_interval_sec (float) : 書き込む間隔(秒)
+            batch_size (int)           : この数の行がたまったら、間隔を待たずに書き込む
+            queue_size (int)           : 書き込み待ちの行の上限(超えた場合は古い行から破棄する)
+        """
+        self.path = path
+        self.flush_interval_sec = flush_interval_sec
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+        # 開けない場合は起動時にエラーにする
+        # 接続はワーカースレッドだけが使う
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for sql in self.SCHEMA:
+                self._conn.execute(sql)
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._counters = {"queued" : 0, "written" : 0, "dropped" : 0, "errors" : 0}
+
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def add(self, kind : str, camera : str, cls : int, start_time : float, end_time : float,
+            track : int = None, frames : int = None, conf : float = None, stay_sec : float = None):
+        """
+        記録する行をキューに積みます
+
+        Args:
+            kind (str)         : 種類("detection" / "alert" / "warning")
+            camera (str)       : カメラの名前
+            cls (int)          : 検出クラス
+            start_time (float) : 開始時間(Unixtime)
+            end_time (float)   : 終了時間(Unixtime)
+            track (int)        : トラッキングID
+            frames (int)       : 検知したフレーム数
+            conf (float)       : 検出信頼度
+            stay_sec (float)   : 静止時間(秒)
+        """
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                self._queue.popleft()
+                self._counters["dropped"] += 1
+
+            self._queue.append((kind, camera, cls, track, start_time, end_time, frames, conf, stay_sec))
+            self._counters["queued"] += 1
+
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def close(self):
+        """
+        書き込み待ちの行を書き込んで、データベースを閉じます
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        self._thread.join(10)
+
+    def stats(self) -> dict:
+        """
+        書き込みの統計を返します
+
+        Returns:
+            dict : queued, written, dropped, errors と pending(書き込み待ちの数)
+        """
+        with self._cond:
+            return dict(self._counters, pending=len(self._queue))
+
+    def _worker(self):
+        """
+        キューに積まれた行をまとめて書き込むスレッド関数
+        """
+        while True:
+            with self._cond:
+                if not self._closed and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.flush_interval_sec)
+
+                rows = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+
+            if len(rows) > 0:
+                try:
+                    with self._conn:
+                        self._conn.executemany(self.INSERT, rows)
+
+                    with self._cond:
+                        self._counters["written"] += len(rows)
+
+                except sqlite3.Error as e:
+                    print(f"Failed to write events: {e}")
+                    with self._cond:
+                        self._counters["errors"] += 1
+
+            if closed:
+                self._conn.close()
+                return
+
+
+class Pipeline:
+    """
+    フレーム取得 / 推論 / 結果の公開 を並行して行うパイプライン
+
+    capture スレッド : FrameSourceからフレームを取得して入力スロットに置く
+    推論(呼び出し元) : next_frame()で最新のフレームを取り出して推論し、結果をpublish()に渡す
+    publish スレッド : publish()に渡された結果をpublish_funcで処理する(描画、JPEG生成、Push通知、プレビュー保存)
+
+    フレームN+1の取得と、フレームN-1の公開が、フレームNの推論と並行して行われます
+    各スロットは1つしか値を持たないので、推論は常に最新のフレームで行われます
+    """
+
+    def __init__(self, source : FrameSource, publish_func, scheduler : FrameScheduler, on_frame = None,
+                 clip : ClipRecorder = None):
+        """
+        Args:
+            source (FrameSource)       : フレームの取得元
+            publish_func               : 推論結果を受け取って公開する関数
+            scheduler (FrameScheduler) : フレーム取得のタイミングを決めるスケジューラ
+            on_frame                   : 新しいフレームを取得するたびに呼ばれる関数(省略可)
+            clip (ClipRecorder)        : 取得したフレームを保持するクリップの保存(省略可)
+        """
+        self.source = source
+        self.publish_func = publish_func
+        self.scheduler = scheduler
+        self.on_frame = on_frame
+        self.clip = clip
+
+        self.capture_stage = Stage("capture")
+        self.inference_stage = Stage("inference")
+        self.publish_stage = Stage("publish")
+
+        self._frames = LatestSlot()
+        self._results = LatestSlot()
+
+        # next_frame()で取り出したフレームを取得した時間(time.monotonic())
+        self.captured = 0.0
+
+    def start(self):
+        """
+        取得スレッドと公開スレッドを開始します
+        """
+        threading.Thread(target=self._capture_loop, daemon=True).start()
+        threading.Thread(target=self._publish_loop, daemon=True).start()
+
+    def next_frame(self, timeout : float = None) -> tuple:
+        """
+        最新のフレームを取り出します
+        新しいフレームが取得されるまで待ちます
+
+        Args:
+            timeout (float) : 待つ最大時間(秒)、Noneの場合は無制限
+
+        Returns:
+            tuple : (カメラフレーム画像(JPEG), 取得時間(Unixtime))、タイムアウトした場合はNone
+                    (取得した時間はcapturedに設定される)
+        """
+        item = self._frames.get(timeout)
+        if item is None:
+            return None
+
+        frame, timestamp, self.captured = item
+        return frame, timestamp
+
+    def publish(self, item, priority : int = 0):
+        """
+        推論結果を公開スレッドに渡します
+
+        Args:
+            item           : publish_funcに渡す値
+            priority (int) : 優先度(Push通知を伴う結果は、伴わない結果で上書きされないよう高くする)
+        """
+        self._results.put(item, priority)
+
+    def stats(self) -> dict:
+        """
+        各処理段の稼働率と処理時間、破棄されたフレーム数を返します
+
+        Returns:
+            dict : 推論したフレーム数(frames)、稼働率(occupancy)、処理時間(latency_ms)と破棄数(dropped)
+        """
+        stages = (self.capture_stage, self.inference_stage, self.publish_stage)
+        return {
+            "frames" : self.inference_stage.count,
+            "occupancy" : {s.name : s.occupancy() for s in stages},
+            "latency_ms" : {s.name : s.latency() for s in stages},
+            "dropped" : {"capture" : self._frames.dropped, "publish" : self._results.dropped}
+        }
+
+    def _capture_loop(self):
+        """
+        フレームを取得し続けるスレッド関数
+        """
+        backoff = Backoff(ERROR_RETRY_INTERVAL_SEC, ERROR_RETRY_INTERVAL_MAX_SEC)
+
+        while True:
+            start = time.monotonic()
+
+            try:
+                with self.capture_stage.busy(), metrics.measure("acquire"):
+                    frame = self.source.read()
+                captured = time.monotonic()
+                timestamp = int(datetime.now(tz=timezone.utc).timestamp())
+
+                self._frames.put((frame, timestamp, captured))
+                backoff.reset()
+
+                # 推論で間引かれるフレームも含めて、すべてのフレームを保持する
+                if self.clip is not None:
+                    self.clip.add(frame, time.time(), captured)
+
+                if self.on_frame is not None:
+                    self.on_frame()
+
+            except Exception as e:
+                print(str(e))
+                metrics.inc("errors")
+                time.sleep(backoff.failed())
+
+            # フレームレート制御
+            # 処理にかかった時間を差し引いた残りの時間だけ待つ
+            with metrics.measure("sleep"):
+                self.scheduler.wait(start)
+
+    def _publish_loop(self):
+        """
+        推論結果を公開し続けるスレッド関数
+        """
+        while True:
+            item = self._results.get()
+
+            try:
+                with self.publish_stage.busy():
+                    self.publish_func(item)
+
+            except Exception as e:
+                print(str(e))
+                metrics.inc("errors")
+
+
+class FrameCollector:
+    """
+    複数のカメラのパイプラインから、新しいフレームをまとめて取り出します
+    各パイプラインのon_frameにnotify()を設定して使います
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def notify(self):
+        """
+        新しいフレームが取得されたことを通知します
+        """
+        self._event.set()
+
+    def collect(self, cameras : list) -> list:
+        """
+        いずれかのカメラで新しいフレームが取得されるまで待ち、
+        その時点で取得済みの各カメラの最新フレームをすべて取り出します
+
+        Args:
+            cameras (list) : Cameraのリスト
+
+        Returns:
+            list : (Camera, カメラフレーム画像(JPEG), 取得時間(Unixtime)) のリスト
+        """
+        while True:
+            self._event.wait()
+            self._event.clear()
+
+            batch = []
+            for camera in cameras:
+                item = camera.pipeline.next_frame(timeout=0)
+                if item is not None:
+                    batch.append((camera, *item))
+
+            if len(batch) > 0:
+                return batch
+
+
+class BatchPredictor:
+    """
+    複数の画像を1回のpredictでまとめて推論します
+
+    バッチ推論に対応していないモデル(NCNNなど、先頭の画像の結果しか返らない)の場合は、
+    最初の推論で検出して、以降は1枚ずつ推論します
+    """
+
+    def __init__(self):
+        self.batched = True
+
+    def predict(self, model : YOLO, imgs : list, **kwargs) -> list:
+        """
+        画像のリストを推論します
+
+        Args:
+            model (YOLO)  : モデル
+            imgs (list)   : PIL Imageのリスト
+            **kwargs      : predictの引数
+
+        Returns:
+            list : imgsと同じ順番の推論結果のリスト
+        """
+        if self.batched and len(imgs) > 1:
+            results = model.predict(imgs, **kwargs)
+            if len(results) == len(imgs):
+                return results
+
+            self.batched = False
+            print("Batched inference is not supported by this model, predicting one image at a time")
+
+        results = []
+        for img in imgs:
+            results += model.predict(img, **kwargs)
+
+        return results
+
+
+class DetectionBatch:
+    """
+    1フレーム分の検出結果をNumPy配列でまとめて保持します
+
+    YOLOの結果からBOXごとにtolist()で取り出す代わりに、全BOXを一度に配列として取り出します
+    Push通知などで従来の形式が必要な場合は to_list() で変換します
+    """
+
+    __slots__ = ("xyxy", "pos", "conf", "cls", "id")
+
+    def __init__(self, xyxy : np.ndarray, conf : np.ndarray, cls : np.ndarray, id : np.ndarray = None):
+        """
+        Args:
+            xyxy (ndarray) : BOX座標 (N, 4) [x1, y1, x2, y2]
+            conf (ndarray) : 検出信頼度 (N,)
+            cls (ndarray)  : 検出クラス (N,)
+            id (ndarray)   : トラッキングID (N,)、トラッキングしていない場合はNone
+        """
+        self.xyxy = xyxy.astype(int)
+        self.conf = conf
+        self.cls = cls.astype(int)
+        self.id = id.astype(int) if id is not None else None
+
+        # 検出物体の中心座標 (N, 2) [x, y]
+        self.pos = (self.xyxy[:, :2] + (self.xyxy[:, 2:] - self.xyxy[:, :2]) / 2).astype(int)
+
+    @classmethod
+    def from_results(cls, results : list, scale : tuple = (1.0, 1.0)) -> "DetectionBatch":
+        """
+        predict / trackの結果から生成します
+        並び順はparse_resultsの従来の処理に合わせて逆順にします
+
+        Args:
+            results (list) : predict / trackの結果リスト
+            scale (tuple)  : BOX座標に掛ける倍率(横, 縦)、縮小デコードした画像の座標を元の解像度に戻す
+
+        Returns:
+            DetectionBatch : 検出結果
+        """
+        boxes = results[0].boxes
+
+        return cls(
+            boxes.xyxy.cpu().numpy()[::-1] * np.array([scale[0], scale[1], scale[0], scale[1]]),
+            boxes.conf.cpu().numpy()[::-1],
+            boxes.cls.cpu().numpy()[::-1],
+            boxes.id.cpu().numpy()[::-1] if boxes.id is not None else None)
+
+    @classmethod
+    def empty(cls) -> "DetectionBatch":
+        """
+        検出なしの結果を生成します
+
+        Returns:
+            DetectionBatch : 空の検出結果
+        """
+        return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0))
+
+    def __len__(self) -> int:
+        return len(self.xyxy)
+
+    def to_list(self) -> list:
+        """
+        以下の形の辞書のリストに変換します
+
+        {
+            "pos"  : {"x" : x, "y" : y}, <= 検出物体中心座標
+            "box"  : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2}, <= BOX座標
+            "conf" : 検出信頼度[confidence score](0.0 ~ 1.0),
+            "cls"  : 検出クラス
+        }
+
+        Returns:
+            list : 変換した結果のリスト
+        """
+        return [
+            {
+                "pos" : {"x" : x, "y" : y},
+                "box" : {"x1" : x1, "y1" : y1, "x2" : x2, "y2" : y2},
+                "conf" : conf,
+                "cls" : cls
+            }
+            for (x, y), (x1, y1, x2, y2), conf, cls
+            in zip(self.pos.tolist(), self.xyxy.tolist(), self.conf.tolist(), self.cls.tolist())
+        ]
+
+
+class MotionGate:
+    """
+    シーンに変化がないフレームの推論を省略するための判定を行います
+
+    次の場合は変化なしと判断します(最後に推論したフレームと比較)
+    - JPEGのデータのハッシュが同じ
+    - 縮小したグレースケール画像で、輝度がpixel_threshold以上変化した画素の割合がarea_threshold未満
+    ただし、最後に推論してからforce_interval_sec以上経過した場合は、変化がなくても推論します
+    """
+
+    # 比較に使う縮小画像の幅(高さは縦横比から決める)
+    WIDTH = 160
+
+    def __init__(self, pixel_threshold : int, area_threshold : float, force_interval_sec : float):
+        """
+        Args:
+            pixel_threshold (int)      : 変化したとみなす輝度の差(0 ~ 255)
+            area_threshold (float)     : 変化ありと判断する、変化した画素の割合(0.0 ~ 1.0)
+            force_interval_sec (float) : 変化がなくても推論する間隔(秒)
+        """
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.force_interval_sec = force_interval_sec
+
+        # 最後に推論したフレームの情報
+        self._digest = None
+        self._gray = None
+        self._last_run = 0.0
+
+        # 統計情報
+        self._counters = {"frames" : 0, "skipped_hash" : 0, "skipped_motion" : 0}
+
+    def check(self, frame : bytes, img : Image) -> bool:
+        """
+        推論が必要かどうかを判定します
+        推論が必要と判定したフレームは、次回以降の比較対象になります
+
+        Args:
+            frame (bytes) : カメラフレーム画像(JPEG)
+            img (Image)   : frameをデコードしたPIL Image
+
+        Returns:
+            bool : 推論が必要な場合はTrue
+        """
+        self._counters["frames"] += 1
+
+        now = time.monotonic()
+        forced = now - self._last_run >= self.force_interval_sec
+
+        # 全く同じフレーム
+        digest = hashlib.blake2b(frame, digest_size=16).digest()
+        if not forced and digest == self._digest:
+            self._counters["skipped_hash"] += 1
+            return False
+
+        # 縮小したグレースケール画像で差分を比較
+        size = (self.WIDTH, max(1, round(self.WIDTH * img.height / img.width)))
+        gray = np.asarray(img.convert("L").resize(size, Image.BOX), dtype=np.int16)
+
+        if not forced and self._gray is not None and self._gray.shape == gray.shape:
+            changed = np.count_nonzero(np.abs(gray - self._gray) >= self.pixel_threshold)
+            if changed < gray.size * self.area_threshold:
+                self._counters["skipped_motion"] += 1
+                return False
+
+        self._digest = digest
+        self._gray = gray
+        self._last_run = now
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までの、推論を省略した割合を返します
+
+        Returns:
+            dict : frames(判定したフレーム数), skipped_hash / skipped_motion(理由ごとの省略数), skip_ratio(省略した割合)
+        """
+        res = dict(self._counters)
+        skipped = res["skipped_hash"] + res["skipped_motion"]
+        res["skip_ratio"] = round(skipped / res["frames"], 3) if res["frames"] > 0 else 0.0
+
+        self._counters = {"frames" : 0, "skipped_hash" : 0, "skipped_motion" : 0}
+
+        return res
+
+
+def points_in_polygon(points : np.ndarray, polygon : np.ndarray) -> np.ndarray:
+    """
+    点が多角形の内側にあるかどうかを判定します(レイキャスティング法)
+
+    Args:
+        points (ndarray)  : 点の座標 (N, 2)
+        polygon (ndarray) : 多角形の頂点の座標 (M, 2)
+
+    Returns:
+        ndarray : 内側にある場合はTrue (N,)
+    """
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+    # 点から右に伸ばした半直線と交差する辺の数が奇数なら内側
+    crosses = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / np.where(y2 == y1, 1e-12, y2 - y1) + x1)
+
+    return np.count_nonzero(crosses, axis=1) % 2 == 1
+
+
+def nms_boxes(xyxy : np.ndarray, conf : np.ndarray, cls : np.ndarray, iou : float) -> np.ndarray:
+    """
+    クラスごとにNMS(Non-Maximum Suppression)を行い、残すBOXのインデックスを返します
+    ROIやタイルの重なった部分で、同じ物体が重複して検出された場合に使います
+
+    Args:
+        xyxy (ndarray) : BOX座標 (N, 4)
+        conf (ndarray) : 検出信頼度 (N,)
+        cls (ndarray)  : 検出クラス (N,)
+        iou (float)    : 重複とみなすIoUのしきい値
+
+    Returns:
+        ndarray : 残すBOXのインデックス(信頼度の高い順)
+    """
+    if len(xyxy) == 0:
+        return np.zeros(0, dtype=int)
+
+    # クラスごとに座標をずらして、違うクラスのBOX同士が重ならないようにする
+    boxes = xyxy + (cls * (xyxy.max() + 1))[:, None]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    order = conf.argsort()[::-1]
+    keep = []
+
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        ious = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-12)
+
+        order = rest[ious <= iou]
+
+    return np.array(keep, dtype=int)
+
+
+class RoiCropper:
+    """
+    ROI(多角形)を囲む矩形を切り出して推論するための画像を作り、検出結果をフレーム全体の座標に戻します
+
+    フレーム全体をモデルの入力サイズに縮小すると遠くの小さな物体が検出できなくなるので、
+    必要な部分だけを切り出して推論します
+    tiledを指定した場合は、ROIを囲む矩形をモデルの入力サイズのタイルに(重なりを持たせて)分割し、
+    縮小せずに推論します
+    """
+
+    def __init__(self, rois : list, tiled : bool, tile_size : int, overlap : float):
+        """
+        Args:
+            rois (list)     : ROIの多角形のリスト(座標はフレームの幅と高さに対する割合)
+            tiled (bool)    : タイルに分割して推論するかどうか
+            tile_size (int) : タイルの大きさ(モデルの入力サイズ)
+            overlap (float) : タイルの重なり(タイルの大きさに対する割合)
+        """
+        self.rois = []
+        for roi in rois:
+            polygon = np.array(roi, dtype=np.float64)
+            if polygon.ndim != 2 or polygon.shape[0] < 3 or polygon.shape[1] != 2:
+                raise ValueError(f"ROI must be a list of 3 or more [x, y] points: {roi}")
+            if polygon.min() < 0.0 or polygon.max() > 1.0:
+                raise ValueError(f"ROI coordinates must be between 0.0 and 1.0: {roi}")
+            self.rois.append(polygon)
+
+        if tiled and tile_size <= 0:
+            raise ValueError("MODEL_INPUT_SIZE must be specified for tiled inference")
+
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    def decode_size(self) -> int:
+        """
+        フレームをデコードする際の長辺の最小サイズ(decode_frameのmin_size)を返します
+        切り出した矩形が、モデルの入力サイズを下回らない程度に縮小します
+
+        Returns:
+            int : 長辺の最小サイズ(0の場合は縮小しない)
+        """
+        if self.tiled:
+            return 0
+
+        ratio = max(max(p.max(axis=0) - p.min(axis=0)) for p in self.rois)
+        return math.ceil(self.tile_size / max(ratio, 1e-3))
+
+    def crop(self, img : Image) -> list:
+        """
+        推論する領域を切り出します
+
+        Args:
+            img (Image) : フレーム画像
+
+        Returns:
+            list : (切り出した画像, 切り出した位置(x, y)) のリスト
+        """
+        res = []
+        for x1, y1, x2, y2 in self._regions(img.width, img.height):
+            res.append((img.crop((x1, y1, x2, y2)), (x1, y1)))
+
+        return res
+
+    def merge(self, img : Image, crops : list, results : list, iou : float) -> Results:
+        """
+        切り出した領域ごとの推論結果を、フレーム全体の座標の1つの結果にまとめます
+        中心がROIの外にある物体は除き、重なった部分で重複した物体はNMSで1つにします
+
+        Args:
+            img (Image)     : フレーム画像
+            crops (list)    : crop()の結果
+            results (list)  : cropsと同じ順番の推論結果
+            iou (float)     : 重複とみなすIoUのしきい値
+
+        Returns:
+            Results : フレーム全体の座標の推論結果
+        """
+        data = []
+        for (_, (x, y)), result in zip(crops, results):
+            boxes = result.boxes.data.cpu().numpy()
+            if len(boxes) > 0:
+                boxes = boxes[:, :6].copy()
+                boxes[:, [0, 2]] += x
+                boxes[:, [1, 3]] += y
+                data.append(boxes)
+
+        data = np.concatenate(data) if len(data) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+        # 中心がいずれかのROIの中にある物体だけを残す
+        if len(data) > 0:
+            centers = (data[:, :2] + data[:, 2:4]) / 2
+            size = np.array([img.width, img.height])
+            inside = np.zeros(len(data), dtype=bool)
+            for polygon in self.rois:
+                inside |= points_in_polygon(centers, polygon * size)
+            data = data[inside]
+
+        # 重なった領域で重複して検出された物体を1つにする
+        data = data[nms_boxes(data[:, :4], data[:, 4], data[:, 5], iou)]
+
+        # BGRの画像(ultralyticsがPIL Imageを推論する場合と同じ形式)
+        orig_img = np.ascontiguousarray(np.asarray(img.convert("RGB"))[:, :, ::-1])
+
+        return Results(orig_img, path="", names=results[0].names, boxes=torch.as_tensor(data))
+
+    def _regions(self, width : int, height : int) -> list:
+        """
+        切り出す矩形を返します
+
+        Args:
+            width (int)  : フレームの幅
+            height (int) : フレームの高さ
+
+        Returns:
+            list : (x1, y1, x2, y2) のリスト
+        """
+        regions = []
+        for polygon in self.rois:
+            x1, y1 = np.floor(polygon.min(axis=0) * (width, height)).astype(int).tolist()
+            x2, y2 = np.ceil(polygon.max(axis=0) * (width, height)).astype(int).tolist()
+
+            if not self.tiled:
+                regions.append((x1, y1, max(x2, x1 + 1), max(y2, y1 + 1)))
+                continue
+
+            for ty in self._tile_starts(y1, y2):
+                for tx in self._tile_starts(x1, x2):
+                    regions.append((tx, ty, min(tx + self.tile_size, x2), min(ty + self.tile_size, y2)))
+
+        return regions
+
+    def _tile_starts(self, start : int, end : int) -> list:
+        """
+        1辺をタイルに分割した際の、各タイルの開始位置を返します
+        最後のタイルは終端に合わせます
+
+        Args:
+            start (int) : 開始位置
+            end (int)   : 終了位置
+
+        Returns:
+            list : 各タイルの開始位置
+        """
+        if end - start <= self.tile_size:
+            return [start]
+
+        stride = max(1, int(self.tile_size * (1.0 - self.overlap)))
+        starts = list(range(start, end - self.tile_size, stride))
+        starts.append(end - self.tile_size)
+
+        return starts
+
+
+def decode_frame(frame : bytes, min_size : int) -> tuple:
+    """
+    カメラフレーム画像(JPEG)をデコードします
+    min_sizeが指定されている場合は、長辺がmin_sizeを下回らない範囲で
+    JPEGのDCTスケーリング(1/2, 1/4, 1/8)を使って縮小しながらデコードします
+
+    Args:
+        frame (bytes)  : カメラフレーム画像(JPEG)
+        min_size (int) : デコード後の長辺の最小サイズ(0の場合は縮小しない)
+
+    Returns:
+        tuple : (PIL Image, 元の解像度に戻すための倍率(横, 縦))
+    """
+    img = Image.open(BytesIO(frame))
+    w, h = img.size
+
+    if min_size > 0 and max(w, h) > min_size:
+        r = min_size / max(w, h)
+        img.draft("RGB", (math.ceil(w * r), math.ceil(h * r)))
+
+    return img, (w / img.width, h / img.height)
+
+
+def decode_frames(frames : list, min_sizes : list, pool : "WorkerPool" = None) -> list:
+    """
+    カメラフレーム画像(JPEG)をモデルの入力サイズに合わせてデコードし、画素を読み込みます
+
+    Args:
+        frames (list)     : カメラフレーム画像(JPEG)のリスト
+        min_sizes (list)  : フレームごとのdecode_frameのmin_size
+        pool (WorkerPool) : デコードを行うワーカープロセス(Noneの場合はこのプロセスでデコードする)
+
+    Returns:
+        list : (PIL Image, 元の解像度に戻すための倍率(横, 縦)) のリスト
+    """
+    if pool is not None:
+        return pool.decode(frames, min_sizes)
+
+    res = []
+    for frame, min_size in zip(frames, min_sizes):
+        # デコードは画素を参照したときに行われるので、ここで読み込む
+        img, scale = decode_frame(frame, min_size)
+        img.load()
+        res.append((img, scale))
+
+    return res
+
+
+def create_result_jpeg(img : Image, tracking_objects : list, scale : tuple = (1.0, 1.0)) -> bytes:
+    """
+    tracking_objectsの内容を画像に書き込みます
+    
+    Args:
+        img (Image)   : カメラフレーム画像のPIL Image
+        tracking_objects (list) : トラッキングオブジェクトを格納した配列
+        scale (tuple) : imgに対する元の解像度の倍率(横, 縦)、縮小した画像に描画する場合に指定する
+
+    Returns:
+        bytes : 結果を書き込んだJPEG画像
+    """
+   
+    with metrics.measure("draw"):
+        draw_tracks(img, tracking_objects, scale)
+
+    with metrics.measure("encode"):
+        dst = BytesIO()
+        img.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def draw_tracks(img : Image, tracking_objects : list, scale : tuple):
+    """
+    tracking_objectsの枠と静止時間を画像に描画します
+
+    Args:
+        img (Image)   : カメラフレーム画像のPIL Image
+        tracking_objects (list) : トラッキングオブジェクトを格納した配列
+        scale (tuple) : imgに対する元の解像度の倍率(横, 縦)
+    """
+    draw = ImageDraw.Draw(img)
+    font_size = max(1, round(30 / scale[0])) # 静止時間を書き込む際の文字の大きさ
+    line_width = max(1, round(5 / scale[0]))
+
+    for p in tracking_objects:
+
+        if not p["tracked"]:
+            continue
+
+        stay_sec = p["stay_sec"]
+
+        # 枠の色を決める
+        # WARNING_SEC / ALERT_SECと比較した結果はアラート状態(AlertStateMachine)に入っている
+        # (設定ファイルで変更された値を、ワーカープロセスでも同じように使えるようにする)
+        if p["alert_state"] == "normal":
+            cr = (255, 255, 255)
+        elif p["alert_state"] == "warning":
+            cr = (255, 255, 0)
+        else:
+            cr = (255, 0, 0)
+
+        # 静止時間
+        hour = math.floor(stay_sec / 60 / 60)
+        min = math.floor(stay_sec / 60) - hour * 60
+        sec = math.floor(stay_sec%60)
+        parking_time = str(min).zfill(2) + ":" + str(sec).zfill(2)
+        if hour > 0:
+            parking_time = str(hour) + ":" + parking_time
+
+        text = f'{parking_time}'
+
+        x1 = p["box"]["x1"] / scale[0]
+        y1 = p["box"]["y1"] / scale[1]
+        x2 = p["box"]["x2"] / scale[0]
+        y2 = p["box"]["y2"] / scale[1]
+
+        draw.rectangle((x1, y1, x2, y2), fill=None, outline=cr, width=line_width)
+
+        text_box = draw.textbbox((x1, y1), text, font_size=font_size, anchor='lt')
+        draw.rectangle(text_box, fill=cr, outline=None)
+        draw.text((x1, y1), text, fill=(0,0,0), font_size=font_size, anchor='lt')
+
+
+def box_iou(a : tuple, b : tuple) -> float:
+    """
+    2つのBOXの重なり(IoU)を返します
+
+    Args:
+        a (tuple) : BOX座標 (x1, y1, x2, y2)
+        b (tuple) : BOX座標 (x1, y1, x2, y2)
+
+    Returns:
+        float : IoU(0.0 ～ 1.0)
+    """
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    """
+    トラッキングオブジェクトの情報
+    長時間動かし続けてもメモリ使用量が増えないよう、__slots__で属性を固定しています
+    """
+
+    __slots__ = ("id", "pos", "box", "prev_timestamp", "stay_sec", "state", "conf", "cls", "frame_no",
+                 "alert_state", "alert_timestamp", "key", "first_timestamp")
+
+    def __init__(self, id : int, pos : tuple, box : tuple, timestamp : int, conf : float, cls : int):
+        """
+        Args:
+            id (int)        : トラッキングID
+            pos (tuple)     : 検出物体中心座標 (x, y)
+            box (tuple)     : BOX座標 (x1, y1, x2, y2)
+            timestamp (int) : 検出された時間(Unixtime)
+            conf (float)    : 検出信頼度
+            cls (int)       : 検出クラス
+        """
+        self.id = id
+        self.pos = pos
+        self.box = box
+        self.prev_timestamp = timestamp
+        self.first_timestamp = timestamp
+        self.stay_sec = 0 # 0秒から開始
+        self.state = "stay"
+        self.conf = conf
+        self.cls = cls
+
+        # 最後に検出されたフレームの番号
+        self.frame_no = 0
+
+        # アラート状態("normal" / "warning" / "alerted")と、最後にアラートを通知した時間
+        self.alert_state = "normal"
+        self.alert_timestamp = 0
+
+        # TrackStoreが付与する識別子(トラッキングIDと違い、トラッカーを初期化しても変わらない)
+        self.key = None
+
+    @classmethod
+    def from_record(cls, record : dict) -> "Track":
+        """
+        to_record()の辞書形式からオブジェクトを復元します
+
+        Args:
+            record (dict) : to_record()の結果
+
+        Returns:
+            Track : オブジェクト
+        """
+        track = cls(record["id"], tuple(record["pos"]), tuple(record["box"]), record["prev_timestamp"], record["conf"], record["cls"])
+        track.stay_sec = record["stay_sec"]
+        track.state = record["state"]
+        track.alert_state = record["alert_state"]
+        track.alert_timestamp = record["alert_timestamp"]
+        track.key = record["key"]
+        track.first_timestamp = record.get("first_timestamp", track.prev_timestamp - track.stay_sec)
+
+        return track
+
+    def to_record(self) -> dict:
+        """
+        トラッキング情報のジャーナルに保存する辞書形式に変換します
+
+        Returns:
+            dict : トラッキングオブジェクトの情報
+        """
+        return {
+            "key" : self.key,
+            "id" : self.id,
+            "pos" : [round(v, 1) for v in self.pos],
+            "box" : [round(v, 1) for v in self.box],
+            "prev_timestamp" : self.prev_timestamp,
+            "first_timestamp" : self.first_timestamp,
+            "stay_sec" : self.stay_sec,
+            "state" : self.state,
+            "conf" : round(self.conf, 3),
+            "cls" : self.cls,
+            "alert_state" : self.alert_state,
+            "alert_timestamp" : self.alert_timestamp
+        }
+
+    def to_dict(self, tracked : bool) -> dict:
+        """
+        Push通知や結果画像の描画で使用する辞書形式に変換します
+
+        Args:
+            tracked (bool) : 今回のフレームで検出されたかどうか
+
+        Returns:
+            dict : トラッキングオブジェクトの情報
+        """
+        return {
+            "id" : self.id,
+            "pos" : {"x" : self.pos[0], "y" : self.pos[1]},
+            "box" : {"x1" : self.box[0], "y1" : self.box[1], "x2" : self.box[2], "y2" : self.box[3]},
+            "prev_timestamp" : self.prev_timestamp,
+            "stay_sec" : self.stay_sec,
+            "state" : self.state,
+            "conf" : self.conf,
+            "cls" : self.cls,
+            "alert_state" : self.alert_state,
+            "tracked" : tracked
+        }
+
+
+class TrackStore:
+    """
+    トラッキングオブジェクトをトラッキングIDで管理します
+
+    オブジェクトは最後に検出された順に並べて保持するので、
+    保持時間を過ぎたオブジェクトの削除は先頭から期限切れのものだけを確認すれば済みます
+
+    再起動前や画像サイズの変更前に追跡していたオブジェクトは、トラッキングIDが変わってしまうので
+    引き継ぎ待ち(orphan)として別に保持し、新しいIDで検出されたBOXと重なればそのオブジェクトとして引き継ぎます
+    """
+
+    def __init__(self):
+        self._tracks = OrderedDict()
+
+        # フレームの番号(begin_frame()のたびに加算)
+        self.frame_no = 0
+
+        # 引き継ぎ待ちのオブジェクト (Track.key -> (Track, 引き継ぎを待つ期限(Unixtime)))
+        self._orphans = OrderedDict()
+
+        # 次に付与するTrack.key
+        self._next_key = 1
+
+        # 前回のdrain_changes()から更新されたオブジェクトのkeyと、削除されたオブジェクトのkey
+        self._dirty = set()
+        self._removed = []
+
+        # 引き継いだオブジェクトの数
+        self.adopted = 0
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks.values())
+
+    def begin_frame(self):
+        """
+        新しいフレームの処理を開始します
+        これ以降にupdate()されなかったオブジェクトは、このフレームでは検出されなかった扱いになります
+        """
+        self.frame_no += 1
+
+    def get(self, id : int) -> Track:
+        """
+        トラッキングIDでオブジェクトを取得します
+
+        Args:
+            id (int) : トラッキングID
+
+        Returns:
+            Track : オブジェクト、存在しない場合はNone
+        """
+        return self._tracks.get(id)
+
+    def update(self, track : Track):
+        """
+        オブジェクトを今回のフレームで検出されたものとして登録(または更新)します
+
+        Args:
+            track (Track) : オブジェクト
+        """
+        if track.key is None:
+            track.key = self._next_key
+            self._next_key += 1
+
+        track.frame_no = self.frame_no
+        self._tracks[track.id] = track
+        self._tracks.move_to_end(track.id)
+        self._dirty.add(track.key)
+
+    def hold(self, timestamp : int):
+        """
+        シーンに変化がなく推論を省略したフレームで、前回検出されたオブジェクトを
+        同じ位置で静止していたものとして更新します(静止時間を加算)
+
+        Args:
+            timestamp (int) : 時間(Unixtime)
+        """
+        for track in [t for t in self._tracks.values() if self.is_tracked(t)]:
+            track.stay_sec = track.stay_sec + timestamp - track.prev_timestamp
+            track.state = "stay"
+            track.prev_timestamp = timestamp
+            self._tracks.move_to_end(track.id)
+            self._dirty.add(track.key)
+
+    def is_tracked(self, track : Track) -> bool:
+        """
+        オブジェクトが今回のフレームで検出されたかどうか
+
+        Args:
+            track (Track) : オブジェクト
+
+        Returns:
+            bool : 検出された場合はTrue
+        """
+        return track.frame_no == self.frame_no
+
+    def prune(self, timestamp : int, retention_sec : int) -> list:
+        """
+        最後に検出されてからretention_sec以上経過したオブジェクトを削除します
+
+        Args:
+            timestamp (int)     : 時間(Unixtime)
+            retention_sec (int) : 保持時間(秒)
+
+        Returns:
+            list : 削除したオブジェクト(Track)のリスト
+        """
+        removed = []
+
+        while len(self._tracks) > 0:
+            track = next(iter(self._tracks.values()))
+            if timestamp - track.prev_timestamp < retention_sec:
+                break
+            self._tracks.popitem(last=False)
+            self._removed.append(track.key)
+            removed.append(track)
+
+        # 引き継ぎを待つ期限が過ぎたオブジェクト
+        for key in [k for k, (_, expires) in self._orphans.items() if timestamp >= expires]:
+            track, _ = self._orphans.pop(key)
+            self._removed.append(key)
+            removed.append(track)
+
+        return removed
+
+    def orphan_all(self, expires : int):
+        """
+        すべてのオブジェクトを引き継ぎ待ちにします
+        (トラッカーを初期化してトラッキングIDが変わる場合)
+
+        Args:
+            expires (int) : 引き継ぎを待つ期限(Unixtime)
+        """
+        for track in self._tracks.values():
+            self._orphans[track.key] = (track, expires)
+        self._tracks.clear()
+
+    def restore(self, tracks : list, expires : int):
+        """
+        保存しておいたオブジェクトを、引き継ぎ待ちとして復元します
+
+        Args:
+            tracks (list) : Trackのリスト
+            expires (int) : 引き継ぎを待つ期限(Unixtime)
+        """
+        for track in tracks:
+            self._orphans[track.key] = (track, expires)
+            self._next_key = max(self._next_key, track.key + 1)
+
+    def adopt(self, id : int, box : tuple, cls : int, iou : float) -> Track:
+        """
+        新しいトラッキングIDで検出されたBOXと、同じクラスで最も重なる引き継ぎ待ちのオブジェクトを取り出します
+
+        Args:
+            id (int)     : 新しいトラッキングID
+            box (tuple)  : 検出されたBOX座標 (x1, y1, x2, y2)
+            cls (int)    : 検出クラス
+            iou (float)  : 同じオブジェクトとみなす重なりの最小値
+
+        Returns:
+            Track : 新しいトラッキングIDを設定したオブジェクト、重なるものがない場合はNone
+        """
+        best, best_iou = None, iou
+        for key, (track, _) in self._orphans.items():
+            if track.cls != cls:
+                continue
+            v = box_iou(track.box, box)
+            if v >= best_iou:
+                best, best_iou = key, v
+
+        if best is None:
+            return None
+
+        track, _ = self._orphans.pop(best)
+        track.id = id
+        self.adopted += 1
+
+        return track
+
+    @property
+    def orphans(self) -> int:
+        """
+        引き継ぎ待ちのオブジェクトの数
+        """
+        return len(self._orphans)
+
+    def records(self) -> list:
+        """
+        引き継ぎ待ちを含むすべてのオブジェクトを、ジャーナルに保存する辞書形式に変換します
+
+        Returns:
+            list : Track.to_record()のリスト
+        """
+        return [t.to_record() for t in self._tracks.values()] + [t.to_record() for t, _ in self._orphans.values()]
+
+    def drain_changes(self) -> tuple:
+        """
+        前回の呼び出しから更新されたオブジェクトと、削除されたオブジェクトを返します
+
+        Returns:
+            tuple : (更新されたオブジェクトのTrack.to_record()のリスト, 削除されたオブジェクトのTrack.keyのリスト)
+        """
+        updated = [t.to_record() for t in self._tracks.values() if t.key in self._dirty]
+        removed = self._removed
+
+        self._dirty = set()
+        self._removed = []
+
+        return updated, removed
+
+    def snapshot(self) -> list:
+        """
+        すべてのオブジェクトを辞書形式のリストに変換します
+
+        Returns:
+            list : Track.to_dict()のリスト
+        """
+        return [t.to_dict(self.is_tracked(t)) for t in self._tracks.values()]
+
+
+class TrackJournal:
+    """
+    トラッキング情報を追記型のジャーナルファイルに保存し、起動時に復元します
+
+    毎フレーム全体を書き直すのではなく、一定の間隔で前回から更新されたオブジェクトと削除されたオブジェクトだけを1行追記します
+    追記した行数が一定数を超えたら、全オブジェクトを1行にまとめたファイルに書き換えます(コンパクション)
+    書き換えは一時ファイルに書き込んでから置き換えるので、途中で終了しても前のファイルが残ります
+    (異常終了で最後の行が途中までしか書かれていない場合は、その行を無視します)
+    """
+
+    def __init__(self, path : str, interval_sec : float, compact_records : int):
+        """
+        Args:
+            path (str)            : ジャーナルファイルのパス
+            interval_sec (float)  : 追記する間隔(秒)
+            compact_records (int) : コンパクションするまでの追記の行数
+        """
+        self.path = path
+        self.interval_sec = interval_sec
+        self.compact_records = compact_records
+
+        self._file = None
+        self._records = 0
+        self._last_time = time.monotonic()
+
+        self._counters = {"restored" : 0, "records" : 0, "compactions" : 0, "bytes" : 0, "errors" : 0}
+
+    def load(self, timestamp : int, max_age_sec : float) -> list:
+        """
+        ジャーナルファイルを先頭から再生して、保存されていたオブジェクトを復元します
+
+        Args:
+            timestamp (int)     : 現在の時間(Unixtime)
+            max_age_sec (float) : 復元するオブジェクトの、最後に検出されてからの時間の上限(秒)
+
+        Returns:
+            list : 復元したTrackのリスト
+        """
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で終了した行
+                        break
+
+                    if "snapshot" in record:
+                        records = {r["key"] : r for r in record["snapshot"]}
+                        continue
+
+                    for r in record.get("updated", []):
+                        records[r["key"]] = r
+                    for key in record.get("removed", []):
+                        records.pop(key, None)
+
+        except FileNotFoundError:
+            return []
+
+        tracks = [Track.from_record(r) for r in records.values() if timestamp - r["prev_timestamp"] <= max_age_sec]
+        self._counters["restored"] += len(tracks)
+
+        return tracks
+
+    def record(self, tracking_objects : TrackStore):
+        """
+        前回から追記する間隔が過ぎていれば、更新されたオブジェクトと削除されたオブジェクトを追記します
+        追記した行数がcompact_recordsを超えた場合は、代わりにコンパクションします
+
+        Args:
+            tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+        """
+        now = time.monotonic()
+        if now - self._last_time < self.interval_sec:
+            return
+        self._last_time = now
+
+        if self._records >= self.compact_records:
+            self.compact(tracking_objects)
+            return
+
+        updated, removed = tracking_objects.drain_changes()
+        if len(updated) == 0 and len(removed) == 0:
+            return
+
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+
+            line = json.dumps({"updated" : updated, "removed" : removed}, separators=(",", ":")) + "\n"
+            self._file.write(line)
+            self._file.flush()
+
+            self._records += 1
+            self._counters["records"] += 1
+            self._counters["bytes"] += len(line)
+
+        except OSError as e:
+            print(f"Failed to write track state: {e}")
+            self._counters["errors"] += 1
+
+    def compact(self, tracking_objects : TrackStore):
+        """
+        全オブジェクトを1行にまとめたファイルに書き換えます
+
+        Args:
+            tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+        """
+        tracking_objects.drain_changes()
+
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            line = json.dumps({"snapshot" : tracking_objects.records()}, separators=(",", ":")) + "\n"
+            with open(self.path + ".tmp", "w") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + ".tmp", self.path)
+
+            self._records = 0
+            self._counters["compactions"] += 1
+            self._counters["bytes"] += len(line)
+
+        except OSError as e:
+            print(f"Failed to write track state: {e}")
+            self._counters["errors"] += 1
+
+    def close(self, tracking_objects : TrackStore):
+        """
+        終了時の状態でコンパクションして、ファイルを閉じます
+
+        Args:
+            tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+        """
+        self.compact(tracking_objects)
+
+    def stats(self) -> dict:
+        """
+        ジャーナルの書き込みの統計を返します
+
+        Returns:
+            dict : restored(復元したオブジェクト数)、records(追記した行数)、compactions(コンパクションの回数)、
+                   bytes(書き込んだバイト数)、errors(書き込みに失敗した数)
+        """
+        return dict(self._counters)
+
+
+class AlertStateMachine:
+    """
+    オブジェクトごとのアラート状態を管理し、Push通知するオブジェクトを決めます
+
+    アラート状態は静止時間によって normal → warning → alerted と遷移します
+    Push通知はalertedに遷移したとき(とwarningに遷移したとき)と、alertedのまま静止し続けて
+    再通知の間隔が過ぎたときだけ行い、通知するのは状態が変わったオブジェクトだけです
+    (ALERT_SECを超えたオブジェクトがいる間、毎フレームPush通知することはありません)
+    """
+
+    def __init__(self, warning_sec : float, alert_sec : float, cooldown_sec : float, push_on_warning : bool = False):
+        """
+        Args:
+            warning_sec (float)    : 警告状態になる静止時間(秒)
+            alert_sec (float)      : アラート状態になる静止時間(秒)
+            cooldown_sec (float)   : アラートを再通知する間隔(秒)
+            push_on_warning (bool) : 警告状態になったときにもPush通知するかどうか
+        """
+        self.configure(warning_sec, alert_sec, cooldown_sec, push_on_warning)
+
+        # 統計情報
+        self._counters = {"warnings" : 0, "alerts" : 0, "realerts" : 0, "pushes" : 0, "suppressed" : 0}
+
+    def configure(self, warning_sec : float, alert_sec : float, cooldown_sec : float, push_on_warning : bool):
+        """
+        状態が遷移する静止時間と、再通知の間隔を設定します
+        (設定ファイルで変更された場合は、次のupdate()から新しい値で判定します)
+
+        Args:
+            warning_sec (float)    : 警告状態になる静止時間(秒)
+            alert_sec (float)      : アラート状態になる静止時間(秒)
+            cooldown_sec (float)   : アラートを再通知する間隔(秒)
+            push_on_warning (bool) : 警告状態になったときにもPush通知するかどうか
+        """
+        self.warning_sec = warning_sec
+        self.alert_sec = alert_sec
+        self.cooldown_sec = cooldown_sec
+        self.push_on_warning = push_on_warning
+
+    def update(self, tracking_objects : TrackStore, timestamp : int) -> list:
+        """
+        今回のフレームで検出されたオブジェクトのアラート状態を更新し、Push通知するオブジェクトを返します
+
+        Args:
+            tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+            timestamp (int)               : 時間(Unixtime)
+
+        Returns:
+            list : Push通知するオブジェクト(Track)のリスト、通知しない場合は空
+        """
+        changed = []
+        alerting = False
+
+        for track in tracking_objects:
+
+            # 今回のフレームで見えていないオブジェクトは、状態を変えない
+            if not tracking_objects.is_tracked(track):
+                continue
+
+            # 枠の色もこの状態で決めるので、従来の描画と同じくALERT_SEC以上で赤枠(アラート状態)にする
+            if track.stay_sec >= self.alert_sec:
+                state = "alerted"
+            elif track.stay_sec >= self.warning_sec:
+                state = "warning"
+            else:
+                state = "normal"
+
+            if state != track.alert_state:
+                # 状態が変わった
+                track.alert_state = state
+
+                if state == "alerted":
+                    track.alert_timestamp = timestamp
+                    self._counters["alerts"] += 1
+                    changed.append(track)
+                elif state == "warning":
+                    self._counters["warnings"] += 1
+                    if self.push_on_warning:
+                        changed.append(track)
+
+            elif state == "alerted":
+                # アラート状態のまま静止し続けている場合は、再通知の間隔ごとに通知する
+                alerting = True
+                if timestamp - track.alert_timestamp >= self.cooldown_sec:
+                    track.alert_timestamp = timestamp
+                    self._counters["realerts"] += 1
+                    changed.append(track)
+
+        if len(changed) > 0:
+            self._counters["pushes"] += 1
+        elif alerting:
+            # 従来は毎フレームPush通知していたフレーム
+            self._counters["suppressed"] += 1
+            metrics.inc("suppressed")
+
+        return changed
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までの、状態の遷移とPush通知の回数を返します
+
+        Returns:
+            dict : warnings / alerts(状態が遷移したオブジェクト数), realerts(再通知したオブジェクト数),
+                   pushes(Push通知したフレーム数), suppressed(アラート状態のオブジェクトがいたが通知しなかったフレーム数)
+        """
+        res = dict(self._counters)
+        self._counters = {k : 0 for k in self._counters}
+
+        return res
+
+
+def create_push_image(frame : bytes, annotated : bytes, boxes : list) -> bytes:
+    """
+    PUSH_IMAGE_MODEに従って、Push通知する画像を生成します
+
+    Args:
+        frame (bytes)     : カメラフレーム画像(JPEG、元の解像度)
+        annotated (bytes) : 検知枠を描画したJPEG画像
+        boxes (list)      : 切り出すBOX座標 (x1, y1, x2, y2) のリスト(元の解像度)
+
+    Returns:
+        bytes : Push通知するJPEG画像
+    """
+    if PUSH_IMAGE_MODE == "thumbnail":
+        return create_thumbnail_jpeg(annotated, PUSH_THUMBNAIL_SIZE)
+
+    if PUSH_IMAGE_MODE == "crops" and len(boxes) > 0:
+        return create_crops_jpeg(frame, boxes[:PUSH_CROP_COUNT], PUSH_CROP_HEIGHT, PUSH_CROP_MARGIN)
+
+    return annotated
+
+
+def create_thumbnail_jpeg(jpeg : bytes, size : int) -> bytes:
+    """
+    JPEG画像を長辺がsize以下になるよう縮小します
+
+    Args:
+        jpeg (bytes) : JPEG画像
+        size (int)   : 長辺のサイズ
+
+    Returns:
+        bytes : 縮小したJPEG画像(縮小する必要がない場合はそのまま)
+    """
+    img = Image.open(BytesIO(jpeg))
+    if max(img.size) <= size:
+        return jpeg
+
+    img.draft("RGB", (size, size))
+    img.thumbnail((size, size), Image.BILINEAR)
+
+    dst = BytesIO()
+    img.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def create_crops_jpeg(jpeg : bytes, boxes : list, height : int, margin : float) -> bytes:
+    """
+    BOXの部分だけを切り出し、高さをそろえて横に並べた1枚のJPEG画像を生成します
+
+    Args:
+        jpeg (bytes)   : カメラフレーム画像(JPEG、元の解像度)
+        boxes (list)   : BOX座標 (x1, y1, x2, y2) のリスト(元の解像度)
+        height (int)   : 切り出した画像の高さ
+        margin (float) : BOXの周囲に含める余白(BOXの大きさに対する割合)
+
+    Returns:
+        bytes : 切り出した画像を並べたJPEG画像
+    """
+    img = Image.open(BytesIO(jpeg))
+
+    crops = []
+    for x1, y1, x2, y2 in boxes:
+        mx = (x2 - x1) * margin
+        my = (y2 - y1) * margin
+        box = (max(0, math.floor(x1 - mx)), max(0, math.floor(y1 - my)),
+               min(img.width, math.ceil(x2 + mx)), min(img.height, math.ceil(y2 + my)))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+
+        crop = img.crop(box)
+        crops.append(crop.resize((max(1, round(crop.width * height / crop.height)), height), Image.BILINEAR))
+
+    sheet = Image.new("RGB", (max(1, sum(c.width for c in crops)), height))
+    x = 0
+    for crop in crops:
+        sheet.paste(crop, (x, 0))
+        x += crop.width
+
+    dst = BytesIO()
+    sheet.save(dst, format='JPEG', quality=75)
+
+    return dst.getvalue()
+
+
+def parse_results(results : list, timestamp : int, tracking_objects : TrackStore, scale : tuple = (1.0, 1.0)):
+    """
+    trackの結果をtracking_objectsに設定します。
+    
+    Args:
+        results (list)   : trackの処理結果
+        timestamp (int)  : 時間(Unixtime)
+        tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+        scale (tuple)    : BOX座標を元の解像度に戻すための倍率(横, 縦)
+
+    """
+
+    # 今回のフレームの処理を開始
+    # update()されなかったオブジェクトは検出されなかった扱いになる
+    tracking_objects.begin_frame()
+
+    # 結果を扱いやすいように成形
+    # 全BOX分の座標などを一度に配列として取り出す
+    batch = DetectionBatch.from_results(results, scale)
+
+    # トラッキングIDが付与されていない場合は何もしない
+    if batch.id is None:
+        return
+
+    for id, (pos_x, pos_y), (x1, y1, x2, y2), conf, cls in zip(
+            batch.id.tolist(), batch.pos.tolist(), batch.xyxy.tolist(), batch.conf.tolist(), batch.cls.tolist()):
+
+        # 今回の処理で検出されたオブジェクトのIDが
+        # tracking_objectsに存在するかどうかを確認
+        p = tracking_objects.get(id)
+
+        # 初めてのトラッキングIDでも、再起動前や画像サイズの変更前に追跡していたオブジェクトと重なれば引き継ぐ
+        # (引き継いだオブジェクトは、動いていなければ前回検出されてからの時間も静止時間に加算される)
+        if p is None:
+            p = tracking_objects.adopt(id, (x1, y1, x2, y2), cls, TRACK_RESTORE_IOU)
+
+        if p is None:
+            # 初めて検知されたオブジェクトなので
+            # 新規に追加
+
+            p = Track(id, (pos_x, pos_y), (x1, y1, x2, y2), timestamp, conf, cls)
+
+        else:
+            # すでにトラッキングされているオブジェクトが
+            # 今回の処理でも見つかったので
+            # 情報を更新
+            update_track(p, (pos_x, pos_y), (x1, y1, x2, y2), conf, timestamp)
+
+        tracking_objects.update(p)
+
+
+def update_track(p : Track, pos : tuple, box : tuple, conf : float, timestamp : int):
+    """
+    すでにトラッキングされているオブジェクトの位置と静止時間を更新します
+    (推論で検出された場合と、キーフレームの間にBOXを動かした場合で共通)
+
+    Args:
+        p (Track)       : オブジェクト
+        pos (tuple)     : 検出物体中心座標 (x, y)
+        box (tuple)     : BOX座標 (x1, y1, x2, y2)
+        conf (float)    : 検出信頼度
+        timestamp (int) : 時間(Unixtime)
+    """
+    p.conf = conf
+
+    prev_x, prev_y = p.pos
+
+    #
+    # 前回から動いているか？
+    # 10ピクセル以上動いていたら動いたと判断
+    move_x = abs(prev_x - pos[0])
+    move_y = abs(prev_y - pos[1])
+    move = move_x > 10 or move_y > 10
+
+    p.pos = pos
+    p.box = box
+
+    if move:
+        p.state = "move"
+    else:
+        # 静止している場合は静止時間を加算
+        p.stay_sec = p.stay_sec + timestamp - p.prev_timestamp
+        p.state = "stay"
+
+    p.prev_timestamp = timestamp
+
+
+class BoxPropagator:
+    """
+    キーフレームの間、検出したBOXをテンプレートマッチングで動かします
+
+    キーフレーム(推論したフレーム)で検出されたBOXの部分の画像をテンプレートとして保持し、
+    キーフレームでないフレームでは、縮小したグレースケール画像で各BOXの周囲からテンプレートと最も一致する位置を探します
+    BOXが見つからない場合や、BOXの外で変化があった場合は、推論が必要(キーフレーム)と判断します
+    """
+
+    # テンプレートの最小の大きさと、一致度の計算に使う最大の大きさ(縮小画像のピクセル)
+    # 大きいBOXは間引いて比較する
+    MIN_TEMPLATE_SIZE = 6
+    MAX_TEMPLATE_SIZE = 48
+
+    # 動いていない位置の一致度がこの差の範囲で最大なら、動いていないとみなす(ノイズで静止時間が途切れないように)
+    STILL_MARGIN = 0.02
+
+    def __init__(self, interval : int, width : int, search_range : int, min_score : float, conf_decay : float,
+                 pixel_threshold : int, area_threshold : float):
+        """
+        Args:
+            interval (int)          : キーフレームの間隔(フレーム数)
+            width (int)             : 縮小画像の幅
+            search_range (int)      : BOXを探す範囲(縮小画像のピクセル)
+            min_score (float)       : BOXが見つかったとみなす一致度
+            conf_decay (float)      : キーフレームでないフレームごとに、信頼度に掛ける値
+            pixel_threshold (int)   : BOXの外で変化したとみなす輝度の差(0 ~ 255)
+            area_threshold (float)  : キーフレームにする、BOXの外で変化した画素の割合(0.0 ~ 1.0)
+        """
+        self.interval = interval
+        self.width = width
+        self.search_range = search_range
+        self.min_score = min_score
+        self.conf_decay = conf_decay
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+
+        # キーフレームの縮小画像と画像サイズ、元の解像度の座標を縮小画像の座標にする倍率
+        self._gray = None
+        self._size = None
+        self._factor = (1.0, 1.0)
+
+        # キーフレームで検出されたオブジェクト (Track, テンプレート, キーフレームでの位置(x, y)) のリスト
+        self._templates = []
+
+        # キーフレームからのフレーム数
+        self._count = 0
+
+        # 統計情報
+        self._counters = {"keyframes" : 0, "propagated" : 0, "interval" : 0, "lost" : 0, "motion" : 0}
+
+    def keyframe(self, img : Image, scale : tuple, tracking_objects : TrackStore):
+        """
+        推論したフレームを、次のキーフレームまでの基準にします
+
+        Args:
+            img (Image)                   : 推論した画像
+            scale (tuple)                 : 元の解像度に戻すための倍率(横, 縦)
+            tracking_objects (TrackStore) : 推論結果を反映したトラッキングオブジェクトの管理
+        """
+        gray = self._to_gray(img)
+        fx = gray.shape[1] / (img.width * scale[0])
+        fy = gray.shape[0] / (img.height * scale[1])
+
+        self._templates = []
+        for track in tracking_objects:
+            if not tracking_objects.is_tracked(track):
+                continue
+
+            x1, y1, x2, y2 = self._gray_box(track.box, (fx, fy), gray.shape)
+            self._templates.append((track, gray[y1:y2, x1:x2], (x1, y1)))
+
+        self._gray = gray
+        self._size = img.size
+        self._factor = (fx, fy)
+        self._count = 0
+        self._counters["keyframes"] += 1
+
+    def propagate(self, img : Image, tracking_objects : TrackStore, timestamp : int) -> bool:
+        """
+        キーフレームで検出されたBOXを動かし、検出された場合と同じように静止時間を更新します
+        推論が必要な場合は何もせずにFalseを返します
+
+        Args:
+            img (Image)                   : フレーム画像
+            tracking_objects (TrackStore) : トラッキングオブジェクトの管理
+            timestamp (int)               : 時間(Unixtime)
+
+        Returns:
+            bool : BOXを動かした場合はTrue、推論が必要(キーフレーム)な場合はFalse
+        """
+        if self._gray is None or img.size != self._size:
+            return False
+
+        # キーフレームの間隔
+        self._count += 1
+        if self._count >= self.interval:
+            self._counters["interval"] += 1
+            return False
+
+        gray = self._to_gray(img)
+        fx, fy = self._factor
+
+        # BOXの外の画素(変化の確認に使う)
+        outside = np.ones(gray.shape, dtype=bool)
+
+        moves = []
+        for track, template, (kx, ky) in self._templates:
+            th, tw = template.shape
+
+            # キーフレームの後に削除されたオブジェクトは動かさない
+            if tracking_objects.get(track.id) is not track:
+                continue
+
+            # 信頼度が閾値を下回ったら、推論で確認し直す
+            conf = track.conf * self.conf_decay
+            if conf < CONF:
+                self._counters["lost"] += 1
+                return False
+
+            # 前のフレームでの位置の周囲を探す
+            x, y = self._gray_box(track.box, (fx, fy), gray.shape)[:2]
+            found = self._match(gray, template, x, y)
+            if found is None or found[2] < self.min_score:
+                self._counters["lost"] += 1
+                return False
+
+            nx, ny, _ = found
+            moves.append((track, (nx - x) / fx, (ny - y) / fy, conf))
+
+            outside[ky:ky + th, kx:kx + tw] = False
+            outside[ny:ny + th, nx:nx + tw] = False
+
+        # BOXの外で変化があれば、新しい物体が現れたかもしれないので推論する
+        changed = np.count_nonzero((np.abs(gray - self._gray) >= self.pixel_threshold) & outside)
+        if changed >= gray.size * self.area_threshold:
+            self._counters["motion"] += 1
+            return False
+
+        # 検出された場合と同じように、位置と静止時間を更新する
+        tracking_objects.begin_frame()
+        for track, dx, dy, conf in moves:
+            x1, y1, x2, y2 = track.box
+            box = (round(x1 + dx), round(y1 + dy), round(x2 + dx), round(y2 + dy))
+            pos = (round(track.pos[0] + dx), round(track.pos[1] + dy))
+            update_track(track, pos, box, conf, timestamp)
+            tracking_objects.update(track)
+
+        self._counters["propagated"] += 1
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        前回の呼び出しから今回までの、キーフレームとBOXを動かしたフレームの数を返します
+
+        Returns:
+            dict : keyframes(推論したフレーム数)、propagated(BOXを動かしたフレーム数)、
+                   interval / lost / motion(理由ごとのキーフレームにした数)、propagate_ratio(BOXを動かした割合)
+        """
+        res = dict(self._counters)
+        total = res["keyframes"] + res["propagated"]
+        res["propagate_ratio"] = round(res["propagated"] / total, 3) if total > 0 else 0.0
+
+        self._counters = {k : 0 for k in self._counters}
+
+        return res
+
+    def _to_gray(self, img : Image) -> np.ndarray:
+        """
+        縮小したグレースケール画像に変換します
+
+        Args:
+            img (Image) : フレーム画像
+
+        Returns:
+            ndarray : 縮小画像 (高さ, 幅)
+        """
+        size = (self.width, max(1, round(self.width * img.height / img.width)))
+        return np.asarray(img.convert("L").resize(size, Image.BOX), dtype=np.float32)
+
+    def _gray_box(self, box : tuple, factor : tuple, shape : tuple) -> tuple:
+        """
+        元の解像度のBOX座標を、縮小画像の座標にします(小さいBOXはMIN_TEMPLATE_SIZEまで広げる)
+
+        Args:
+            box (tuple)    : BOX座標 (x1, y1, x2, y2)
+            factor (tuple) : 縮小画像の座標にする倍率(横, 縦)
+            shape (tuple)  : 縮小画像の大きさ (高さ, 幅)
+
+        Returns:
+            tuple : 縮小画像のBOX座標 (x1, y1, x2, y2)
+        """
+        h, w = shape
+        x1, x2 = round(box[0] * factor[0]), round(box[2] * factor[0])
+        y1, y2 = round(box[1] * factor[1]), round(box[3] * factor[1])
+
+        size = self.MIN_TEMPLATE_SIZE
+        if x2 - x1 < size:
+            x1 = (x1 + x2 - size) // 2
+            x2 = x1 + size
+        if y2 - y1 < size:
+            y1 = (y1 + y2 - size) // 2
+            y2 = y1 + size
+
+        x1 = min(max(x1, 0), max(w - (x2 - x1), 0))
+        y1 = min(max(y1, 0), max(h - (y2 - y1), 0))
+
+        return x1, y1, min(x1 + (x2 - x1), w), min(y1 + (y2 - y1), h)
+
+    def _match(self, gray : np.ndarray, template : np.ndarray, x : int, y : int) -> tuple:
+        """
+        (x, y)の周囲search_rangeの範囲で、テンプレートと最も一致する位置を探します(正規化相互相関)
+
+        Args:
+            gray (ndarray)     : 縮小画像
+            template (ndarray) : テンプレート
+            x (int)            : 探す中心の位置(テンプレートの左上)
+            y (int)            : 探す中心の位置(テンプレートの左上)
+
+        Returns:
+            tuple : (x, y, 一致度)、探す範囲が画像に収まらない場合はNone
+        """
+        th, tw = template.shape
+        r = self.search_range
+
+        x1, y1 = max(0, x - r), max(0, y - r)
+        region = gray[y1:min(gray.shape[0], y + th + r), x1:min(gray.shape[1], x + tw + r)]
+        if region.shape[0] < th or region.shape[1] < tw:
+            return None
+
+        # 大きいテンプレートは間引いて比較する
+        step = max(1, math.ceil(max(th, tw) / self.MAX_TEMPLATE_SIZE))
+        windows = np.lib.stride_tricks.sliding_window_view(region, (th, tw))[:, :, ::step, ::step]
+        t = template[::step, ::step]
+
+        w = windows - windows.mean(axis=(2, 3), keepdims=True)
+        t = t - t.mean()
+        tt = (t * t).sum()
+
+        if tt < 1e-6:
+            # 輝度が一様なテンプレートは、輝度の差で比較する
+            scores = 1.0 - np.abs(windows - template[::step, ::step]).mean(axis=(2, 3)) / 255.0
+        else:
+            denom = np.sqrt((w * w).sum(axis=(2, 3)) * tt)
+            scores = (w * t).sum(axis=(2, 3)) / np.maximum(denom, 1e-6)
+
+        iy, ix = np.unravel_index(np.argmax(scores), scores.shape)
+        best = float(scores[iy, ix])
+
+        # 動いていない位置の一致度がほぼ同じなら、動いていないとみなす
+        sy, sx = y - y1, x - x1
+        if 0 <= sy < scores.shape[0] and 0 <= sx < scores.shape[1] and scores[sy, sx] >= best - self.STILL_MARGIN:
+            iy, ix = sy, sx
+
+        return x1 + int(ix), y1 + int(iy), best
+
+
+class SharedSlots:
+    """
+    ワーカープロセスとの画像データの受け渡しに使う共有メモリを使い回します
+    空いている共有メモリが足りない場合は、新しく作成します
+    """
+
+    # 共有メモリを確保する単位(バイト)
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = []
+        self._all = []
+
+    def acquire(self, size : int) -> SharedMemory:
+        """
+        size以上の大きさの共有メモリを取得します
+
+        Args:
+            size (int) : 必要な大きさ(バイト)
+
+        Returns:
+            SharedMemory : 共有メモリ(使い終わったらrelease()で返す)
+        """
+        size = max(1, math.ceil(size / self.BLOCK_SIZE)) * self.BLOCK_SIZE
+
+        with self._lock:
+            for i, shm in enumerate(self._free):
+                if shm.size >= size:
+                    return self._free.pop(i)
+
+            # 空いているものが小さすぎる場合は、作り直す
+            if len(self._free) > 0:
+                self._discard(self._free.pop())
+
+            shm = SharedMemory(create=True, size=size)
+            self._all.append(shm)
+
+            return shm
+
+    def release(self, shm : SharedMemory):
+        """
+        共有メモリを返します
+
+        Args:
+            shm (SharedMemory) : acquire()で取得した共有メモリ
+        """
+        with self._lock:
+            self._free.append(shm)
+
+    def close(self):
+        """
+        すべての共有メモリを破棄します
+        """
+        with self._lock:
+            for shm in list(self._all):
+                self._discard(shm)
+            self._free.clear()
+
+    def _discard(self, shm : SharedMemory):
+        """
+        共有メモリを破棄します(ロックを取得した状態で呼ぶ)
+        """
+        self._all.remove(shm)
+        shm.close()
+        shm.unlink()
+
+
+# ワーカープロセスで開いた共有メモリ(名前 → SharedMemory)
+_worker_shms = {}
+
+# ワーカープロセスで開いたままにしておく共有メモリの最大数
+_WORKER_SHM_CACHE_SIZE = 32
+
+
+def _worker_init():
+    """
+    ワーカープロセスの初期化
+    Ctrl+Cはメインプロセスで処理するので、ワーカープロセスでは無視する
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _worker_buffer(name : str) -> memoryview:
+    """
+    ワーカープロセスで共有メモリを開きます(開いたものは使い回す)
+
+    Args:
+        name (str) : 共有メモリの名前
+
+    Returns:
+        memoryview : 共有メモリのバッファ
+    """
+    shm = _worker_shms.get(name)
+    if shm is None:
+        # 作り直されて使われなくなったものが溜まらないよう、上限を超えたら全部閉じる
+        if len(_worker_shms) >= _WORKER_SHM_CACHE_SIZE:
+            for s in _worker_shms.values():
+                s.close()
+            _worker_shms.clear()
+
+        shm = SharedMemory(name=name)
+        _worker_shms[name] = shm
+
+    return shm.buf
+
+
+def _decode_task(src : str, length : int, dst : str, min_size : int) -> tuple:
+    """
+    ワーカープロセスでJPEGをデコードし、RGBの画素データを共有メモリに書き込みます
+
+    Args:
+        src (str)      : JPEGが書き込まれた共有メモリの名前
+        length (int)   : JPEGの長さ(バイト)
+        dst (str)      : 画素データを書き込む共有メモリの名前
+        min_size (int) : decode_frameのmin_size
+
+    Returns:
+        tuple : (画像サイズ, 倍率)
+    """
+    img, scale = decode_frame(bytes(_worker_buffer(src)[:length]), min_size)
+    data = img.convert("RGB").tobytes()
+    _worker_buffer(dst)[:len(data)] = data
+
+    return img.size, scale
+
+
+def _annotate_task(src : str, length : int, size : tuple, dst : str, args : tuple) -> int:
+    """
+    ワーカープロセスで枠を描画してJPEGにエンコードし、共有メモリに書き込みます
+
+    Args:
+        src (str)     : 画像が書き込まれた共有メモリの名前
+        length (int)  : 画像データの長さ(バイト)
+        size (tuple)  : RGBの画素データの場合は画像サイズ、JPEGの場合はNone
+        dst (str)     : JPEGを書き込む共有メモリの名前
+        args (tuple)  : create_result_jpegの画像以外の引数
+
+    Returns:
+        int : JPEGの長さ(バイト)
+    """
+    data = bytes(_worker_buffer(src)[:length])
+    img = Image.open(BytesIO(data)) if size is None else Image.frombytes("RGB", size, data)
+
+    jpeg = create_result_jpeg(img, *args)
+
+    buf = _worker_buffer(dst)
+    if len(jpeg) > len(buf):
+        raise RuntimeError(f"Encoded image is too large ({len(jpeg)} bytes)")
+    buf[:len(jpeg)] = jpeg
+
+    return len(jpeg)
+
+
+class WorkerPool:
+    """
+    JPEGのデコードと、枠の描画 + JPEGエンコードを別プロセスで行います
+
+    推論と同じプロセスで行うとGILを取り合うため、検知物体が多く描画に時間がかかるシーンで推論が遅れます
+    画像データはpickleせず、共有メモリ(SharedMemory)で受け渡します
+    ワーカープロセスが異常終了した場合は、以降は同じプロセス内で処理します
+    """
+
+    def __init__(self, processes : int):
+        """
+        スレッドのロックの状態などを引き継がないよう、スレッドを開始する前に呼び出してください
+
+        Args:
+            processes (int) : ワーカープロセスの数
+        """
+        # 共有メモリを管理するresource_trackerをforkの前に起動して、ワーカープロセスと共有する
+        # (ワーカープロセスが別々に起動すると、ワーカープロセスの終了時に共有メモリが破棄されてしまう)
+        resource_tracker.ensure_running()
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_worker_init)
+        self._slots = SharedSlots()
+
+        # 最初の呼び出しでワーカープロセスがすべて起動するので、ここで起動しておく
+        self._executor.submit(int).result()
+
+        print(f"Worker pool started: {processes} processes")
+
+    def decode(self, frames : list, min_sizes : list) -> list:
+        """
+        カメラフレーム画像(JPEG)をまとめてデコードします
+        (decode_frameでデコードして、画素を読み込んだものと同じ結果になります)
+
+        Args:
+            frames (list)    : カメラフレーム画像(JPEG)のリスト
+            min_sizes (list) : フレームごとのdecode_frameのmin_size
+
+        Returns:
+            list : (PIL Image, 元の解像度に戻すための倍率(横, 縦)) のリスト
+        """
+        if self._executor is None:
+            return [self._decode_local(frame, min_size) for frame, min_size in zip(frames, min_sizes)]
+
+        slots = []
+        try:
+            tasks = []
+            for frame, min_size in zip(frames, min_sizes):
+                # ヘッダだけ読んで、デコード後のサイズを求める
+                img, _ = decode_frame(frame, min_size)
+
+                src = self._slots.acquire(len(frame))
+                slots.append(src)
+                dst = self._slots.acquire(img.width * img.height * 3)
+                slots.append(dst)
+
+                src.buf[:len(frame)] = frame
+                tasks.append((dst, self._executor.submit(_decode_task, src.name, len(frame), dst.name, min_size)))
+
+            res = []
+            for dst, future in tasks:
+                size, scale = future.result()
+                res.append((Image.frombytes("RGB", size, dst.buf[:size[0] * size[1] * 3]), scale))
+
+            return res
+
+        except BrokenProcessPool:
+            self._broken()
+            return [self._decode_local(frame, min_size) for frame, min_size in zip(frames, min_sizes)]
+
+        finally:
+            for shm in slots:
+                self._slots.release(shm)
+
+    def annotate(self, src, *args) -> bytes:
+        """
+        画像に枠を描画してJPEGにエンコードします
+        (create_result_jpegと同じ結果になります)
+
+        Args:
+            src   : PIL Image またはカメラフレーム画像(JPEG)
+            *args : create_result_jpegの画像以外の引数
+
+        Returns:
+            bytes : 枠を描画したJPEG画像
+        """
+        if self._executor is None:
+            return self._annotate_local(src, *args)
+
+        if isinstance(src, Image.Image):
+            data = src.convert("RGB").tobytes()
+            size = src.size
+        else:
+            data = src
+            size = None
+
+        w, h = src.size if size is not None else Image.open(BytesIO(src)).size
+
+        slots = []
+        try:
+            src_shm = self._slots.acquire(len(data))
+            slots.append(src_shm)
+            # JPEGは画素データより大きくなることはないので、画素データの大きさ + ヘッダ分を確保する
+            dst_shm = self._slots.acquire(w * h * 3 + 65536)
+            slots.append(dst_shm)
+
+            src_shm.buf[:len(data)] = data
+            length = self._executor.submit(_annotate_task, src_shm.name, len(data), size, dst_shm.name, args).result()
+
+            return bytes(dst_shm.buf[:length])
+
+        except BrokenProcessPool:
+            self._broken()
+            return self._annotate_local(src, *args)
+
+        finally:
+            for shm in slots:
+                self._slots.release(shm)
+
+    def close(self):
+        """
+        ワーカープロセスを終了し、共有メモリを破棄します
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._slots.close()
+
+    def _broken(self):
+        """
+        ワーカープロセスが異常終了したので、以降は同じプロセス内で処理します
+        """
+        if self._executor is not None:
+            print("Worker pool is broken, decoding and encoding in the main process")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _decode_local(self, frame : bytes, min_size : int) -> tuple:
+        img, scale = decode_frame(frame, min_size)
+        img.load()
+        return img, scale
+
+    def _annotate_local(self, src, *args) -> bytes:
+        img = src if isinstance(src, Image.Image) else Image.open(BytesIO(src))
+        return create_result_jpeg(img, *args)
+
+
+def publish(item : tuple, camera : "Camera"):
+    """
+    トラッキング結果を公開します
+    (Pipelineの公開スレッドから呼ばれます)
+
+    Args:
+        item (tuple)    : (時間(Unixtime), カメラフレーム画像(JPEG), PIL Image, decode_frameの倍率, tracking_objectsのコピー,
+                           Push通知するオブジェクトのリスト(通知しない場合は空))
+        camera (Camera) : トラッキング結果を公開するカメラ(Push通知の送信キュー、プレビューの保存先)
+
+    Returns:
+        なし
+    """
+    timestamp, frame, img, scale, tracking_objects, changed = item
+    alert = len(changed) > 0
+
+    # 元の解像度の画像に描画するかどうか
+    # サムネイルや切り出した画像をPush通知する場合は、推論に使った縮小画像に描画する
+    full = alert and PUSH_IMAGE_MODE not in ("thumbnail", "crops")
+    src = frame
+
+    if camera.pool is not None:
+        # 描画とJPEGエンコードはワーカープロセスで行う
+        # Push通知する画像は元の解像度のJPEGから、プレビューだけの場合は推論に使った縮小画像から生成する
+        with metrics.measure("encode"):
+            if full:
+                frame = camera.pool.annotate(frame, tracking_objects)
+            else:
+                frame = camera.pool.annotate(img, tracking_objects, scale)
+
+    else:
+        # Push通知する画像は元の解像度で生成する
+        # プレビューだけの場合は、推論に使った縮小画像にそのまま描画する
+        if full and scale != (1.0, 1.0):
+            with metrics.measure("decode"):
+                img = Image.open(BytesIO(frame))
+                img.load()
+            scale = (1.0, 1.0)
+
+        # 結果を書き込んだJPEG画像の生成
+        frame = create_result_jpeg(img, tracking_objects, scale)
+
+    if alert:
+        # 複数のカメラを処理している場合は、どのカメラの結果かを含める
+        # (changedはフレームごとのコピーなので、そのまま書き換えてよい)
+        if camera.tagged:
+            for p in changed:
+                p["camera"] = camera.name
+
+        # Push通知する画像
+        # 切り出す場合は、状態が変わったオブジェクトだけを切り出す
+        with metrics.measure("encode"):
+            boxes = [(p["box"]["x1"], p["box"]["y1"], p["box"]["x2"], p["box"]["y2"]) for p in changed]
+            image = create_push_image(src, frame, boxes)
+
+        # PUSH通知
+        # 画像には全オブジェクトを描画し、結果情報には状態が変わったオブジェクトだけを含める
+        # 送信はワーカースレッドで行うので、ここでは待たない
+        camera.push_queue.put(timestamp, image, changed)
+
+    # 結果確認用のプレビューイメージの保存
+    # HTTP配信が有効な場合は、ファイルには書き込まずメモリ上の画像を配信する
+    with metrics.measure("preview"):
+        if camera.preview is not None:
+            camera.preview.update(frame)
+        else:
+            with open(camera.preview_image_path, 'wb') as f:
+                f.write(frame)
+
+
+class Camera:
+    """
+    1台のカメラの処理に必要なもの(フレームの取得元、パイプライン、Push通知の送信キュー、プレビュー)と、
+    カメラごとのトラッキング情報を保持します
+    """
+
+    def __init__(self, name : str, stream_command : str, stream_format : str,
+                 preview_image_path : str, preview_http_port : int, on_frame = None, tagged : bool = False,
+                 pool : WorkerPool = None, rois : list = None, track_state_path : str = ""):
+        """
+        Args:
+            name (str)               : カメラの名前
+            stream_command (str)     : ストリーミングコマンド(空の場合は aicap get_frame)
+            stream_format (str)      : ストリーミングコマンドの出力形式
+            preview_image_path (str) : プレビュー画像の保存パス
+            preview_http_port (int)  : プレビュー画像をHTTPで配信するポート番号(0の場合は配信しない)
+            on_frame                 : 新しいフレームを取得するたびに呼ばれる関数
+            tagged (bool)            : Push通知の結果情報にカメラの名前を含めるかどうか
+            pool (WorkerPool)        : 描画とJPEGエンコードを行うワーカープロセス(使わない場合はNone)
+            rois (list)              : 推論する領域(ROI)の多角形のリスト(空の場合はフレーム全体)
+            track_state_path (str)   : トラッキング情報の保存先(空の場合は保存しない)
+        """
+        self.name = name
+        self.tagged = tagged
+        self.preview_image_path = preview_image_path
+        self.pool = pool
+
+        # トラッキングオブジェクト情報の管理
+        self.tracking_objects = TrackStore()
+
+        # トラッキング情報の保存
+        # 前回保存したオブジェクトは引き継ぎ待ちとして復元し、新しいトラッキングIDのオブジェクトに引き継ぐ
+        self.journal = TrackJournal(track_state_path, TRACK_STATE_INTERVAL_SEC, TRACK_STATE_COMPACT_RECORDS) if track_state_path else None
+        if self.journal is not None:
+            now = int(datetime.now(tz=timezone.utc).timestamp())
+            restored = self.journal.load(now, TRACK_RESTORE_MAX_AGE_SEC)
+            self.tracking_objects.restore(restored, now + TRACK_RESTORE_WAIT_SEC)
+            self.journal.compact(self.tracking_objects)
+            print(f"Restored {len(restored)} tracks from {track_state_path}")
+
+        # オブジェクトごとのアラート状態
+        self.alerts = AlertStateMachine(WARNING_SEC, ALERT_SEC, ALERT_COOLDOWN_SEC, ALERT_PUSH_ON_WARNING)
+
+        # トラッカー(モデルとは別に、カメラごとに保持する)
+        self.tracker = TrackerState()
+
+        # トラッキングに使った画像サイズ
+        self.frame_w = 0
+        self.frame_h = 0
+
+        # 推論する領域の切り出し(ROIを指定しない場合はNone)
+        self.roi = RoiCropper(rois, ROI_TILED, MODEL_INPUT_SIZE, ROI_TILE_OVERLAP) if rois else None
+
+        # フレームをデコードする際の長辺の最小サイズ
+        self.decode_size = self.roi.decode_size() if self.roi is not None else MODEL_INPUT_SIZE
+
+        # 推論を省略するかどうかの判定
+        self.gate = MotionGate(MOTION_PIXEL_THRESHOLD, MOTION_AREA_THRESHOLD, MOTION_FORCE_INTERVAL_SEC)
+
+        # キーフレームの間にBOXを動かす(キーフレームを使わない場合はNone)
+        self.propagator = BoxPropagator(
+            KEYFRAME_INTERVAL,
+            KEYFRAME_MATCH_WIDTH,
+            KEYFRAME_SEARCH_RANGE,
+            KEYFRAME_MIN_SCORE,
+            KEYFRAME_CONF_DECAY,
+            MOTION_PIXEL_THRESHOLD,
+            MOTION_AREA_THRESHOLD) if KEYFRAME_INTERVAL > 0 else None
+
+        # カメラフレームの取得元
+        self.source = FrameSource(stream_command, stream_format)
+
+        # Push通知の送信キュー
+        self.push_queue = PushQueue(
+            PUSH_QUEUE_SIZE,
+            drop_policy=PUSH_DROP_POLICY,
+            retry_count=PUSH_RETRY_COUNT,
+            retry_interval=PUSH_RETRY_INTERVAL_SEC,
+            retry_interval_max=PUSH_RETRY_INTERVAL_MAX_SEC)
+
+        # プレビューのHTTP配信
+        self.preview = PreviewServer(preview_http_port) if preview_http_port > 0 else None
+
+        # フレームレートの制御
+        self.scheduler = FrameScheduler(TARGET_FPS, IDLE_FPS, IDLE_AFTER_SEC)
+
+        # 検知した前後の映像の保存
+        self.clip = ClipRecorder(
+            CLIP_DIR,
+            name if tagged else "",
+            CLIP_PRE_SEC,
+            CLIP_POST_SEC,
+            CLIP_BUFFER_MAX_BYTES,
+            CLIP_MAX_SEC,
+            CLIP_KEEP_COUNT) if CLIP_DIR else None
+
+        # 取得 / 推論 / 公開 のパイプライン
+        self.pipeline = Pipeline(
+            self.source,
+            lambda item: publish(item, self),
+            self.scheduler,
+            on_frame,
+            self.clip)
+
+    def start(self):
+        """
+        プレビューの配信とパイプラインを開始します
+        """
+        if self.preview is not None:
+            self.preview.start()
+        self.pipeline.start()
+
+    def close(self):
+        """
+        フレームの取得を終了します
+        (書き込み待ちのクリップは、そこまでのフレームで書き込み、トラッキング情報は終了時の状態で保存する)
+        """
+        self.source.close()
+        if self.clip is not None:
+            self.clip.close()
+        if self.journal is not None:
+            self.journal.close(self.tracking_objects)
+
+    def print_stats(self):
+        """
+        統計情報を出力します
+        """
+        suffix = f" ({self.name})" if self.tagged else ""
+        print(f"frame source{suffix}: {json.dumps(self.source.stats())}")
+        print(f"push queue{suffix}: {json.dumps(self.push_queue.stats())}")
+        print(f"pipeline{suffix}: {json.dumps(self.pipeline.stats())}")
+        print(f"motion gate{suffix}: {json.dumps(self.gate.stats())}")
+        print(f"scheduler{suffix}: {json.dumps(self.scheduler.stats())}")
+        if self.clip is not None:
+            print(f"clips{suffix}: {json.dumps(self.clip.stats())}")
+        print(f"alerts{suffix}: {json.dumps(self.alerts.stats())}")
+        if self.propagator is not None:
+            print(f"keyframes{suffix}: {json.dumps(self.propagator.stats())}")
+        if self.journal is not None:
+            stats = dict(self.journal.stats(), orphans=self.tracking_objects.orphans, adopted=self.tracking_objects.adopted)
+            print(f"track journal{suffix}: {json.dumps(stats)}")
+
+
+def create_cameras(config : str, on_frame = None, pool : WorkerPool = None) -> list:
+    """
+    カメラの設定からCameraのリストを作成します
+
+    Args:
+        config (str)      : カメラの設定(JSON配列)、空の場合は従来通りの1台
+        on_frame          : 新しいフレームを取得するたびに呼ばれる関数
+        pool (WorkerPool) : 描画とJPEGエンコードを行うワーカープロセス(使わない場合はNone)
+
+    Returns:
+        list : Cameraのリスト
+    """
+    rois = json.loads(ROIS) if ROIS else []
+
+    if not config:
+        return [Camera("default", FRAME_STREAM_COMMAND, FRAME_STREAM_FORMAT, PREVIEW_IMAGE_PATH, PREVIEW_HTTP_PORT, on_frame,
+                       pool=pool, rois=rois, track_state_path=TRACK_STATE_PATH)]
+
+    base, ext = os.path.splitext(PREVIEW_IMAGE_PATH)
+    track_base, track_ext = os.path.splitext(TRACK_STATE_PATH)
+
+    cameras = []
+    for i, c in enumerate(json.loads(config)):
+        name = str(c.get("name", f"camera{i + 1}"))
+        if any(camera.name == name for camera in cameras):
+            raise ValueError(f"Duplicate camera name: {name}")
+
+        cameras.append(Camera(
+            name,
+            c.get("stream_command", FRAME_STREAM_COMMAND),
+            c.get("stream_format", FRAME_STREAM_FORMAT),
+            c.get("preview_image_path", f"{base}_{name}{ext}"),
+            int(c.get("preview_http_port", 0)),
+            on_frame,
+            tagged=True,
+            pool=pool,
+            rois=c.get("rois", rois),
+            track_state_path=f"{track_base}_{name}{track_ext}" if TRACK_STATE_PATH else ""))
+
+    return cameras
+
+
+def main():
+
+    # 設定ファイル
+    # 定数の代わりに設定値を指定でき、実行中の変更もメインループで反映する
+    config = RuntimeConfig(CONFIG_FILE_PATH, CONFIG_CHECK_INTERVAL_SEC)
+    config.load()
+    if not MODEL_FILE_NAME:
+        raise ValueError("MODEL_FILE_NAME is not set (environment variable or config file)")
+
+    # 結果情報をファイルや標準入力で渡す場合は、aicapのオプションが必要
+    # (Push通知のたびに失敗しないよう、起動時に確認する)
+    if PUSH_PAYLOAD_TRANSPORT not in ("arg", "file", "stdin"):
+        raise ValueError(f"invalid PUSH_PAYLOAD_TRANSPORT: {PUSH_PAYLOAD_TRANSPORT}")
+    if PUSH_PAYLOAD_TRANSPORT != "arg" and not PUSH_JSON_FILE_OPTION:
+        raise ValueError(f"PUSH_JSON_FILE_OPTION must be set when PUSH_PAYLOAD_TRANSPORT is {PUSH_PAYLOAD_TRANSPORT}")
+
+    # 読み込んだモデルの管理
+    # 複数のカメラを処理する場合も、モデルは1つだけ読み込む
+    models = ModelManager(MODEL_CACHE_SIZE, MODEL_INPUT_SIZE)
+
+    # 複数の画像をまとめて推論
+    predictor = BatchPredictor()
+
+    # 各カメラの新しいフレームをまとめて取り出す
+    collector = FrameCollector()
+
+    # デコードと描画 + JPEGエンコードを行うワーカープロセス
+    # プロセスはforkで起動するので、スレッドを開始する(カメラを作成する)前に起動しておく
+    pool = WorkerPool(WORKER_PROCESSES) if WORKER_PROCESSES > 0 else None
+
+    # 検知の記録
+    # オブジェクトごとの検知していた期間(削除したとき)と、警告とアラートを記録する
+    events = EventStore(EVENT_DB_PATH, EVENT_FLUSH_INTERVAL_SEC, EVENT_BATCH_SIZE, EVENT_QUEUE_SIZE) if EVENT_DB_PATH else None
+
+    # カメラごとの取得元、パイプライン、Push通知、プレビュー、トラッキング情報
+    cameras = create_cameras(CAMERAS, collector.notify, pool)
+    for camera in cameras:
+        camera.start()
+
+    def print_stats():
+        for camera in cameras:
+            camera.print_stats()
+        if events is not None:
+            print(f"events: {json.dumps(events.stats())}")
+
+    stats_time = time.monotonic()
+    metrics_time = time.monotonic()
+
+    # 推論でエラーが発生した場合の待ち時間
+    backoff = Backoff(ERROR_RETRY_INTERVAL_SEC, ERROR_RETRY_INTERVAL_MAX_SEC)
+
+    while True:
+
+        try:
+            # 設定ファイルが変更されていれば、次のフレームから反映する
+            # (トラッキング中のオブジェクトと静止時間はそのまま引き継ぐ)
+            if config.check():
+                for camera in cameras:
+                    camera.alerts.configure(WARNING_SEC, ALERT_SEC, ALERT_COOLDOWN_SEC, ALERT_PUSH_ON_WARNING)
+
+            # ビデオ映像取得
+            # 各カメラの取得スレッドが取得した最新のフレームを受け取る
+            batch = collector.collect(cameras)
+            metrics.inc("frames", len(batch))
+
+            with ExitStack() as stack:
+                for camera, _, _ in batch:
+                    stack.enter_context(camera.pipeline.inference_stage.busy())
+
+                # 推論するフレーム (Camera, PIL Image, 倍率, 時間)
+                targets = []
+
+                # PLI Imageに変換
+                # モデルの入力サイズ(ROIを指定したカメラは、ROIを切り出した大きさ)に合わせて縮小しながらデコードする
+                # ワーカープロセスを使う場合は、各カメラのフレームを並行してデコードする
+                # (デコード結果は (PIL Image, 倍率) のリストで、batchと同じ順番)
+                with metrics.measure("decode"):
+                    decoded = decode_frames(
+                        [frame for _, frame, _ in batch],
+                        [camera.decode_size for camera, _, _ in batch],
+                        pool)
+
+                for (camera, frame, timestamp), (img, scale) in zip(batch, decoded):
+
+                    # シーンに変化がなければ推論を省略し、前回の結果をそのまま使う
+                    if not MOTION_GATE_ENABLED or camera.gate.check(frame, img):
+
+                        # キーフレームでなければ推論せず、前回検出したBOXをテンプレートマッチングで動かす
+                        if camera.propagator is not None:
+                            with metrics.measure("propagate"):
+                                propagated = camera.propagator.propagate(img, camera.tracking_objects, timestamp)
+                            if propagated:
+                                metrics.inc("propagated")
+                                continue
+
+                        targets.append((camera, img, scale, timestamp))
+
+                        # 画像サイズが変わったら座標が合わなくなるので、トラッカーを初期化する
+                        # 追跡していたオブジェクトは引き継ぎ待ちにして、新しいトラッキングIDのオブジェクトに引き継ぐ
+                        # (BOX座標は元の解像度なので、カメラの解像度が変わっていなければ重なりで引き継げる)
+                        if img.width != camera.frame_w or img.height != camera.frame_h:
+                            camera.frame_w = img.width
+                            camera.frame_h = img.height
+                            camera.tracker.reset()
+                            camera.tracking_objects.orphan_all(timestamp + TRACK_RESTORE_WAIT_SEC)
+
+                    else:
+                        # 前回検出されたオブジェクトは、そのまま静止しているものとして静止時間を加算する
+                        camera.tracking_objects.hold(timestamp)
+                        metrics.inc("skipped")
+
+                if len(targets) > 0:
+
+                    # モデルを取得
+                    # 初めて使うモデルの場合は、ここでモデルの読み込みとウォームアップが行われる
+                    # (画像サイズが違うカメラやROIを切り出す場合も、同じモデルを共有する)
+                    model = models.get(MODEL_FILE_PATH)
+
+                    # 推論する画像
+                    # ROIを指定したカメラは、ROIを囲む矩形(またはタイル)を切り出す
+                    # (カメラごとに (切り出した画像, 位置) のリスト)
+                    crops = []
+                    for camera, img, _, _ in targets:
+                        crops.append(camera.roi.crop(img) if camera.roi is not None else [(img, (0, 0))])
+
+                    # 物体検知実行
+                    # 各カメラの画像をまとめて1回で推論する
+                    with metrics.measure("inference"):
+                        outputs = predictor.predict(
+                            model,
+                            [c for items in crops for c, _ in items],
+                            conf=CONF, 
+                            iou=IOU, 
+                            classes=CLASSES, 
+                            verbose=PREDICT_VERBOSE)
+
+                    # カメラごとに、切り出した画像の推論結果をフレーム全体の座標の1つの結果にまとめる
+                    results = []
+                    for (camera, img, _, _), items in zip(targets, crops):
+                        part, outputs = outputs[:len(items)], outputs[len(items):]
+                        results.append(camera.roi.merge(img, items, part, IOU) if camera.roi is not None else part[0])
+
+                    for (camera, _, scale, timestamp), result in zip(targets, results):
+
+                        # トラッキング実行
+                        # トラッカーはカメラごとに別々に保持する
+                        with metrics.measure("track"):
+                            tracked = camera.tracker.update([result])
+
+                        # 結果を確認し、tracking_objectsに格納する
+                        with metrics.measure("parse"):
+                            parse_results(tracked, timestamp, camera.tracking_objects, scale)
+                        metrics.inc("detections", len(tracked[0].boxes))
+
+                    # 推論したフレームを、次のキーフレームまでBOXを動かす基準にする
+                    for camera, img, scale, _ in targets:
+                        if camera.propagator is not None:
+                            with metrics.measure("propagate"):
+                                camera.propagator.keyframe(img, scale, camera.tracking_objects)
+
+            for (camera, frame, timestamp), (img, scale) in zip(batch, decoded):
+
+                tracking_objects = camera.tracking_objects
+
+                # 追跡中のオブジェクトがある間はフレームレートを上げる
+                camera.scheduler.set_active(any(tracking_objects.is_tracked(p) for p in tracking_objects))
+
+                # アラート状態が変わったオブジェクト(と再通知の間隔が過ぎたオブジェクト)があればPush通知
+                changed = camera.alerts.update(tracking_objects, timestamp)
+
+                # 警告とアラート(再通知を含む)を記録する
+                if events is not None:
+                    for t in changed:
+                        events.add("alert" if t.alert_state == "alerted" else "warning", camera.name, t.cls, timestamp, timestamp,
+                                   track=t.id, conf=round(t.conf, 3), stay_sec=t.stay_sec)
+
+                # アラート状態になった(再通知した)オブジェクトがあれば、そのフレームの前後の映像を保存する
+                if camera.clip is not None and any(t.alert_state == "alerted" for t in changed):
+                    camera.clip.trigger(camera.pipeline.captured)
+
+                # 描画、Push通知、プレビュー保存は公開スレッドで行う
+                # tracking_objectsは次のフレームで更新されるので、この時点の内容を辞書形式にコピーして渡す
+                # Push通知を伴うフレームは、伴わないフレームで上書きされないよう優先度を上げる
+                snapshot = tracking_objects.snapshot()
+                changed = [t.to_dict(True) for t in changed]
+                camera.pipeline.publish((timestamp, frame, img, scale, snapshot, changed), priority=1 if changed else 0)
+
+                # 時間がたったオブジェクトは削除する
+                removed = tracking_objects.prune(timestamp, OBJECT_RETENTION_TIME_SEC)
+
+                # 削除したオブジェクトは、最初に検出されてから最後に検出されるまでを1行として記録する
+                if events is not None:
+                    for t in removed:
+                        events.add("detection", camera.name, t.cls, t.first_timestamp, t.prev_timestamp,
+                                   track=t.id, conf=round(t.conf, 3), stay_sec=t.stay_sec)
+
+                # 更新されたトラッキング情報を保存する(一定の間隔でまとめて追記する)
+                if camera.journal is not None:
+                    camera.journal.record(tracking_objects)
+
+            backoff.reset()
+
+            # 統計情報を出力
+            if STATS_INTERVAL_SEC > 0 and time.monotonic() - stats_time >= STATS_INTERVAL_SEC:
+                print_stats()
+                stats_time = time.monotonic()
+
+            # 計測値をファイルに書き出す
+            if METRICS_FILE_PATH and time.monotonic() - metrics_time >= METRICS_INTERVAL_SEC:
+                metrics.write(METRICS_FILE_PATH)
+                metrics_time = time.monotonic()
+
+        except KeyboardInterrupt:
             print("Received SIGINT (Ctrl+C), exiting...")
+            print_stats()
+
+            # トラッキング情報を保存しない場合は、追跡中のオブジェクトもここまでで記録する
+            # (保存する場合は、再起動後に引き継いで削除したときに記録する)
+            if events is not None:
+                for camera in cameras:
+                    if camera.journal is None:
+                        for t in camera.tracking_objects.prune(float("inf"), 0):
+                            events.add("detection", camera.name, t.cls, t.first_timestamp, t.prev_timestamp,
+                                       track=t.id, conf=round(t.conf, 3), stay_sec=t.stay_sec)
+
+            for camera in cameras:
+                camera.close()
+            if pool is not None:
+                pool.close()
+            if events is not None:
+                events.close()
             sys.exit(0)
 
         except Exception as e:
             print(str(e))    
-            time.sleep(5)
+            metrics.inc("errors")
+            time.sleep(backoff.failed())
 
 
 if __name__ == "__main__":
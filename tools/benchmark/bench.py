@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+検知プログラムのベンチマーク
+
+ベンチマーク用のaicapコマンド(bin/aicap)をPATHの先頭に置いて、録画済みのJPEG画像で
+各プログラムのextmod.pyを一定フレーム数だけ実行し、結果をJSONで出力します
+
+使用例)
+    python3 tools/benchmark/bench.py --frames ~/frames --count 300 --model ~/models/yolo11n_ncnn_model
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROGRAMS_DIR = os.path.join(BENCH_DIR, "..", "..", "programs")
+
+# 既定で実行するプログラム
+DEFAULT_PROGRAMS = ["built-in-object-detection", "stay_counter", "bear_repellent"]
+
+# モデルの準備ができたことを示す出力
+READY_LINE = "Model ready"
+
+# 統計情報の出力(「名前: {JSON}」の形式、複数のカメラを処理する場合は「名前 (カメラ名): {JSON}」)
+STATS_LINE = re.compile(r"^((?:frame source|push queue|pipeline|motion gate|scheduler|alerts|deterrent|clips|track journal|events|cascade|keyframes)(?: \(.+\))?): (\{.*\})$")
+
+# SIGINTを送ってから終了を待つ時間(秒)
+EXIT_TIMEOUT_SEC = 30
+
+
+def model_file_name(program_dir : str) -> str:
+    """
+    docker-compose.ymlからMODEL_FILE_NAMEを取得します
+
+    Args:
+        program_dir (str) : プログラムのディレクトリ
+
+    Returns:
+        str : モデルファイル名(見つからない場合は空文字列)
+    """
+    try:
+        with open(os.path.join(program_dir, "docker-compose.yml")) as f:
+            m = re.search(r"MODEL_FILE_NAME:\s*(\S+)", f.read())
+            return m.group(1) if m else ""
+    except OSError:
+        return ""
+
+
+def read_served(state_dir : str) -> int:
+    """
+    aicapが配信したフレーム数を返します
+
+    Args:
+        state_dir (str) : aicapの記録ディレクトリ
+
+    Returns:
+        int : 配信したフレーム数
+    """
+    try:
+        with open(os.path.join(state_dir, "served.json")) as f:
+            return json.loads(f.read() or "{}").get("count", 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def read_pushes(state_dir : str) -> dict:
+    """
+    aicapが記録したPush通知を集計します
+
+    Args:
+        state_dir (str) : aicapの記録ディレクトリ
+
+    Returns:
+        dict : 件数(count)、画像の合計サイズ(image_bytes)、JSONの合計サイズ(json_bytes)
+    """
+    res = {"count" : 0, "image_bytes" : 0, "json_bytes" : 0}
+    try:
+        with open(os.path.join(state_dir, "pushes.jsonl")) as f:
+            for line in f:
+                record = json.loads(line)
+                res["count"] += 1
+                res["image_bytes"] += record["image_bytes"]
+                res["json_bytes"] += record["json_bytes"]
+    except OSError:
+        pass
+
+    return res
+
+
+def poll_exit(proc : subprocess.Popen) -> bool:
+    """
+    プロセスが終了していれば回収して、終了コードとリソース使用量を記録します
+    (RUSAGE_CHILDRENは実行済みの全プロセスの最大値になってしまうので、wait4でプロセスごとに取得する)
+
+    Args:
+        proc (subprocess.Popen) : プロセス
+
+    Returns:
+        bool : 終了している場合はTrue(proc.returncodeとproc.rusageが設定される)
+    """
+    if proc.returncode is None:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            proc.rusage = rusage
+
+    return proc.returncode is not None
+
+
+def wait_exit(proc : subprocess.Popen, timeout : float):
+    """
+    プロセスの終了を待ちます
+
+    Args:
+        proc (subprocess.Popen) : プロセス
+        timeout (float)         : 待ち時間(秒)。過ぎた場合は強制終了する
+    """
+    deadline = time.monotonic() + timeout
+    while not poll_exit(proc):
+        if time.monotonic() > deadline:
+            proc.kill()
+            deadline = float("inf")
+
+        time.sleep(0.1)
+
+
+def run(program : str, args) -> dict:
+    """
+    プログラムを1つ実行して、結果を返します
+
+    Args:
+        program (str) : プログラムのディレクトリ名またはパス
+        args          : コマンドライン引数
+
+    Returns:
+        dict : 結果
+    """
+    program_dir = program if os.path.isdir(program) else os.path.join(PROGRAMS_DIR, program)
+    program_dir = os.path.abspath(program_dir)
+    name = os.path.basename(program_dir)
+
+    state_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+
+    env = dict(os.environ)
+    env.update({
+        "PATH" : os.path.join(BENCH_DIR, "bin") + os.pathsep + env.get("PATH", ""),
+        "PYTHONUNBUFFERED" : "1",
+        "AICAP_BENCH_FRAMES" : os.path.abspath(args.frames),
+        "AICAP_BENCH_STATE" : state_dir,
+        "AICAP_BENCH_FPS" : str(args.fps),
+        "AICAP_BENCH_PUSH_DELAY_SEC" : str(args.push_delay),
+        "MODEL_FILE_NAME" : os.path.abspath(args.model) if args.model else model_file_name(program_dir),
+        "PREVIEW_IMAGE_PATH" : os.path.join(state_dir, "result.jpg"),
+        "PREVIEW_HTTP_PORT" : "0",
+        # 統計情報は終了時の1回だけ出力させる
+        "STATS_INTERVAL_SEC" : "0",
+    })
+    if args.stream:
+        env["FRAME_STREAM_COMMAND"] = "aicap stream"
+        env["FRAME_STREAM_FORMAT"] = "mjpeg"
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    print(f"[{name}] starting ({state_dir})", file=sys.stderr)
+
+    proc = subprocess.Popen(
+        [args.python, "extmod.py"],
+        cwd=program_dir,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace"
+    )
+
+    ready = threading.Event()
+    stats = {}
+    log = []
+
+    def reader():
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            log.append(line)
+            if args.verbose:
+                print(f"[{name}] {line}", file=sys.stderr)
+            if READY_LINE in line:
+                ready.set()
+            m = STATS_LINE.match(line)
+            if m:
+                stats[m.group(1)] = json.loads(m.group(2))
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+
+    start = time.monotonic()
+    error = None
+
+    # モデルの読み込みが終わるまで待つ(読み込み時間は計測に含めない)
+    while not ready.wait(0.2):
+        if poll_exit(proc):
+            error = "exited before model was ready"
+            break
+        if time.monotonic() - start > args.timeout:
+            error = "timed out waiting for model"
+            break
+
+    load_sec = time.monotonic() - start
+    served_base = read_served(state_dir)
+    bench_start = time.monotonic()
+
+    while error is None and read_served(state_dir) - served_base < args.count:
+        if poll_exit(proc):
+            error = "exited during benchmark"
+            break
+        if time.monotonic() - bench_start > args.timeout:
+            error = "timed out during benchmark"
+            break
+        time.sleep(0.05)
+
+    duration = time.monotonic() - bench_start
+    served = read_served(state_dir) - served_base
+
+    if not poll_exit(proc):
+        proc.send_signal(signal.SIGINT)
+    wait_exit(proc, EXIT_TIMEOUT_SEC)
+    rusage = proc.rusage
+    t.join(5)
+
+    frames = sum(v.get("frames", 0) for k, v in stats.items() if k.startswith("pipeline"))
+
+    res = {
+        "program" : name,
+        "returncode" : proc.returncode,
+        "error" : error,
+        "model_load_sec" : round(load_sec, 2),
+        "duration_sec" : round(duration, 2),
+        "frames_served" : served,
+        "frames_inferred" : frames,
+        "throughput_fps" : round(frames / duration, 2) if duration > 0 else 0.0,
+        # Linuxではキロバイト単位
+        "peak_rss_mb" : round(rusage.ru_maxrss / 1024, 1),
+        "cpu_sec" : round(rusage.ru_utime + rusage.ru_stime, 2),
+        "pushes" : read_pushes(state_dir),
+        "stats" : stats,
+    }
+
+    if error is not None:
+        res["log_tail"] = log[-20:]
+
+    if not args.keep:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    print(f"[{name}] {res['throughput_fps']} fps, {res['peak_rss_mb']} MB, {res['pushes']['count']} pushes"
+          + (f" ({error})" if error else ""), file=sys.stderr)
+
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark for the detection programs")
+    parser.add_argument("programs", nargs="*", default=DEFAULT_PROGRAMS,
+                        help="program directories (names under programs/ or paths)")
+    parser.add_argument("--frames", required=True, help="directory of recorded JPEG frames")
+    parser.add_argument("--count", type=int, default=300, help="frames to serve after the model is ready")
+    parser.add_argument("--fps", type=float, default=10.0, help="camera frame rate (0: as fast as requested)")
+    parser.add_argument("--stream", action="store_true", help="use FRAME_STREAM_COMMAND instead of get_frame")
+    parser.add_argument("--push-delay", type=float, default=0.0, help="seconds each push takes")
+    parser.add_argument("--model", default="", help="model path (default: MODEL_FILE_NAME in docker-compose.yml)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment variable")
+    parser.add_argument("--python", default=sys.executable, help="python interpreter to run extmod.py")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds before giving up on a program")
+    parser.add_argument("--out", default="", help="write results to this JSON file (default: stdout)")
+    parser.add_argument("--keep", action="store_true", help="keep the aicap state directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="echo program output")
+    args = parser.parse_args()
+
+    results = {
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host" : {
+            "platform" : platform.platform(),
+            "machine" : platform.machine(),
+            "python" : platform.python_version(),
+            "cpu_count" : os.cpu_count(),
+        },
+        "config" : {
+            "frames" : os.path.abspath(args.frames),
+            "count" : args.count,
+            "fps" : args.fps,
+            "stream" : args.stream,
+            "push_delay" : args.push_delay,
+            "model" : args.model,
+            "env" : args.env,
+        },
+        "results" : [run(p, args) for p in args.programs],
+    }
+
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    sys.exit(1 if any(r["error"] for r in results["results"]) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+検知の記録の集計
+
+各プログラムが記録した検知の記録(EVENT_DB_PATH、SQLite)から、期間を指定して
+件数、検知していた時間、静止時間を集計したり、記録の一覧を出力します
+
+使用例)
+    python3 tools/events/events.py /home/cap/aicap/extmod/events.db summary --since 7d
+    python3 tools/events/events.py events.db list --since 2026-10-01 --until 2026-10-08 --kind alert
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+# 相対時間の単位(秒)
+DURATION_UNITS = {"s" : 1, "m" : 60, "h" : 3600, "d" : 86400, "w" : 604800}
+
+# 一覧で出力する列
+LIST_COLUMNS = ["kind", "camera", "cls", "track", "start_time", "end_time", "frames", "conf", "stay_sec"]
+
+
+def parse_time(value : str, now : float) -> float:
+    """
+    時間の指定をUnixtimeに変換します
+
+    Args:
+        value (str) : 相対時間(「7d」「12h」「30m」など、現在からさかのぼる)、日時(ISO 8601)、またはUnixtime
+        now (float) : 現在の時間(Unixtime)
+
+    Returns:
+        float : Unixtime
+    """
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhdw])", value)
+    if m:
+        return now - float(m.group(1)) * DURATION_UNITS[m.group(2)]
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+
+def build_where(args, now : float) -> tuple:
+    """
+    コマンドライン引数から検索条件を組み立てます
+    期間は開始時間で絞り込みます(start_timeのインデックスを使う)
+
+    Args:
+        args        : コマンドライン引数
+        now (float) : 現在の時間(Unixtime)
+
+    Returns:
+        tuple : (WHERE句, パラメータのリスト)
+    """
+    conds = ["start_time >= ?", "start_time < ?"]
+    params = [parse_time(args.since, now), parse_time(args.until, now) if args.until else now]
+
+    for column in ("kind", "camera", "cls", "track"):
+        value = getattr(args, column)
+        if value is not None:
+            conds.append(f"{column} = ?")
+            params.append(value)
+
+    return " AND ".join(conds), params
+
+
+def summary(conn : sqlite3.Connection, where : str, params : list) -> list:
+    """
+    種類、カメラ、クラスごとに集計します
+
+    Args:
+        conn (sqlite3.Connection) : データベース
+        where (str)               : WHERE句
+        params (list)             : パラメータ
+
+    Returns:
+        list : 集計結果(件数、検知していた時間の合計 / 平均 / 最大、静止時間の平均 / 最大)のリスト
+    """
+    sql = f"""
+        SELECT kind, camera, cls, COUNT(*),
+               SUM(end_time - start_time), AVG(end_time - start_time), MAX(end_time - start_time),
+               AVG(stay_sec), MAX(stay_sec)
+        FROM events WHERE {where}
+        GROUP BY kind, camera, cls
+        ORDER BY kind, camera, cls
+    """
+    res = []
+    for kind, camera, cls, count, total, avg, longest, avg_stay, max_stay in conn.execute(sql, params):
+        res.append({
+            "kind" : kind,
+            "camera" : camera,
+            "cls" : cls,
+            "count" : count,
+            "duration_total_sec" : round(total, 1),
+            "duration_avg_sec" : round(avg, 1),
+            "duration_max_sec" : round(longest, 1),
+            "stay_avg_sec" : round(avg_stay, 1) if avg_stay is not None else None,
+            "stay_max_sec" : round(max_stay, 1) if max_stay is not None else None,
+        })
+
+    return res
+
+
+def episodes(conn : sqlite3.Connection, where : str, params : list, limit : int) -> list:
+    """
+    記録の一覧を、新しいものから返します
+
+    Args:
+        conn (sqlite3.Connection) : データベース
+        where (str)               : WHERE句
+        params (list)             : パラメータ
+        limit (int)               : 最大の件数
+
+    Returns:
+        list : 記録のリスト
+    """
+    sql = f"SELECT {', '.join(LIST_COLUMNS)} FROM events WHERE {where} ORDER BY start_time DESC LIMIT ?"
+    return [dict(zip(LIST_COLUMNS, row)) for row in conn.execute(sql, params + [limit])]
+
+
+def print_table(rows : list):
+    """
+    結果を表形式で出力します
+
+    Args:
+        rows (list) : 辞書のリスト
+    """
+    if len(rows) == 0:
+        print("(no events)")
+        return
+
+    columns = list(rows[0].keys())
+    cells = [[format_cell(c, r[c]) for c in columns] for r in rows]
+    widths = [max(len(c), *(len(row[i]) for row in cells)) for i, c in enumerate(columns)]
+
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def format_cell(column : str, value) -> str:
+    """
+    表の1つの値を文字列にします(時間は日時で表示)
+
+    Args:
+        column (str) : 列名
+        value        : 値
+
+    Returns:
+        str : 表示する文字列
+    """
+    if value is None:
+        return "-"
+    if column in ("start_time", "end_time"):
+        return datetime.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the detection event store")
+    parser.add_argument("db", help="event database (EVENT_DB_PATH)")
+    parser.add_argument("command", choices=["summary", "list"], help="summary: counts and durations, list: events")
+    parser.add_argument("--since", default="1d", help="start of the range (e.g. 7d, 12h, 2026-10-01, unixtime; default: 1d)")
+    parser.add_argument("--until", default="", help="end of the range (default: now)")
+    parser.add_argument("--kind", choices=["detection", "alert", "warning"], help="only this kind of event")
+    parser.add_argument("--camera", help="only this camera")
+    parser.add_argument("--cls", type=int, help="only this class")
+    parser.add_argument("--track", type=int, help="only this tracking ID")
+    parser.add_argument("--limit", type=int, default=100, help="maximum number of events to list")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    # 書き込み中のデータベースも読めるよう、読み取り専用で開く(WALモード)
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+
+    start = time.monotonic()
+    try:
+        where, params = build_where(args, time.time())
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if args.command == "summary":
+        rows = summary(conn, where, params)
+    else:
+        rows = episodes(conn, where, params, args.limit)
+
+    elapsed_ms = (time.monotonic() - start) * 1000
+    conn.close()
+
+    if args.json:
+        print(json.dumps(rows, indent=2, ensure_ascii=False))
+    else:
+        print_table(rows)
+
+    print(f"{len(rows)} rows in {elapsed_ms:.1f} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()